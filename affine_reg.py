@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# In-process affine registration to the MNI152 template.
+#
+# A CPU-only replacement for the affine stage of TurboPrep for scans that only
+# need a rigid or affine alignment. Both images are turned into Gaussian
+# pyramids (8/4/2 mm by default); at every level a fixed set of voxels inside the
+# template brain is sampled once, mapped through the current transform and the
+# moving image is interpolated there only (trilinear), so one metric evaluation
+# touches a few tens of thousands of points instead of the full volume. The
+# metric is Mattes-style mutual information (default, works across T1/T2/FLAIR)
+# or NCC for same-contrast pairs, optimised with Powell from coarse to fine,
+# rigid first and then full affine.
+#
+# The template pyramid is built once per worker process and reused for every
+# subject. Output per subject, compatible with propagate.py:
+#   affine_transf.mat      ITK AffineTransform_double_3_3 (fixed=template -> moving)
+#   registered.nii.gz      moving image resampled onto the template grid (cubic)
+
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter, center_of_mass
+from scipy.optimize import minimize
+
+from propagate import write_affine_transf, resample_to_template, read_paths_from_file
+
+# --- Configuration ---
+INPUT_FILE_LIST = "./input_files.txt"
+OUTPUT_DIR_LIST = "./output_paths.txt"
+TEMPLATE_FILE = "MNI152_T1_1mm_brain.nii.gz"
+TRANSFORM_NAME = "affine_transf.mat"
+REGISTERED_NAME = "registered.nii.gz"
+LEVELS_MM = (8.0, 4.0, 2.0)      # pyramid spacing, coarse to fine
+SAMPLES = (4000, 10000, 20000)   # sampled template voxels per level
+METRIC = "mi"                    # "mi" or "ncc"
+HIST_BINS = 32
+# --- End Configuration ---
+
+# Parameter vector: translation (mm), rotation (rad), log-scale, shear.
+# Steps bring every parameter to roughly "1 unit ~ 1 mm at the brain surface".
+_STEP = np.array([1, 1, 1, .01, .01, .01, .01, .01, .01, .01, .01, .01])
+_RIGID = 6
+_AFFINE = 12
+
+# Per-process template pyramid, keyed by (path, mtime, levels)
+_template_cache = {}
+
+
+class Level:
+    """One pyramid level: smoothed, subsampled data and its voxel->RAS affine."""
+
+    def __init__(self, data, affine):
+        self.data = data
+        self.affine = affine
+        self.inv_affine = np.linalg.inv(affine)
+
+
+def build_pyramid(data, affine, levels_mm=LEVELS_MM):
+    """Gaussian pyramid: smooth with sigma = factor/2 voxels, then keep every factor-th voxel."""
+    data = np.asarray(data, dtype=np.float32)
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    pyramid = []
+    for spacing in levels_mm:
+        factors = np.maximum(np.round(spacing / zooms), 1).astype(int)
+        sigma = np.where(factors > 1, factors / 2.0, 0)
+        smoothed = gaussian_filter(data, sigma) if sigma.any() else data
+        sub = np.ascontiguousarray(smoothed[::factors[0], ::factors[1], ::factors[2]])
+        pyramid.append(Level(sub, affine @ np.diag([*factors, 1.0])))
+    return pyramid
+
+
+def load_template(template_path=TEMPLATE_FILE, levels_mm=LEVELS_MM):
+    """Template image and pyramid, built once per process."""
+    key = (os.path.abspath(template_path), os.path.getmtime(template_path), tuple(levels_mm))
+    if key not in _template_cache:
+        img = nib.load(template_path)
+        data = img.get_fdata(dtype=np.float32)
+        _template_cache.clear()
+        _template_cache[key] = (img, build_pyramid(data, img.affine, levels_mm))
+    return _template_cache[key]
+
+
+def params_to_matrix(p, center):
+    """Fixed->moving RAS matrix for a parameter vector, rotating/scaling about `center`."""
+    tx, ty, tz, rx, ry, rz, sx, sy, sz, hxy, hxz, hyz = p
+    cx, sx_, cy, sy_, cz, sz_ = np.cos(rx), np.sin(rx), np.cos(ry), np.sin(ry), np.cos(rz), np.sin(rz)
+    rot = (np.array([[cz, -sz_, 0], [sz_, cz, 0], [0, 0, 1]])
+           @ np.array([[cy, 0, sy_], [0, 1, 0], [-sy_, 0, cy]])
+           @ np.array([[1, 0, 0], [0, cx, -sx_], [0, sx_, cx]]))
+    shear = np.array([[1, hxy, hxz], [0, 1, hyz], [0, 0, 1]])
+    linear = rot @ shear @ np.diag(np.exp([sx, sy, sz]))
+    M = np.eye(4)
+    M[:3, :3] = linear
+    M[:3, 3] = center + np.array([tx, ty, tz]) - linear @ center
+    return M
+
+
+def _sample_points(level, n, rng):
+    """World coordinates of up to `n` template voxels inside the brain."""
+    idx = np.flatnonzero(level.data > 0)
+    if idx.size > n:
+        idx = rng.choice(idx, n, replace=False)
+    vox = np.stack(np.unravel_index(idx, level.data.shape)).astype(np.float64)
+    world = level.affine[:3, :3] @ vox + level.affine[:3, 3:4]
+    return world, level.data.ravel()[idx].astype(np.float64)
+
+
+class _Trilinear:
+    """
+    Trilinear interpolation at arbitrary points: eight flat-index gathers, about
+    twice as fast as map_coordinates(order=1) for the point counts used here.
+    """
+
+    def __init__(self, data):
+        self.flat = np.ascontiguousarray(data, dtype=np.float32).ravel()
+        self.shape = np.array(data.shape)
+        self.upper = (self.shape - 1)[:, None]
+        strides = np.array([data.shape[1] * data.shape[2], data.shape[2], 1])
+        sx, sy, sz = strides
+        self.strides = strides
+        self.corners = [0, sx, sy, sx + sy, sz, sx + sz, sy + sz, sx + sy + sz]
+
+    def inside(self, coords):
+        return np.all((coords >= 0) & (coords <= self.upper), axis=0)
+
+    def __call__(self, coords):
+        i0 = np.minimum(coords.astype(np.intp), self.upper - 1)  # coords are >= 0 here
+        fx, fy, fz = (coords - i0).astype(np.float32)
+        gx, gy, gz = 1 - fx, 1 - fy, 1 - fz
+        base = self.strides @ i0
+        weights = [gx * gy * gz, fx * gy * gz, gx * fy * gz, fx * fy * gz,
+                   gx * gy * fz, fx * gy * fz, gx * fy * fz, fx * fy * fz]
+        out = self.flat[base] * weights[0]
+        for offset, w in zip(self.corners[1:], weights[1:]):
+            out += self.flat[base + offset] * w
+        return out
+
+
+def _quantize(values, lo, hi, bins):
+    q = (values - lo) * ((bins - 1) / max(hi - lo, 1e-6))
+    return np.clip(q, 0, bins - 1).astype(np.intp)
+
+
+class _Cost:
+    """Metric of one pyramid level as a function of the scaled parameter vector."""
+
+    def __init__(self, fixed_level, moving_level, n_samples, center, base, metric, rng):
+        self.points, fixed_vals = _sample_points(fixed_level, n_samples, rng)
+        self.moving = moving_level
+        self.interp = _Trilinear(moving_level.data)
+        self.center = center
+        self.base = base
+        self.metric = metric
+        if metric == "mi":
+            lo, hi = np.percentile(fixed_vals, [1, 99])
+            self.fixed_q = _quantize(fixed_vals, lo, hi, HIST_BINS)
+            nz = moving_level.data[moving_level.data > 0]
+            self.mov_range = np.percentile(nz, [1, 99]) if nz.size else (0.0, 1.0)
+        else:
+            self.fixed_z = (fixed_vals - fixed_vals.mean()) / (fixed_vals.std() + 1e-9)
+
+    def matrix(self, x):
+        p = self.base.copy()
+        p[:x.size] += x * _STEP[:x.size]
+        return params_to_matrix(p, self.center)
+
+    def __call__(self, x):
+        vox_map = self.moving.inv_affine @ self.matrix(x)
+        coords = vox_map[:3, :3] @ self.points + vox_map[:3, 3:4]
+        inside = self.interp.inside(coords)
+        if inside.sum() < 0.1 * inside.size:
+            return 1.0  # mapped outside the moving field of view
+        vals = self.interp(coords[:, inside])
+
+        if self.metric == "ncc":
+            f = self.fixed_z[inside]
+            m = (vals - vals.mean()) / (vals.std() + 1e-9)
+            return -float(np.mean(f * m)) * inside.mean()
+
+        joint = np.bincount(self.fixed_q[inside] * HIST_BINS + _quantize(vals, *self.mov_range, HIST_BINS),
+                            minlength=HIST_BINS * HIST_BINS).reshape(HIST_BINS, HIST_BINS)
+        pxy = joint / joint.sum()
+        px = pxy.sum(axis=1, keepdims=True)
+        py = pxy.sum(axis=0, keepdims=True)
+        nz = pxy > 0
+        mi = np.sum(pxy[nz] * np.log(pxy[nz] / (px @ py)[nz]))
+        # Penalise shrinking the overlap, otherwise MI can prefer mapping into background
+        return -float(mi) * inside.mean()
+
+
+def register_params(moving_data, moving_affine, template_path=TEMPLATE_FILE, dof=_AFFINE,
+                    metric=METRIC, levels_mm=LEVELS_MM, samples=SAMPLES, seed=0,
+                    init=None, first_level=0):
+    """
+    Affine registration of a moving volume to the template.
+    Returns a reference dict: parameter vector, template centre, moving centre
+    of mass and final metric value. Passing a previous result as `init` (e.g.
+    the baseline visit of the same subject) starts from its parameters, shifted
+    by the difference in centres of mass, instead of the plain centre-of-mass
+    alignment; `first_level` skips that many of the coarsest pyramid levels.
+    """
+    _, fixed_pyr = load_template(template_path, levels_mm)
+    moving_pyr = build_pyramid(moving_data, moving_affine, levels_mm)
+    rng = np.random.default_rng(seed)
+
+    # Rotate/scale about the template brain centre; start with the centres of mass aligned
+    def world_com(level, weights):
+        return level.affine[:3, :3] @ np.array(center_of_mass(weights)) + level.affine[:3, 3]
+
+    t_com = world_com(fixed_pyr[-1], fixed_pyr[-1].data > 0)
+    m_com = world_com(moving_pyr[-1], np.maximum(moving_pyr[-1].data, 0))
+    if init is None:
+        params = np.zeros(_AFFINE)
+        params[:3] = m_com - t_com
+    else:
+        params = np.array(init["params"], dtype=np.float64)
+        params[:3] += m_com - np.asarray(init["moving_com"])
+
+    value = 0.0
+    for i, (fixed_level, moving_level) in enumerate(zip(fixed_pyr, moving_pyr)):
+        if i < first_level:
+            continue
+        # Rigid first on the coarsest level, then the requested degrees of freedom
+        stages = [_RIGID, dof] if i == 0 and dof != _RIGID and init is None else [dof]
+        n = samples[min(i, len(samples) - 1)]
+        for n_params in stages:
+            cost = _Cost(fixed_level, moving_level, n, t_com, params, metric, rng)
+            res = minimize(cost, np.zeros(n_params), method="Powell",
+                           options={"xtol": 1e-2, "ftol": 5e-4, "maxfev": 300 * n_params})
+            params[:n_params] += res.x * _STEP[:n_params]
+            value = float(res.fun)
+    return {"params": params, "center": t_com, "moving_com": m_com, "metric": value}
+
+
+def register(moving_data, moving_affine, template_path=TEMPLATE_FILE, dof=_AFFINE,
+             metric=METRIC, levels_mm=LEVELS_MM, samples=SAMPLES, seed=0):
+    """
+    Affine registration of a moving volume to the template.
+    Returns the 4x4 RAS fixed->moving matrix and the final metric value.
+    """
+    ref = register_params(moving_data, moving_affine, template_path, dof, metric, levels_mm, samples, seed)
+    return params_to_matrix(ref["params"], ref["center"]), ref["metric"]
+
+
+def register_file(input_path, output_dir, template_path=TEMPLATE_FILE, dof=_AFFINE,
+                  metric=METRIC, overwrite=False):
+    """Register one NIfTI file and write `affine_transf.mat` and `registered.nii.gz`."""
+    transform_path = os.path.join(output_dir, TRANSFORM_NAME)
+    registered_path = os.path.join(output_dir, REGISTERED_NAME)
+    if os.path.exists(transform_path) and os.path.exists(registered_path) and not overwrite:
+        return None
+
+    start = time.time()
+    moving = nib.load(input_path)
+    fixed_to_moving, value = register(moving.get_fdata(dtype=np.float32), moving.affine,
+                                      template_path, dof=dof, metric=metric)
+    template_img, _ = load_template(template_path)
+
+    os.makedirs(output_dir, exist_ok=True)
+    write_affine_transf(transform_path, fixed_to_moving)
+    data = resample_to_template(moving, fixed_to_moving, template_img, order=3).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, template_img.affine), registered_path)
+    return {"metric": value, "seconds": time.time() - start}
+
+
+def _init_worker(template_path):
+    load_template(template_path)
+
+
+def register_batch(input_list=INPUT_FILE_LIST, output_list=OUTPUT_DIR_LIST, template_path=TEMPLATE_FILE,
+                   dof=_AFFINE, metric=METRIC, workers=None, overwrite=False):
+    """Register every input/output pair of the list files across a process pool."""
+    inputs = read_paths_from_file(input_list)
+    outputs = read_paths_from_file(output_list)
+    if len(inputs) != len(outputs):
+        raise SystemExit(f"Error: Mismatch in number of lines between {input_list} and {output_list}.")
+
+    done = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(template_path,)) as pool:
+        futures = {
+            pool.submit(register_file, i, o, template_path, dof, metric, overwrite): i
+            for i, o in zip(inputs, outputs)
+        }
+        for fut in as_completed(futures):
+            name = os.path.basename(futures[fut])
+            try:
+                info = fut.result()
+            except Exception as e:
+                failed += 1
+                print(f"Error registering {futures[fut]}: {e}")
+                continue
+            if info is None:
+                skipped += 1
+            else:
+                done += 1
+                print(f"{name}: metric {info['metric']:.4f} in {info['seconds']:.1f}s")
+    print(f"Registration finished: {done} done, {skipped} skipped, {failed} failed.")
+    return done, skipped, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Affine registration to the MNI152 template (CPU, in-process).")
+    parser.add_argument("--inputs", default=INPUT_FILE_LIST)
+    parser.add_argument("--outputs", default=OUTPUT_DIR_LIST)
+    parser.add_argument("--template", default=TEMPLATE_FILE)
+    parser.add_argument("--dof", type=int, choices=[_RIGID, _AFFINE], default=_AFFINE)
+    parser.add_argument("--metric", choices=["mi", "ncc"], default=METRIC)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    register_batch(args.inputs, args.outputs, args.template, args.dof, args.metric,
+                   args.workers, args.overwrite)
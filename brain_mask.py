@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Volumetric brain masking: 3D Otsu + coarse-grid morphology + largest component.
+#
+#   1. Otsu threshold from one histogram of the whole volume, computed on the
+#      stored (unscaled) integers - the mask does not depend on scl_slope, so
+#      int16 data is never converted to float;
+#   2. the thresholded volume is block-reduced by DOWNSAMPLE (majority vote)
+#      and 3D closing, largest-component selection and hole filling (both from
+#      connected-component labels) run on that coarse grid (DOWNSAMPLE**3
+#      fewer voxels);
+#   3. back at full resolution the coarse interior (eroded by one coarse
+#      voxel) is taken as-is and the boundary band comes from the full-res
+#      threshold, so edges keep voxel detail.
+# Replaces the per-slice Otsu + 5x5 closing of msrcr.get_brain_mask and the
+# min-max threshold of mask.py with one consistent 3D mask. Batches run on a
+# process pool:
+#   python brain_mask.py --input-dir 1 --output-dir masks --workers 8
+#   python mask.py --method otsu3d --input_file sub01.nii.gz
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from tqdm import tqdm
+
+import qc_metrics
+
+# --- Configuration ---
+DOWNSAMPLE = 2          # coarse grid factor per axis
+CLOSING_ITERS = 2       # closing radius in coarse voxels
+HIST_BINS = 256         # bins for float data (integers use one bin per value when feasible)
+MAX_INT_BINS = 1 << 16
+HIST_STRIDE = 2         # histogram of every 2nd voxel per axis (Otsu is insensitive to it)
+# --- End Configuration ---
+
+
+def volume_histogram(data, bins=HIST_BINS):
+    """
+    Histogram of the whole volume in one pass, native dtype. Returns
+    (counts, bin centres, bin upper bounds); integers get one bin per value.
+    """
+    flat = data.ravel()
+    lo, hi = int(flat.min()), int(np.ceil(flat.max()))
+    if data.dtype.kind in "iu" and hi - min(lo, 0) < MAX_INT_BINS:
+        counts = np.bincount(flat if lo >= 0 else flat.astype(np.intp) - lo)
+        values = np.arange(counts.size, dtype=np.float64) + min(lo, 0)
+        return counts, values, values
+    counts, edges = np.histogram(flat, bins=bins, range=(float(flat.min()), float(flat.max())))
+    return counts, (edges[:-1] + edges[1:]) / 2, edges[1:]
+
+
+def otsu_threshold(counts, centers, upper=None):
+    """Otsu's threshold from a histogram: voxels > threshold are foreground."""
+    upper = centers if upper is None else upper
+    w0 = np.cumsum(counts, dtype=np.float64)
+    total = w0[-1]
+    m0 = np.cumsum(counts * centers, dtype=np.float64)
+    w1 = total - w0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu0 = m0 / w0
+        mu1 = (m0[-1] - m0) / w1
+        between = w0 * w1 * (mu0 - mu1) ** 2
+    between[~np.isfinite(between)] = -1
+    return upper[int(np.argmax(between))]
+
+
+def _pad_to_blocks(binary, f):
+    pad = [(0, (-n) % f) for n in binary.shape]
+    return np.pad(binary, pad) if any(p for _, p in pad) else binary
+
+
+def _block_reduce(binary, f):
+    """Majority vote over f x f x f blocks, as f**3 strided uint8 adds."""
+    u8 = binary.view(np.uint8)
+    counts = None
+    for i in range(f):
+        for j in range(f):
+            for k in range(f):
+                part = u8[i::f, j::f, k::f]
+                counts = part.copy() if counts is None else np.add(counts, part, out=counts)
+    return counts * 2 >= f ** 3
+
+
+def _block_expand(coarse, f, shape):
+    """Nearest-neighbour upsampling by f per axis, as f**3 strided stores."""
+    full = np.empty(shape, dtype=coarse.dtype)
+    for i in range(f):
+        for j in range(f):
+            for k in range(f):
+                full[i::f, j::f, k::f] = coarse
+    return full
+
+
+def fill_and_keep_largest(binary):
+    """Largest connected component of `binary` with its interior holes filled."""
+    labeled, n = ndimage.label(binary)
+    if n == 0:
+        return binary
+    sizes = np.bincount(labeled.ravel())
+    sizes[0] = 0
+    component = labeled == sizes.argmax()
+    # Holes: background components that do not touch the volume border
+    background, _ = ndimage.label(~component)
+    border = np.unique(np.concatenate([background[[0, -1]].ravel(), background[:, [0, -1]].ravel(),
+                                       background[:, :, [0, -1]].ravel()]))
+    outside = np.isin(background, border[border > 0])
+    return ~outside
+
+
+def compute_mask(data, downsample=DOWNSAMPLE, closing_iters=CLOSING_ITERS, threshold=None):
+    """Bool brain mask of a 3D volume (any dtype); returns (mask, threshold)."""
+    if threshold is None:
+        sample = data[::HIST_STRIDE, ::HIST_STRIDE, ::HIST_STRIDE]
+        threshold = otsu_threshold(*volume_histogram(np.ascontiguousarray(sample)))
+    f = downsample
+    fine = _pad_to_blocks(data > threshold, f)
+
+    coarse = _block_reduce(fine, f) if f > 1 else fine
+    struct = ndimage.generate_binary_structure(3, 1)
+    r = closing_iters
+    if r:
+        # Pad so closing does not erode objects touching the border
+        coarse = ndimage.binary_closing(np.pad(coarse, r), struct, iterations=r)[r:-r, r:-r, r:-r]
+    coarse = fill_and_keep_largest(coarse)
+    if f == 1:
+        return coarse, threshold
+
+    # Interior blocks (eroded by one coarse voxel) are kept whole; the
+    # boundary band takes the full-resolution threshold
+    code = coarse.view(np.uint8) + ndimage.binary_erosion(coarse, struct).view(np.uint8)
+    code = _block_expand(code, f, fine.shape)
+    mask = np.greater(code, 0, out=fine, where=fine)
+    mask |= code == 2
+    return mask[:data.shape[0], :data.shape[1], :data.shape[2]], threshold
+
+
+def load_native(path):
+    """(image, stored data): unscaled integers when the scaling is a positive affine map."""
+    img = nib.load(path)
+    slope, _ = img.header.get_slope_inter()
+    if slope is None or slope > 0:
+        return img, np.asanyarray(img.dataobj.get_unscaled())
+    return img, np.asanyarray(img.dataobj)
+
+
+def mask_file(input_path, output_path, **kwargs):
+    """Write the uint8 mask of `input_path`; returns the mask fraction."""
+    img, data = load_native(input_path)
+    mask, _ = compute_mask(data, **kwargs)
+    out = nib.Nifti1Image(mask.astype(np.uint8), img.affine, img.header)
+    out.set_data_dtype(np.uint8)
+    out.header.set_slope_inter(1.0, 0.0)
+    nib.save(out, output_path)
+    qc_metrics.record(output_path, "mask", data, mask, source=input_path,
+                      voxel_ml=qc_metrics.voxel_volume_ml(img.header))
+    return float(mask.mean())
+
+
+def mask_batch(pairs, workers=None, **kwargs):
+    """Mask (input, output) pairs across a process pool; returns the failed inputs."""
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(mask_file, src, dst, **kwargs): src for src, dst in pairs}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Masking"):
+            try:
+                fut.result()
+            except Exception as e:
+                failed.append(futures[fut])
+                print(f"Error masking {futures[fut]}: {e}")
+    print(f"Masking finished: {len(pairs) - len(failed)} done, {len(failed)} failed.")
+    return failed
+
+
+def default_output(input_path):
+    return os.path.splitext(os.path.splitext(input_path)[0])[0] + '_brain_mask.nii.gz'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="3D Otsu brain masks for a directory of volumes.")
+    parser.add_argument("--input-dir", required=True)
+    parser.add_argument("--output-dir", help="Default: next to each input as *_brain_mask.nii.gz")
+    parser.add_argument("--downsample", type=int, default=DOWNSAMPLE)
+    parser.add_argument("--closing-iters", type=int, default=CLOSING_ITERS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    inputs = [os.path.join(args.input_dir, f) for f in sorted(os.listdir(args.input_dir))
+              if f.endswith((".nii", ".nii.gz")) and "_brain_mask" not in f]
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        pairs = [(p, os.path.join(args.output_dir, os.path.basename(default_output(p)))) for p in inputs]
+    else:
+        pairs = [(p, default_output(p)) for p in inputs]
+    mask_batch(pairs, args.workers, downsample=args.downsample, closing_iters=args.closing_iters)
@@ -15,16 +15,24 @@ expected_files = [
 ]
 # --- End Configuration ---
 
-# Initialize dictionaries to store results
-missing_files_map = {}  # Stores {folder_path: [list_of_missing_files]}
-missing_file_counts = collections.Counter() # Counts how many folders miss each specific file
 
-print(f"Scanning subdirectories inside: {parent_directory}\n")
+def check_outputs(parent_directory=parent_directory, expected_files=expected_files):
+    """
+    Report subdirectories of `parent_directory` that miss any of `expected_files`.
+    Returns ({folder_path: [missing files]}, Counter of missing file names).
+    """
+    # Initialize dictionaries to store results
+    missing_files_map = {}  # Stores {folder_path: [list_of_missing_files]}
+    missing_file_counts = collections.Counter() # Counts how many folders miss each specific file
+
+    print(f"Scanning subdirectories inside: {parent_directory}\n")
+
+    # Check if the parent directory exists
+    if not os.path.isdir(parent_directory):
+        print(f"Error: Parent directory not found at '{parent_directory}'")
+        print("\n---------------------")
+        return None, missing_file_counts
 
-# Check if the parent directory exists
-if not os.path.isdir(parent_directory):
-    print(f"Error: Parent directory not found at '{parent_directory}'")
-else:
     # Iterate through items in the parent directory
     for item_name in os.listdir(parent_directory):
         item_path = os.path.join(parent_directory, item_name)
@@ -73,4 +81,9 @@ else:
             for file_name, count in missing_file_counts.items():
                 print(f"- '{file_name}': Missing from {count} folder(s)")
 
-print("\n---------------------")
\ No newline at end of file
+    print("\n---------------------")
+    return missing_files_map, missing_file_counts
+
+
+if __name__ == "__main__":
+    check_outputs()
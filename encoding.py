@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Compact NIfTI output encoding.
+#
+# Intensity volumes are stored as uint8/int16 with per-volume scl_slope /
+# scl_inter instead of float32. The slope is the smallest one that covers the
+# volume's range, the intercept is placed so that 0 (background) stays exactly
+# 0, and the narrowest dtype whose rounding error (slope / 2) is within the
+# requested bound is used. Readers need no change: nibabel's get_fdata() (and
+# every other NIfTI reader) applies the scaling.
+#
+# Label maps go to the smallest integer dtype that holds their label set.
+#
+#   python encoding.py recode out_dir/*.nii.gz --max-rel-error 1e-3
+#   python encoding.py recode seg/*.nii.gz --labels
+
+import os
+import argparse
+
+import numpy as np
+import nibabel as nib
+
+# --- Configuration ---
+# Largest allowed |decoded - original| as a fraction of the volume's value range
+MAX_REL_ERROR = 1e-3
+# Candidate storage types, narrowest first
+INTENSITY_DTYPES = ("uint8", "int16")
+# --- End Configuration ---
+
+
+def _scaling(vmin, vmax, dtype):
+    """
+    (slope, inter) mapping [vmin, vmax] into the integer range of `dtype`,
+    keeping 0 exactly representable when it lies inside the range.
+    """
+    info = np.iinfo(dtype)
+    levels = int(info.max) - int(info.min)
+    span = vmax - vmin
+    if span <= 0:
+        return 1.0, float(vmin) if vmin != 0 else 0.0
+    if vmin <= 0 <= vmax:
+        # One spare level so the integer offset of 0 can be rounded up. The
+        # header stores slope/inter as float32, so the slope is rounded up to 8
+        # significant bits: k * slope is then exact in float32 and 0 decodes to 0.
+        slope = span / (levels - 1)
+        exp = np.floor(np.log2(slope)) - 7
+        slope = float(np.ceil(slope / 2.0 ** exp) * 2.0 ** exp)
+        k = int(np.ceil(info.min - vmin / slope))
+        return slope, -k * slope
+    slope = span / levels
+    return slope, vmin - int(info.min) * slope
+
+
+def quantize(data, dtype, slope, inter):
+    info = np.iinfo(dtype)
+    q = np.rint((data - inter) / slope)
+    return np.clip(q, info.min, info.max).astype(dtype)
+
+
+def encode_intensity(data, max_abs_error=None, max_rel_error=MAX_REL_ERROR, dtypes=INTENSITY_DTYPES):
+    """
+    Choose a storage dtype and scaling for a float volume.
+    Returns (quantized array, slope, inter, report) where report holds the
+    achieved max/RMS error; falls back to float32 if no dtype meets the bound.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    finite = np.isfinite(data)
+    n_nonfinite = int(data.size - finite.sum())
+    if n_nonfinite:
+        data = np.where(finite, data, 0).astype(np.float32)
+    vmin, vmax = float(data.min()), float(data.max())
+    bound = max_abs_error if max_abs_error is not None else max_rel_error * max(vmax - vmin, 1e-12)
+
+    for dtype in dtypes:
+        slope, inter = _scaling(vmin, vmax, dtype)
+        if slope / 2 > bound:
+            continue
+        q = quantize(data, dtype, slope, inter)
+        err = q.astype(np.float32) * np.float32(slope) + np.float32(inter) - data
+        report = {"dtype": np.dtype(dtype).name, "slope": slope, "inter": inter,
+                  "max_abs_error": float(np.abs(err).max()), "rms_error": float(np.sqrt(np.mean(err ** 2))),
+                  "bound": bound, "nonfinite": n_nonfinite}
+        return q, slope, inter, report
+
+    return data, 1.0, 0.0, {"dtype": "float32", "slope": 1.0, "inter": 0.0, "max_abs_error": 0.0,
+                            "rms_error": 0.0, "bound": bound, "nonfinite": n_nonfinite}
+
+
+def smallest_label_dtype(labels):
+    """Smallest NIfTI integer dtype that holds every label value."""
+    lo, hi = int(labels.min()), int(labels.max())
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def encode_labels(labels):
+    """Cast a label map to its smallest integer dtype; float inputs must hold integers."""
+    labels = np.asarray(labels)
+    if labels.dtype.kind == "f":
+        rounded = np.rint(labels)
+        if not np.array_equal(rounded, labels):
+            raise ValueError("Label map has non-integer values")
+        labels = rounded
+    return labels.astype(smallest_label_dtype(labels), copy=False)
+
+
+def intensity_image(data, affine, header=None, **kwargs):
+    """Nifti1Image with quantized storage; returns (image, report)."""
+    q, slope, inter, report = encode_intensity(data, **kwargs)
+    img = nib.Nifti1Image(q, affine, header)
+    img.set_data_dtype(q.dtype)
+    img.header.set_slope_inter(slope, inter)
+    return img, report
+
+
+def label_image(labels, affine, header=None):
+    labels = encode_labels(labels)
+    img = nib.Nifti1Image(labels, affine, header)
+    img.set_data_dtype(labels.dtype)
+    img.header.set_slope_inter(1.0, 0.0)
+    return img
+
+
+def save_intensity(data, affine, path, header=None, **kwargs):
+    """Save a float volume with compact encoding; returns the error report."""
+    img, report = intensity_image(data, affine, header, **kwargs)
+    nib.save(img, path)
+    return report
+
+
+def save_labels(labels, affine, path, header=None):
+    img = label_image(labels, affine, header)
+    nib.save(img, path)
+    return img.get_data_dtype().name
+
+
+def save_output(data, affine, path, header=None, encoding=None, max_rel_error=MAX_REL_ERROR):
+    """
+    Save an intensity volume as float32 (encoding=None, the previous behaviour)
+    or compactly ('auto' picks the narrowest dtype within the bound, 'uint8' /
+    'int16' force one). Returns the error report (None for float32).
+    """
+    if encoding is None:
+        nib.save(nib.Nifti1Image(np.asarray(data, dtype=np.float32), affine, header), path)
+        return None
+    dtypes = INTENSITY_DTYPES if encoding == "auto" else (encoding,)
+    max_error = None if encoding == "auto" else np.inf
+    return save_intensity(data, affine, path, header, max_abs_error=max_error,
+                          max_rel_error=max_rel_error, dtypes=dtypes)
+
+
+def describe(report):
+    return (f"{report['dtype']} (max err {report['max_abs_error']:.3g}, "
+            f"rms {report['rms_error']:.3g}, bound {report['bound']:.3g})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-encode NIfTI files compactly in place.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("recode")
+    p.add_argument("files", nargs="+")
+    p.add_argument("--labels", action="store_true", help="Files are label maps")
+    p.add_argument("--max-rel-error", type=float, default=MAX_REL_ERROR)
+    p.add_argument("--max-abs-error", type=float)
+    args = parser.parse_args()
+
+    before = after = 0
+    for path in args.files:
+        size = os.path.getsize(path)
+        img = nib.load(path)
+        tmp = path + ".tmp.nii.gz"
+        if args.labels:
+            dtype = save_labels(np.asanyarray(img.dataobj), img.affine, tmp, img.header)
+            summary = dtype
+        else:
+            report = save_intensity(img.get_fdata(dtype=np.float32), img.affine, tmp, img.header,
+                                    max_abs_error=args.max_abs_error, max_rel_error=args.max_rel_error)
+            summary = describe(report)
+        os.replace(tmp, path)
+        before += size
+        after += os.path.getsize(path)
+        print(f"{path}: {summary}, {size / 1e6:.1f} MB -> {os.path.getsize(path) / 1e6:.1f} MB")
+    print(f"Total: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
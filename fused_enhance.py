@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Fused MSRCR + unsharp mask + white-stripe (same output as msrcr_sample.py).
+#
+# msrcr_sample.py blurs every slice three times for the retinex scales,
+# unsharp-masks in a second pass and white-stripes a third full copy. Here:
+#   * scipy's reflect-mode Gaussian is diagonal in the DCT-II basis, so each
+#     slab of slices is transformed once and every retinex scale is a
+#     multiply by that scale's kernel response plus one inverse DCT (the cost
+#     no longer grows with sigma; sigma=250 was a 2001-tap kernel per pass);
+#   * the unsharp detail is taken from the retinex slab while it is still in
+#     cache, and written straight into the single output volume;
+#   * white-stripe is applied to that volume in place.
+# Only one full-volume buffer is allocated; everything else is slab-sized.
+#
+#   python fused_enhance.py --input-dir 1 --output-dir normalized_regs_msrcr
+#   python -m pipeline enhance --method msrcr_unsharp_fused
+
+import os
+import argparse
+
+import numpy as np
+from scipy import fft
+from scipy.ndimage import gaussian_filter
+
+from bias_field import correct_bias
+from encoding import describe, save_output
+from intermediate_cache import load_resampled
+import qc_metrics
+
+# --- Configuration ---
+INPUT_DIR = '1'
+OUTPUT_DIR = 'normalized_regs_msrcr'
+TARGET_SHAPE = (182, 218, 182)
+SIGMA_LIST = (15, 80, 250)
+GAIN = 1.0
+OFFSET = 0.0
+SHARPEN_RADIUS = 1
+SHARPEN_AMOUNT = 1.0
+STRIPE_PCT = (70, 90)
+# Slices per slab (bounds the temporary DCT buffers)
+SLAB = 16
+# Remove a volumetric (N4-style) bias field before the retinex (bias_field.py)
+BIAS_CORRECT = False
+# --- End Configuration ---
+
+_TRUNCATE = 4.0  # scipy.ndimage / skimage default
+
+
+def gaussian_response(n, sigma, truncate=_TRUNCATE):
+    """
+    DCT-II eigenvalues of scipy's truncated reflect-mode Gaussian on a length-n
+    axis: blurring is idct(dct(x) * response), exactly, for any kernel radius.
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    w = np.exp(-0.5 * (x / float(sigma)) ** 2)
+    w /= w.sum()
+    k = np.arange(n)
+    return np.cos(np.pi * np.outer(k, x) / n) @ w
+
+
+def _responses(shape, sigma_list):
+    return [(gaussian_response(shape[0], s)[:, None, None],
+             gaussian_response(shape[1], s)[None, :, None]) for s in sigma_list]
+
+
+def white_stripe_inplace(volume, mask=None, lower_pct=STRIPE_PCT[0], upper_pct=STRIPE_PCT[1]):
+    """White-stripe normalization (as in msrcr_sample.py) without a second copy; returns (mean, std)."""
+    vals = volume[mask > 0] if mask is not None else volume.ravel()
+    lo, hi = np.percentile(vals, [lower_pct, upper_pct])
+    stripe_vals = vals[(vals >= lo) & (vals <= hi)]
+    mean_ws, std_ws = stripe_vals.mean(), stripe_vals.std()
+    std_ws = std_ws if std_ws > 0 else 1.0
+    volume -= mean_ws
+    volume /= std_ws
+    return mean_ws, std_ws
+
+
+def fused_enhance(volume, mask=None, sigma_list=SIGMA_LIST, gain=GAIN, offset=OFFSET,
+                  sharpen_radius=SHARPEN_RADIUS, sharpen_amount=SHARPEN_AMOUNT,
+                  white_stripe=True, slab=SLAB, out=None):
+    """
+    Slice-wise MSRCR, unsharp mask and white-stripe of a 3D volume (slices on
+    the last axis). Returns a float32 volume (`out` if given).
+    """
+    if out is None:
+        out = np.empty(volume.shape, dtype=np.float32)
+    responses = _responses(volume.shape, sigma_list)
+    n_scales = len(sigma_list)
+
+    for z0 in range(0, volume.shape[2], slab):
+        img = volume[:, :, z0:z0 + slab].astype(np.float64) + 1.0
+        # Cubic resampling undershoots well below -1 at sharp edges; log() of
+        # those voxels is NaN, the unsharp blur spreads it and white-stripe's
+        # percentiles then turn the whole volume NaN. Treat them as 0.
+        np.maximum(img, 1.0, out=img)
+        coeffs = fft.dctn(img, type=2, axes=(0, 1), workers=-1)
+        log_blur = np.zeros_like(img)
+        for r0, r1 in responses:
+            blur = fft.idctn(coeffs * r0 * r1, type=2, axes=(0, 1), workers=-1)
+            log_blur += np.log(blur + 1e-6)
+        msr = np.log(img)
+        msr -= log_blur / n_scales
+        if gain != 1.0 or offset != 0.0:
+            msr = gain * msr + offset
+        msr = msr.astype(np.float32)
+        if sharpen_amount:
+            blurred = gaussian_filter(msr, sigma=(sharpen_radius, sharpen_radius, 0), mode='reflect')
+            np.subtract(msr, blurred, out=blurred)
+            blurred *= sharpen_amount
+            msr += blurred
+        out[:, :, z0:z0 + slab] = msr
+
+    if white_stripe:
+        white_stripe_inplace(out, mask)
+    return out
+
+
+def enhance_file(src, dst, target_shape=TARGET_SHAPE, sigma_list=SIGMA_LIST, gain=GAIN, offset=OFFSET,
+                 sharpen_radius=SHARPEN_RADIUS, sharpen_amount=SHARPEN_AMOUNT,
+                 output_encoding=None, max_rel_error=1e-3, out=None, bias_correct=BIAS_CORRECT):
+    """Resample, enhance and white-stripe one volume into `dst`; returns the output buffer for reuse."""
+    volume, mask, affine, header = load_resampled(src, target_shape)
+    if bias_correct:
+        volume, _ = correct_bias(volume, mask)
+    if out is None or out.shape != volume.shape:
+        out = np.empty(volume.shape, dtype=np.float32)
+    fused_enhance(volume, mask, sigma_list, gain, offset, sharpen_radius, sharpen_amount,
+                  white_stripe=False, out=out)
+    stripe = white_stripe_inplace(out, mask)
+    report = save_output(out, affine, dst, header, encoding=output_encoding, max_rel_error=max_rel_error)
+    qc_metrics.record(dst, "msrcr_unsharp", out, mask, source=src, stripe=stripe)
+    return out, report
+
+
+def process_dir(input_dir=INPUT_DIR, output_dir=OUTPUT_DIR, target_shape=TARGET_SHAPE,
+                sigma_list=SIGMA_LIST, gain=GAIN, offset=OFFSET,
+                sharpen_radius=SHARPEN_RADIUS, sharpen_amount=SHARPEN_AMOUNT,
+                output_encoding=None, max_rel_error=1e-3, bias_correct=BIAS_CORRECT):
+    """Drop-in for msrcr_sample.process_dir using the fused kernel."""
+    os.makedirs(output_dir, exist_ok=True)
+    out = None
+    for filename in sorted(os.listdir(input_dir)):
+        if not filename.endswith('.nii.gz'):
+            continue
+        out, report = enhance_file(os.path.join(input_dir, filename), os.path.join(output_dir, filename),
+                                   target_shape, sigma_list, gain, offset, sharpen_radius, sharpen_amount,
+                                   output_encoding, max_rel_error, out=out, bias_correct=bias_correct)
+        encoded = f" Stored as {describe(report)}." if report else ""
+        print(f"Processed {filename}: fused MSRCR + sharpening + WhiteStripe.{encoded}")
+    print("All files processed with the fused MSRCR / unsharp / WhiteStripe stage.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fused MSRCR + unsharp mask + white-stripe.")
+    parser.add_argument("--input-dir", default=INPUT_DIR)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--target-shape", type=int, nargs=3, default=list(TARGET_SHAPE))
+    parser.add_argument("--encoding", choices=["auto", "int16", "uint8"])
+    parser.add_argument("--max-rel-error", type=float, default=1e-3)
+    parser.add_argument("--bias-correct", action="store_true", help="N4-style bias correction first")
+    args = parser.parse_args()
+    process_dir(args.input_dir, args.output_dir, tuple(args.target_shape),
+                output_encoding=args.encoding, max_rel_error=args.max_rel_error,
+                bias_correct=args.bias_correct)
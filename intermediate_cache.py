@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# Content-addressed on-disk cache for expensive intermediates.
+#
+# Keys hash the *content* of the input file together with the stage name and
+# its parameters (target shape, interpolation order, method, ...), so a renamed
+# or copied input still hits and a changed input or parameter never does.
+# Values are stored as uncompressed .npy files (fast to read back, no zlib) in
+#   <CACHE_DIR>/<key[:2]>/<key>/<name>.npy
+# Entries are published with an atomic rename, so concurrent workers can share
+# one cache directory. The directory is capped at CACHE_MAX_GB; least recently
+# used entries (by the entry directory's mtime, refreshed on every hit) are
+# evicted first, down to EVICT_TO of the cap. Each store keeps a running byte
+# total (one scan at start-up) and only rescans the tree when a put crosses
+# the cap.
+#
+# The padded + cubic-resampled volume used by normalize.py, normalize2.py,
+# msrcr.py, msrcr_sample.py and sweep.py goes through `load_resampled`, so a
+# second enhancement variant over the same dataset skips resampling entirely.
+# That only pays off if the cap holds the whole dataset - about 36 MB per
+# subject at 182x218x182, i.e. ~22 GB for 600 subjects; a smaller cap makes a
+# sequential pass evict every entry before the next stage reaches it. The
+# cache is therefore off unless asked for: set PIPELINE_CACHE=1 (or
+# PIPELINE_CACHE_DIR) and size PIPELINE_CACHE_MAX_GB to the dataset.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+# --- Configuration ---
+CACHE_DIR = os.environ.get("PIPELINE_CACHE_DIR", os.path.join(".cache", "intermediates"))
+CACHE_MAX_GB = float(os.environ.get("PIPELINE_CACHE_MAX_GB", 20))
+CACHE_ENABLED = os.environ.get("PIPELINE_CACHE", "1" if "PIPELINE_CACHE_DIR" in os.environ else "0") != "0"
+# Eviction frees space down to this fraction of the cap
+EVICT_TO = 0.8
+# --- End Configuration ---
+
+_CHUNK = 1 << 20
+# (path, size, mtime_ns) -> sha256, so a file is hashed once per process
+_digests = {}
+
+
+def file_digest(path):
+    """SHA-256 of a file's bytes."""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    digest = _digests.get(memo_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK), b""):
+                h.update(chunk)
+        digest = _digests[memo_key] = h.hexdigest()
+    return digest
+
+
+def cache_key(stage, input_digest, **params):
+    """Key for `stage` applied to the input with these parameters."""
+    payload = json.dumps({"stage": stage, "input": input_digest, "params": params},
+                         sort_keys=True, default=lambda o: np.asarray(o).tolist())
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class IntermediateStore:
+    def __init__(self, root=CACHE_DIR, max_gb=CACHE_MAX_GB):
+        self.root = root
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        os.makedirs(root, exist_ok=True)
+        # Running total; other workers' puts are only seen at the next rescan
+        self._total = self.size_bytes()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Dict of arrays stored under `key`, or None."""
+        entry = self._entry(key)
+        try:
+            names = [n for n in os.listdir(entry) if n.endswith(".npy")]
+            arrays = {n[:-4]: np.load(os.path.join(entry, n)) for n in names}
+        except (FileNotFoundError, ValueError, OSError):
+            return None  # missing, or evicted while we were reading
+        try:
+            os.utime(entry, None)  # LRU touch
+        except OSError:
+            pass
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a dict of arrays; returns False if another worker stored it first."""
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        try:
+            size = 0
+            for name, arr in arrays.items():
+                path = os.path.join(tmp, f"{name}.npy")
+                np.save(path, np.asarray(arr), allow_pickle=False)
+                size += os.path.getsize(path)
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self._total += size
+        if self._total > self.max_bytes:
+            self.evict()
+        return True
+
+    def get_or_compute(self, key, compute):
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return arrays
+
+    def _entries(self):
+        for shard in os.listdir(self.root):
+            shard_path = os.path.join(self.root, shard)
+            if shard.startswith(".") or not os.path.isdir(shard_path):
+                continue
+            for key in os.listdir(shard_path):
+                entry = os.path.join(shard_path, key)
+                try:
+                    size = sum(e.stat().st_size for e in os.scandir(entry))
+                    yield os.stat(entry).st_mtime, size, entry
+                except OSError:
+                    continue
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in EVICT_TO of max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        if total > self.max_bytes:
+            for _, size, entry in entries:
+                if total <= EVICT_TO * self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                removed += 1
+        self._total = total
+        # Temp dirs left behind by killed workers
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(".tmp-") and now - os.stat(path).st_mtime > 3600:
+                shutil.rmtree(path, ignore_errors=True)
+        return removed
+
+
+_store = None
+
+
+def default_store():
+    """Process-wide store in CACHE_DIR, or None when caching is disabled."""
+    global _store
+    if not CACHE_ENABLED:
+        return None
+    if _store is None:
+        _store = IntermediateStore()
+    return _store
+
+
+def cached(stage, input_path, compute, store=None, **params):
+    """
+    Return compute() (a dict of arrays) for `stage` on `input_path`, served from
+    the cache when the same content was processed with the same parameters.
+    """
+    store = store or default_store()
+    if store is None:
+        return compute()
+    key = cache_key(stage, file_digest(input_path), **params)
+    return store.get_or_compute(key, compute)
+
+
+def load_resampled(path, target_shape, order=3):
+    """
+    Load a NIfTI volume, pad it to the target aspect ratio and resample it
+    (cubic by default) together with its `data > 0` mask.
+    Returns (float32 volume, bool mask, affine, header).
+    """
+    import nibabel as nib
+    from msrcr import pad_and_resample
+
+    img = nib.load(path)
+    target_shape = tuple(int(s) for s in target_shape)
+
+    def compute():
+        data = img.get_fdata(dtype=np.float32)
+        vol, mask = pad_and_resample(data, data > 0, target_shape, order=order)
+        return {"volume": vol.astype(np.float32, copy=False), "mask": mask}
+
+    arrays = cached("pad_resample", path, compute, target_shape=target_shape, order=order, mask="gt0")
+    return arrays["volume"], arrays["mask"], img.affine, img.header
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or trim the intermediate cache.")
+    parser.add_argument("command", choices=["status", "evict", "clear"])
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--max-gb", type=float, default=CACHE_MAX_GB)
+    args = parser.parse_args()
+
+    store = IntermediateStore(args.cache_dir, args.max_gb)
+    if args.command == "evict":
+        print(f"Evicted {store.evict()} entries.")
+    elif args.command == "clear":
+        shutil.rmtree(args.cache_dir, ignore_errors=True)
+        print(f"Removed {args.cache_dir}.")
+    if args.command != "clear":
+        print(f"{args.cache_dir}: {store.size_bytes() / 1024 ** 3:.2f} GB of {args.max_gb:.1f} GB")
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Dense label indices for SynthSeg / TurboPrep segmentations.
+#
+# SynthSeg label IDs go up to the 2000-range cortical parcels, so segm.nii.gz
+# ends up int16/int32 and every consumer decodes it as float64 via get_fdata.
+# This module builds one dataset-wide table of the label IDs that actually
+# occur (background 0 always maps to index 0), remaps each segmentation to a
+# dense uint8 index volume (uint16 if there are more than 256 labels) with a
+# single vectorized LUT lookup, and writes a `<name>.labels.json` sidecar next
+# to every remapped file so it stays self-describing. The same table is used
+# for all subjects, so an index means the same structure everywhere.
+#
+#   python label_table.py build  --input-dir reg_0000_process --table label_table.json
+#   python label_table.py encode --input-dir reg_0000_process --output-dir reg_0000_idx --table label_table.json
+#
+# Consumers load the compact volume with `load_index` and map back with
+# `to_label_ids` / `index_of` when they need the original IDs.
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+from tqdm import tqdm
+
+# --- Configuration ---
+TABLE_FILE = "label_table.json"
+SIDECAR_SUFFIX = ".labels.json"
+# --- End Configuration ---
+
+
+def raw_labels(path):
+    """Label volume in its stored integer dtype (no float64 decode)."""
+    img = nib.load(path)
+    data = np.asanyarray(img.dataobj)
+    if data.dtype.kind == "f":
+        data = np.rint(data).astype(np.int32)
+    return img, data
+
+
+def label_set(path):
+    """Sorted label IDs present in one segmentation."""
+    _, data = raw_labels(path)
+    lo = int(data.min())
+    if lo >= 0:
+        counts = np.bincount(data.ravel())
+        return np.flatnonzero(counts).tolist()
+    return np.unique(data).tolist()
+
+
+def build_table(paths, workers=None):
+    """Union of the label sets of `paths`, scanned in parallel; 0 is always index 0."""
+    labels = {0}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(label_set, p): p for p in paths}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Scanning labels"):
+            labels.update(fut.result())
+    return sorted(labels, key=lambda v: (v != 0, v))
+
+
+def save_table(path, table):
+    with open(path, "w") as f:
+        json.dump({"labels": [int(v) for v in table]}, f)
+
+
+def load_table(path):
+    with open(path) as f:
+        return json.load(f)["labels"]
+
+
+def index_dtype(table):
+    return np.uint8 if len(table) <= 256 else np.uint16
+
+
+def make_lut(table):
+    """(lut, offset): lut[label - offset] is the dense index, -1 for unknown labels."""
+    table = np.asarray(table, dtype=np.int64)
+    offset = min(int(table.min()), 0)
+    lut = np.full(int(table.max()) - offset + 1, -1, dtype=np.int32)
+    lut[table - offset] = np.arange(table.size, dtype=np.int32)
+    return lut, offset
+
+
+def to_index(labels, table, lut=None):
+    """Label-ID volume -> dense index volume (uint8/uint16)."""
+    lut, offset = lut if lut is not None else make_lut(table)
+    flat = labels.ravel()
+    lo, hi = int(flat.min()), int(flat.max())
+    if lo < offset or hi - offset >= lut.size:
+        raise ValueError(f"Labels outside the table range: [{lo}, {hi}]")
+    idx = lut[flat - offset] if offset else lut[flat]
+    if idx.min() < 0:
+        missing = np.unique(flat[idx < 0])
+        raise ValueError(f"Labels not in table: {missing.tolist()[:10]}")
+    return idx.astype(index_dtype(table)).reshape(labels.shape)
+
+
+def to_label_ids(index, table):
+    """Dense index volume -> original label IDs."""
+    table = np.asarray(table)
+    return table.astype(np.min_scalar_type(table.max()) if table.min() >= 0 else np.int32)[index]
+
+
+def index_of(table, label_id):
+    return list(table).index(label_id)
+
+
+def sidecar_path(path):
+    base = path[:-len(".nii.gz")] if path.endswith(".nii.gz") else os.path.splitext(path)[0]
+    return base + SIDECAR_SUFFIX
+
+
+def encode_file(src, dst, table):
+    """Write the dense index volume of `src` to `dst` plus its sidecar table."""
+    img, labels = raw_labels(src)
+    index = to_index(labels, table)
+    out = nib.Nifti1Image(index, img.affine, img.header)
+    out.set_data_dtype(index.dtype)
+    out.header.set_slope_inter(1.0, 0.0)
+    nib.save(out, dst)
+    with open(sidecar_path(dst), "w") as f:
+        json.dump({"labels": [int(v) for v in table], "source": os.path.abspath(src)}, f)
+    return os.path.getsize(src), os.path.getsize(dst)
+
+
+def load_index(path):
+    """(index volume in its compact dtype, table, image) for a remapped file."""
+    img = nib.load(path)
+    with open(sidecar_path(path)) as f:
+        table = json.load(f)["labels"]
+    return np.asanyarray(img.dataobj), table, img
+
+
+def load_label_ids(path):
+    """Original label IDs of a remapped file."""
+    index, table, _ = load_index(path)
+    return to_label_ids(index, table)
+
+
+def encode_batch(pairs, table, workers=None):
+    """Encode (src, dst) pairs across a process pool; returns (bytes before, bytes after, failures)."""
+    before = after = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(encode_file, s, d, table): s for s, d in pairs}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Remapping labels"):
+            try:
+                b, a = fut.result()
+                before += b
+                after += a
+            except Exception as e:
+                failed.append(futures[fut])
+                print(f"Error remapping {futures[fut]}: {e}")
+    return before, after, failed
+
+
+def list_inputs(input_dir=None, outputs=None, name="segm.nii.gz"):
+    """Segmentations from a directory of .nii.gz files, or `name` inside each listed output dir."""
+    if input_dir:
+        return [os.path.join(input_dir, f) for f in sorted(os.listdir(input_dir))
+                if f.endswith(".nii.gz") and not f.endswith("_idx.nii.gz")]
+    with open(outputs) as f:
+        dirs = [line.strip() for line in f if line.strip()]
+    return [p for p in (os.path.join(d, name) for d in dirs) if os.path.isfile(p)]
+
+
+def encode_pairs(paths, output_dir=None, by_folder=False):
+    """
+    (source, destination) pairs for `encode_batch`: `*_idx.nii.gz` next to
+    each input, or one file per input in output_dir. With by_folder (inputs
+    from --outputs, all named segm.nii.gz) the files are named after their
+    folder, `<folder>_segm.nii.gz`, or the work-queue job id if folders repeat.
+    """
+    if not output_dir:
+        return [(p, p[:-len(".nii.gz")] + "_idx.nii.gz") for p in paths]
+    os.makedirs(output_dir, exist_ok=True)
+    names = [os.path.basename(p) for p in paths]
+    if by_folder or len(set(names)) < len(names):
+        from work_queue import job_id_for
+
+        folders = [os.path.basename(os.path.dirname(os.path.abspath(p))) for p in paths]
+        if len(set(folders)) < len(folders):
+            folders = [job_id_for(os.path.abspath(p)) for p in paths]
+        names = [f"{d}_{n}" for d, n in zip(folders, names)]
+    return [(p, os.path.join(output_dir, n)) for p, n in zip(paths, names)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dense uint8 label indices with a sidecar lookup table.")
+    parser.add_argument("command", choices=["build", "encode"])
+    parser.add_argument("--input-dir", help="Directory of segmentation .nii.gz files")
+    parser.add_argument("--outputs", help="List of output directories containing --name")
+    parser.add_argument("--name", default="segm.nii.gz")
+    parser.add_argument("--output-dir", help="Where encoded files go (default: next to the input as *_idx.nii.gz)")
+    parser.add_argument("--table", default=TABLE_FILE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if not args.input_dir and not args.outputs:
+        parser.error("one of --input-dir or --outputs is required")
+
+    paths = list_inputs(args.input_dir, args.outputs, args.name)
+    if args.command == "build" or not os.path.isfile(args.table):
+        table = build_table(paths, args.workers)
+        save_table(args.table, table)
+        print(f"{len(table)} labels -> {args.table} (index dtype {np.dtype(index_dtype(table)).name})")
+    else:
+        table = load_table(args.table)
+
+    if args.command == "encode":
+        pairs = encode_pairs(paths, args.output_dir, by_folder=not args.input_dir)
+        before, after, failed = encode_batch(pairs, table, args.workers)
+        print(f"Remapped {len(pairs) - len(failed)} files: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB, "
+              f"{len(failed)} failed.")
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Subject-grouped (longitudinal) processing with a per-subject reference.
+#
+# Image UIDs such as `Patient-024_week-018_reg` (in the file or folder names)
+# carry the patient ID, and most patients have many visits. Instead of treating every visit independently,
+# jobs are grouped by patient and each group runs on one worker, earliest visit
+# first. The baseline visit is processed in full and leaves a reference:
+#   * its registration parameters - follow-ups start from them (shifted by the
+#     change in head position) and skip the coarsest pyramid level and the
+#     rigid pre-stage (affine_reg.register_params);
+#   * its 3D brain mask in template space (brain_mask.py) - reused as the mask
+#     of every follow-up;
+#   * its white-stripe voxels in template space - follow-ups are normalized by
+#     the mean/std of the same voxels, so no per-visit percentiles are needed
+#     and the normalization follows the same tissue over time.
+# The reference is also saved to REFERENCE_DIR/<patient>.npz, so a resumed run
+# (or a new visit of a known patient) reuses it. Outputs per visit, as from
+# TurboPrep: affine_transf.mat, mask.nii.gz, normalized.nii.gz (white-striped
+# inside the mask, 0 outside)
+#
+#   python longitudinal.py --inputs input_files.txt --outputs output_paths.txt --workers 8
+
+import os
+import re
+import time
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+
+import qc_metrics
+from affine_reg import (METRIC, TRANSFORM_NAME, _AFFINE, _RIGID, _init_worker, load_template, params_to_matrix,
+                        register_params)
+from brain_mask import compute_mask
+from propagate import write_affine_transf, resample_to_template, read_paths_from_file
+from work_queue import job_id_for
+
+# --- Configuration ---
+INPUT_FILE_LIST = "./input_files.txt"
+OUTPUT_DIR_LIST = "./output_paths.txt"
+TEMPLATE_FILE = "MNI152_T1_1mm_brain.nii.gz"
+REFERENCE_DIR = "longitudinal_refs"
+SUBJECT_PATTERN = r"(Patient-\d+)"   # patient ID anywhere in the input path
+VISIT_PATTERN = r"week-(\d+)"        # visit order; the smallest is the baseline
+FOLLOWUP_FIRST_LEVEL = 1             # follow-ups skip the coarsest registration level
+REUSE_MASK = True                    # False: recompute the mask for every visit
+STRIPE_PCT = (70, 90)
+MASK_NAME = "mask.nii.gz"
+NORMALIZED_NAME = "normalized.nii.gz"
+# --- End Configuration ---
+
+_OUTPUTS = (TRANSFORM_NAME, MASK_NAME, NORMALIZED_NAME)
+
+
+def parse_uid(path):
+    """
+    (subject, visit) from the input path, so IDs in folder names count too (the
+    last match wins). Inputs without a patient ID become their own group, keyed
+    by their unique path - generic names like <visit>/T1.nii.gz never merge.
+    """
+    subjects = re.findall(SUBJECT_PATTERN, path)
+    visits = re.findall(VISIT_PATTERN, path)
+    return (subjects[-1] if subjects else job_id_for(os.path.abspath(path)),
+            int(visits[-1]) if visits else 0)
+
+
+def group_by_subject(inputs, outputs):
+    """{subject: [(visit, input, output), ...]} sorted by visit, largest groups first."""
+    groups = defaultdict(list)
+    for input_path, output_dir in zip(inputs, outputs):
+        subject, visit = parse_uid(input_path)
+        groups[subject].append((visit, input_path, output_dir))
+    for visits in groups.values():
+        visits.sort()
+    return dict(sorted(groups.items(), key=lambda kv: -len(kv[1])))
+
+
+def reference_path(ref_dir, subject):
+    return os.path.join(ref_dir, f"{subject}.npz")
+
+
+def save_reference(path, ref):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}.npz"
+    np.savez_compressed(tmp, params=ref["registration"]["params"],
+                        moving_com=ref["registration"]["moving_com"],
+                        mask=ref["mask"], stripe=ref["stripe"], baseline=ref["baseline"])
+    os.replace(tmp, path)
+
+
+def load_reference(path):
+    with np.load(path) as f:
+        return {"registration": {"params": f["params"], "moving_com": f["moving_com"]},
+                "mask": f["mask"], "stripe": f["stripe"], "baseline": str(f["baseline"])}
+
+
+def process_visit(input_path, output_dir, template_path=TEMPLATE_FILE, ref=None, dof=_AFFINE, metric=METRIC):
+    """
+    Register, mask and white-stripe one visit. Without `ref` this is the
+    baseline and a new reference is returned; otherwise `ref` is reused.
+    Returns (reference, info).
+    """
+    start = time.time()
+    moving = nib.load(input_path)
+    data = moving.get_fdata(dtype=np.float32)
+    reg = register_params(data, moving.affine, template_path, dof=dof, metric=metric,
+                          init=ref["registration"] if ref else None,
+                          first_level=FOLLOWUP_FIRST_LEVEL if ref else 0)
+    fixed_to_moving = params_to_matrix(reg["params"], reg["center"])
+    template_img, _ = load_template(template_path)
+    registered = resample_to_template(moving, fixed_to_moving, template_img, order=3).astype(np.float32)
+
+    if ref is None or not REUSE_MASK:
+        mask, _ = compute_mask(registered)
+    else:
+        mask = ref["mask"]
+    if ref is None:
+        lo, hi = np.percentile(registered[mask], STRIPE_PCT)
+        stripe = mask & (registered >= lo) & (registered <= hi)
+        ref = {"registration": reg, "mask": mask, "stripe": stripe, "baseline": input_path}
+    stripe_vals = registered[ref["stripe"]]
+    mean_ws, std_ws = float(stripe_vals.mean()), float(stripe_vals.std())
+    std_ws = std_ws if std_ws > 0 else 1.0
+    normalized = np.where(mask, (registered - mean_ws) / std_ws, 0).astype(np.float32)
+
+    os.makedirs(output_dir, exist_ok=True)
+    write_affine_transf(os.path.join(output_dir, TRANSFORM_NAME), fixed_to_moving)
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), template_img.affine), os.path.join(output_dir, MASK_NAME))
+    normalized_path = os.path.join(output_dir, NORMALIZED_NAME)
+    nib.save(nib.Nifti1Image(normalized, template_img.affine), normalized_path)
+    qc_metrics.record(normalized_path, "longitudinal", normalized, mask, stripe=(mean_ws, std_ws))
+    return ref, {"metric": reg["metric"], "seconds": time.time() - start,
+                 "baseline": ref["baseline"] == input_path}
+
+
+def process_subject(subject, visits, template_path=TEMPLATE_FILE, ref_dir=REFERENCE_DIR, overwrite=False,
+                    dof=_AFFINE, metric=METRIC):
+    """
+    Run all visits of one subject in order on this worker, computing the
+    reference on the first visit that has none. Returns [(input, info | error str)].
+    """
+    ref_file = reference_path(ref_dir, subject)
+    ref = load_reference(ref_file) if os.path.exists(ref_file) and not overwrite else None
+    results = []
+    for _, input_path, output_dir in visits:
+        done = all(os.path.exists(os.path.join(output_dir, n)) for n in _OUTPUTS)
+        if done and ref is not None and not overwrite:
+            results.append((input_path, None))
+            continue
+        try:
+            new_ref, info = process_visit(input_path, output_dir, template_path, ref, dof, metric)
+        except Exception as e:
+            results.append((input_path, f"{type(e).__name__}: {e}"))
+            continue
+        if ref is None:
+            save_reference(ref_file, new_ref)
+        ref = new_ref
+        results.append((input_path, info))
+    return results
+
+
+def run_longitudinal(input_list=INPUT_FILE_LIST, output_list=OUTPUT_DIR_LIST, template_path=TEMPLATE_FILE,
+                     workers=None, ref_dir=REFERENCE_DIR, overwrite=False, dof=_AFFINE, metric=METRIC):
+    """Process every visit of the list files, one subject group per worker task."""
+    inputs = read_paths_from_file(input_list)
+    outputs = read_paths_from_file(output_list)
+    if len(inputs) != len(outputs):
+        raise SystemExit(f"Error: Mismatch in number of lines between {input_list} and {output_list}.")
+    groups = group_by_subject(inputs, outputs)
+    print(f"{len(inputs)} visits in {len(groups)} subjects "
+          f"({sum(len(v) > 1 for v in groups.values())} with follow-ups).")
+
+    done = skipped = failed = 0
+    seconds = {True: [], False: []}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(template_path,)) as pool:
+        futures = {pool.submit(process_subject, subject, visits, template_path, ref_dir, overwrite,
+                               dof, metric): subject
+                   for subject, visits in groups.items()}
+        for fut in as_completed(futures):
+            subject = futures[fut]
+            try:
+                results = fut.result()
+            except Exception as e:
+                failed += len(groups[subject])
+                print(f"Error processing {subject}: {e}")
+                continue
+            for input_path, info in results:
+                name = os.path.basename(input_path)
+                if info is None:
+                    skipped += 1
+                elif isinstance(info, str):
+                    failed += 1
+                    print(f"Error processing {input_path}: {info}")
+                else:
+                    done += 1
+                    seconds[info["baseline"]].append(info["seconds"])
+                    role = "baseline" if info["baseline"] else "follow-up"
+                    print(f"{name} ({role}): metric {info['metric']:.4f} in {info['seconds']:.1f}s")
+    for is_baseline, times in seconds.items():
+        if times:
+            print(f"Mean {'baseline' if is_baseline else 'follow-up'} time: {np.mean(times):.1f}s")
+    print(f"Longitudinal processing finished: {done} done, {skipped} skipped, {failed} failed.")
+    return done, skipped, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Subject-grouped registration, masking and white-stripe.")
+    parser.add_argument("--inputs", default=INPUT_FILE_LIST)
+    parser.add_argument("--outputs", default=OUTPUT_DIR_LIST)
+    parser.add_argument("--template", default=TEMPLATE_FILE)
+    parser.add_argument("--reference-dir", default=REFERENCE_DIR)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--dof", type=int, choices=[_RIGID, _AFFINE], default=_AFFINE)
+    parser.add_argument("--metric", choices=["mi", "ncc"], default=METRIC)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    run_longitudinal(args.inputs, args.outputs, args.template, args.workers, args.reference_dir, args.overwrite,
+                     args.dof, args.metric)
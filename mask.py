@@ -3,6 +3,9 @@ import numpy as np
 from scipy.ndimage import label
 import os
 
+import qc_metrics
+from brain_mask import default_output, mask_file
+
 def get_largest_connected_component(binary_img):
     labeled_array, num_features = label(binary_img)
     if num_features == 0:
@@ -15,7 +18,14 @@ def get_largest_connected_component(binary_img):
     largest_component = labeled_array == largest_label
     return largest_component.astype(np.uint8)
 
-def extract_brain_mask(input_path, output_path=None, threshold=0.1):
+def extract_brain_mask(input_path, output_path=None, threshold=0.1, method="threshold"):
+    # 'otsu3d': volumetric Otsu + coarse-grid closing / hole filling (brain_mask.py)
+    if method == "otsu3d":
+        output_path = output_path or default_output(input_path)
+        mask_file(input_path, output_path)
+        print(f"3D Otsu brain mask saved to: {output_path}")
+        return
+
     # Load the NIfTI image
     img = nib.load(input_path)
     data = img.get_fdata()
@@ -32,6 +42,8 @@ def extract_brain_mask(input_path, output_path=None, threshold=0.1):
     if not output_path:
         output_path = os.path.splitext(os.path.splitext(input_path)[0])[0] + '_brain_mask.nii.gz'
     nib.save(brain_mask_img, output_path)
+    qc_metrics.record(output_path, "mask", data, brain_mask, source=input_path,
+                      voxel_ml=qc_metrics.voxel_volume_ml(img.header))
     print(f"Largest brain mask saved to: {output_path}")
 
 # Example usage
@@ -42,6 +54,8 @@ if __name__ == "__main__":
     parser.add_argument("--input_file", help="Path to input .nii.gz file")
     parser.add_argument("--output", help="Path to save output mask file")
     parser.add_argument("--threshold", type=float, default=0.1, help="Threshold for binarization")
+    parser.add_argument("--method", choices=["threshold", "otsu3d"], default="threshold",
+                        help="Min-max threshold + largest component, or 3D Otsu engine")
 
     args = parser.parse_args()
-    extract_brain_mask(args.input_file, args.output, args.threshold)
+    extract_brain_mask(args.input_file, args.output, args.threshold, args.method)
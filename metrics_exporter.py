@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# Live Prometheus metrics for the long-running batch drivers.
+#
+# script.py, script_gpu.py and segment.py hand a MetricsExporter to the
+# ResourceScheduler, which counts every attempt and samples its own state:
+#   pipeline_jobs_pending / pipeline_jobs_running      queue depth, jobs in flight
+#   pipeline_jobs_total{tool,outcome}                  success / failure / retry / timeout
+#   pipeline_job_seconds{tool}                         per-stage latency histogram
+#   pipeline_job_rss_bytes{tool,job}                   RSS of each running job's process tree
+#   pipeline_process_rss_bytes                         RSS of the driver itself
+#   pipeline_memory_reserved_bytes, pipeline_threads_reserved, pipeline_eta_seconds
+#   pipeline_last_completion_timestamp_seconds         for stall alerts
+# Queue workers add pipeline_queue_jobs{state} from the shared queue.
+#
+# The metrics are written to a text-format file that is rewritten atomically
+# every INTERVAL_S (point node_exporter's textfile collector at its directory,
+# or just `cat` it), and/or served at http://127.0.0.1:<port>/metrics. Each
+# driver has its own default file (turboprep_metrics.prom,
+# turboprep_gpu_metrics.prom, synthseg_metrics.prom) so drivers started from
+# the same directory don't overwrite each other. Only the standard library is
+# used, and nothing is computed between scrapes beyond the counters the
+# scheduler bumps as results arrive:
+#   python metrics_exporter.py --file turboprep_metrics.prom   # print a snapshot
+
+import os
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Configuration ---
+INTERVAL_S = 15
+PREFIX = "pipeline_"
+# Stage latencies range from seconds (mask, resample) to hours (TurboPrep on CPU)
+LATENCY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+# --- End Configuration ---
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Context manager observing the wall time of its block."""
+        return _Timer(self, labels)
+
+    def _samples(self, key, value):
+        counts, total = value
+        lines = [f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _number(u))])} {c}"
+                 for u, c in zip(self.buckets, counts)]
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def process_rss_bytes(pid=None):
+    """VmRSS of one process from /proc (0 if unavailable)."""
+    try:
+        with open(f"/proc/{pid or os.getpid()}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class MetricsExporter:
+    """
+    Registry of metrics plus the outputs that publish them: a text file
+    rewritten every `interval` seconds and/or a localhost HTTP endpoint.
+    Collectors (callables) run right before each render to refresh gauges
+    from live state, e.g. the scheduler's queue.
+    """
+
+    def __init__(self, path=None, port=None, interval=INTERVAL_S, host="127.0.0.1"):
+        self.path = path
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+        self.started = time.time()
+        self.gauge("process_rss_bytes", "Resident memory of the driver process")
+        self.gauge("exporter_start_timestamp_seconds", "When this exporter started").set(self.started)
+
+    # --- Registry ---
+    def _register(self, cls, name, help_text, labelnames, **kwargs):
+        name = PREFIX + name
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already registered with a different type or labels")
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def add_collector(self, func):
+        self._collectors.append(func)
+
+    # --- Output ---
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        self._metrics[PREFIX + "process_rss_bytes"].set(process_rss_bytes())
+        for collect in list(self._collectors):
+            try:
+                collect()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+        with self._lock:
+            metrics = [self._metrics[k] for k in sorted(self._metrics)]
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+    def write(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Could not write metrics to {self.path}: {e}")
+
+    def _serve(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def start(self):
+        """Start the file writer and/or HTTP server; returns self."""
+        if self.port is not None and self._server is None:
+            self._serve()
+        if self.path and self._thread is None:
+            self.write()
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Write a final snapshot and shut the outputs down."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.path:
+            self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def describe(self):
+        targets = ([self.path] if self.path else []) + ([f"http://{self.host}:{self.port}/metrics"]
+                                                        if self.port is not None else [])
+        return ", ".join(targets) or "disabled"
+
+
+def exporter_from_config(path=None, port=None, interval=INTERVAL_S):
+    """A started exporter, or None when neither a file nor a port is configured."""
+    if not path and port is None:
+        return None
+    return MetricsExporter(path, port, interval).start()
+
+
+def track_queue(exporter, work_queue):
+    """Export the shared work queue's per-state counts (work_queue.py) with every render."""
+    gauge = exporter.gauge("queue_jobs", "Jobs in the shared work queue by state", ("state",))
+
+    def collect():
+        for state, count in work_queue.status().items():
+            gauge.set(count, state=state)
+
+    exporter.add_collector(collect)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show a running batch's Prometheus metrics snapshot.")
+    parser.add_argument("--file", default="turboprep_metrics.prom")
+    parser.add_argument("--match", help="Only lines containing this text")
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        lines = [line.rstrip("\n") for line in f if not line.startswith("#")]
+    age = time.time() - os.path.getmtime(args.file)
+    for line in lines:
+        if not args.match or args.match in line:
+            print(line)
+    print(f"({args.file} last written {age:.0f}s ago)")
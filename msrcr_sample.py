@@ -3,10 +3,14 @@
 
 import os
 import numpy as np
-import nibabel as nib
-from scipy.ndimage import zoom, gaussian_filter
+from scipy.ndimage import gaussian_filter
 from skimage import filters
 
+from bias_field import correct_bias
+from encoding import describe, save_output
+from intermediate_cache import load_resampled
+import qc_metrics
+
 # Multi-Scale Retinex with Color Restoration for grayscale images
 def msrcr_gray(img, sigma_list=(15, 80, 250), gain=1.0, offset=0.0):
     """
@@ -17,8 +21,9 @@ def msrcr_gray(img, sigma_list=(15, 80, 250), gain=1.0, offset=0.0):
       - offset: constant offset added
     Returns a float32 image of same shape.
     """
-    # Avoid log of zero
-    img_safe = img.astype(np.float32) + 1.0
+    # Avoid log of zero; cubic-resampling undershoot (< -1) is treated as 0,
+    # otherwise its NaN log spreads through the sharpening and white-stripe
+    img_safe = np.maximum(img.astype(np.float32) + 1.0, 1.0)
     log_img = np.log(img_safe)
     retinex = np.zeros_like(img_safe)
     for sigma in sigma_list:
@@ -31,7 +36,7 @@ def msrcr_gray(img, sigma_list=(15, 80, 250), gain=1.0, offset=0.0):
     return msr.astype(np.float32)
 
 # Optional: robust white-stripe normalization (Shinohara et al. 2014)
-def white_stripe_normalize(volume, lower_pct=70, upper_pct=90, mask=None):
+def white_stripe_normalize(volume, lower_pct=70, upper_pct=90, mask=None, return_stats=False):
     data = volume
     if mask is not None:
         vals = data[mask > 0]
@@ -41,6 +46,8 @@ def white_stripe_normalize(volume, lower_pct=70, upper_pct=90, mask=None):
     stripe_vals = vals[(vals >= lo) & (vals <= hi)]
     mean_ws = stripe_vals.mean()
     std_ws = stripe_vals.std() if stripe_vals.std() > 0 else 1.0
+    if return_stats:
+        return (data - mean_ws) / std_ws, (mean_ws, std_ws)
     return (data - mean_ws) / std_ws
 
 # Parameters
@@ -60,65 +67,69 @@ offset = 0.0
 sharpen_radius = 1       # Unsharp mask radius
 sharpen_amount = 1.0     # Unsharp mask amount
 
-# Create output directory if it doesn't exist
-os.makedirs(output_dir, exist_ok=True)
-
-for filename in os.listdir(input_dir):
-    if not filename.endswith('.nii.gz'):
-        continue
-
-    # Load image and data
-    filepath = os.path.join(input_dir, filename)
-    img = nib.load(filepath)
-    data = img.get_fdata().astype(np.float32)
-
-    # Brain mask: nonzero voxels
-    brain_mask = (data > 0)
-
-    # Compute padding to reach target ratio
-    current_shape = np.array(data.shape)
-    scales = current_shape / target_ratio
-    scale = np.max(scales)
-    padded_shape = np.ceil(scale * target_ratio).astype(int)
-    total_pad = padded_shape - current_shape
-    pad_before = (total_pad // 2).astype(int)
-    pad_after = (total_pad - pad_before).astype(int)
-    pad_widths = list(zip(pad_before, pad_after))
-    padded_data = np.pad(data, pad_widths, mode='constant', constant_values=0)
-    padded_mask = np.pad(brain_mask, pad_widths, mode='constant', constant_values=0)
-
-    # Resample to target shape (cubic interpolation for intensity)
-    zoom_factors = target_shape / padded_data.shape
-    resampled_data = zoom(padded_data, zoom_factors, order=3)
-    resampled_mask = zoom(padded_mask.astype(np.float32), zoom_factors, order=0) > 0.5
-
-    # Apply Multi-Scale Retinex (MSRCR) slice-by-slice
-    msr_data = np.zeros_like(resampled_data)
-    for z in range(resampled_data.shape[2]):
-        slice_img = resampled_data[:, :, z]
-        msr_slice = msrcr_gray(slice_img, sigma_list=sigma_list, gain=gain, offset=offset)
-        msr_data[:, :, z] = msr_slice
-
-    # Apply unsharp masking (sharpening) slice-by-slice
-    sharpened_data = np.zeros_like(msr_data)
-    for z in range(msr_data.shape[2]):
-        slice_img = msr_data[:, :, z]
-        sharp_slice = filters.unsharp_mask(
-            slice_img,
-            radius=sharpen_radius,
-            amount=sharpen_amount,
-            preserve_range=True
-        )
-        sharpened_data[:, :, z] = sharp_slice
-
-    # Normalize with WhiteStripe on sharpened output
-    data_norm = white_stripe_normalize(sharpened_data, lower_pct=70, upper_pct=90, mask=resampled_mask)
-
-    # Save output
-    out_img = nib.Nifti1Image(
-        data_norm.astype(np.float32), affine=img.affine, header=img.header)
-    nib.save(out_img, os.path.join(output_dir, filename))
-
-    print(f"Processed {filename}: padded & resampled, MSRCR + sharpening, then WhiteStripe normalization.")
-
-print("All files processed with cubic resampling, MSRCR, unsharp masking, and WhiteStripe normalization.")
+# Remove a volumetric (N4-style) bias field before MSRCR / white-stripe (bias_field.py)
+bias_correct = False
+
+# Output encoding: None keeps float32; 'auto', 'int16' or 'uint8' store scaled
+# integers within max_rel_error of the value range (see encoding.py)
+output_encoding = None
+max_rel_error = 1e-3
+
+
+def process_dir(input_dir=input_dir, output_dir=output_dir, target_shape=target_shape,
+                sigma_list=sigma_list, gain=gain, offset=offset,
+                sharpen_radius=sharpen_radius, sharpen_amount=sharpen_amount,
+                output_encoding=output_encoding, max_rel_error=max_rel_error, bias_correct=bias_correct):
+    """MSRCR + unsharp masking, then white-stripe, for every volume in input_dir."""
+    # Create output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+
+    for filename in os.listdir(input_dir):
+        if not filename.endswith('.nii.gz'):
+            continue
+
+        # Pad to the target ratio and resample (cubic for intensity, nearest for
+        # the nonzero-voxel brain mask); served from the intermediate cache when
+        # another stage already resampled this input
+        filepath = os.path.join(input_dir, filename)
+        resampled_data, resampled_mask, affine, header = load_resampled(filepath, target_shape)
+        if bias_correct:
+            resampled_data, _ = correct_bias(resampled_data, resampled_mask)
+
+        # Apply Multi-Scale Retinex (MSRCR) slice-by-slice
+        msr_data = np.zeros_like(resampled_data)
+        for z in range(resampled_data.shape[2]):
+            slice_img = resampled_data[:, :, z]
+            msr_slice = msrcr_gray(slice_img, sigma_list=sigma_list, gain=gain, offset=offset)
+            msr_data[:, :, z] = msr_slice
+
+        # Apply unsharp masking (sharpening) slice-by-slice
+        sharpened_data = np.zeros_like(msr_data)
+        for z in range(msr_data.shape[2]):
+            slice_img = msr_data[:, :, z]
+            sharp_slice = filters.unsharp_mask(
+                slice_img,
+                radius=sharpen_radius,
+                amount=sharpen_amount,
+                preserve_range=True
+            )
+            sharpened_data[:, :, z] = sharp_slice
+
+        # Normalize with WhiteStripe on sharpened output
+        data_norm, stripe = white_stripe_normalize(sharpened_data, lower_pct=70, upper_pct=90,
+                                                   mask=resampled_mask, return_stats=True)
+
+        # Save output, with QC metrics from the arrays already in memory
+        out_path = os.path.join(output_dir, filename)
+        report = save_output(data_norm, affine, out_path, header,
+                             encoding=output_encoding, max_rel_error=max_rel_error)
+        qc_metrics.record(out_path, "msrcr_unsharp", data_norm, resampled_mask, source=filepath, stripe=stripe)
+
+        encoded = f" Stored as {describe(report)}." if report else ""
+        print(f"Processed {filename}: padded & resampled, MSRCR + sharpening, then WhiteStripe normalization.{encoded}")
+
+    print("All files processed with cubic resampling, MSRCR, unsharp masking, and WhiteStripe normalization.")
+
+
+if __name__ == '__main__':
+    process_dir()
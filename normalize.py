@@ -1,9 +1,12 @@
 import os
 import numpy as np
 import nibabel as nib
-import cv2
 from scipy.ndimage import zoom
 
+from intermediate_cache import load_resampled
+import slice_kernels as sk
+import qc_metrics
+
 # Optional: robust white-stripe normalization (if desired)
 def white_stripe_normalize(volume, lower_pct=70, upper_pct=90, mask=None):
     data = volume
@@ -23,7 +26,7 @@ def load_nii_image(file_path):
     return nii.get_fdata(), nii.affine, nii.header
 
 
-def pad_and_resample(volume, mask, target_shape):
+def pad_and_resample(volume, mask, target_shape, order=3):
     # Compute padding for target ratio
     current = np.array(volume.shape)
     target = np.array(target_shape)
@@ -41,46 +44,37 @@ def pad_and_resample(volume, mask, target_shape):
 
     # Compute zoom factors to reach target_shape
     zooms = target / padded_vol.shape
-    resampled_vol = zoom(padded_vol, zooms, order=3)
+    resampled_vol = zoom(padded_vol, zooms, order=order)
     resampled_mask = zoom(padded_mask.astype(np.float32), zooms, order=0) > 0.5
 
     return resampled_vol, resampled_mask
 
 
-def get_brain_mask(slice_2d):
+# Slice operations write into `out` (allocated when None) and take their
+# temporaries from a reusable arena, see slice_kernels.py
+def get_brain_mask(slice_2d, out=None, arena=None):
     # Otsu-based mask per slice
-    norm8 = cv2.normalize(slice_2d, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-    _, mask = cv2.threshold(norm8, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    kernel = np.ones((5, 5), np.uint8)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-    return mask.astype(bool)
+    return sk.brain_mask(slice_2d, out, arena)
 
 
-def apply_clahe(slice_2d, clip_limit=2.0, tile_grid_size=(8, 8)):
-    norm = cv2.normalize(slice_2d, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
-    return clahe.apply(norm)
+def apply_clahe(slice_2d, clip_limit=2.0, tile_grid_size=(8, 8), out=None, arena=None):
+    return sk.clahe(slice_2d, out, arena, clip_limit, tile_grid_size)
 
 
-def apply_msrcr(slice_2d, sigma_list=(15, 80, 250), gain=1.0, offset=0):
-    img = slice_2d.astype(np.float32) + 1.0
-    retinex = sum(
-        np.log10(img) - np.log10(cv2.GaussianBlur(img, (0, 0), sigma))
-        for sigma in sigma_list
-    )
-    retinex /= len(sigma_list)
-    result = gain * retinex + offset
-    return cv2.normalize(result, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+def apply_msrcr(slice_2d, sigma_list=(15, 80, 250), gain=1.0, offset=0, out=None, arena=None):
+    return sk.msrcr(slice_2d, out, arena, sigma_list, gain, offset)
 
 
-def process_slice(slice_2d, method):
+def process_slice(slice_2d, method, out=None, arena=None):
+    arena = arena or sk.worker_arena()
+    out = np.empty(slice_2d.shape, dtype=np.uint8) if out is None else out
     if method == "clahe":
-        return apply_clahe(slice_2d)
+        return apply_clahe(slice_2d, out=out, arena=arena)
     elif method == "msrcr":
-        return apply_msrcr(slice_2d)
+        return apply_msrcr(slice_2d, out=out, arena=arena)
     elif method == "clahe_msrcr":
-        clahe_img = apply_clahe(slice_2d)
-        return apply_msrcr(clahe_img)
+        clahe_img = apply_clahe(slice_2d, out=arena.like("clahe_img", out), arena=arena)
+        return apply_msrcr(clahe_img, out=out, arena=arena)
     else:
         raise ValueError(f"Invalid method: {method}")
 
@@ -92,25 +86,23 @@ def process_and_save(input_dir, output_dir, method, target_shape):
             continue
 
         path = os.path.join(input_dir, fname)
-        vol, affine, header = load_nii_image(path)
-        brain_mask_vol = (vol > 0)
 
-        # Pad & resample whole volume
-        vol_rs, mask_rs = pad_and_resample(vol, brain_mask_vol, target_shape)
+        # Pad & resample whole volume (shared with the other stages via the intermediate cache)
+        vol_rs, mask_rs, affine, header = load_resampled(path, target_shape)
 
-        # Prepare output array
+        # Prepare output array and the per-slice buffers (reused for every slice)
         out_vol = np.zeros_like(vol_rs, dtype=np.uint8)
+        arena = sk.worker_arena()
+        slice_shape = vol_rs.shape[:2]
+        masked_input = arena.get("masked_input", slice_shape, vol_rs.dtype)
+        enhanced = arena.get("enhanced", slice_shape, np.uint8)
 
         # Process slice-by-slice
         for z in range(vol_rs.shape[2]):
-            sl = vol_rs[:, :, z]
             m = mask_rs[:, :, z]
-            masked_input = np.zeros_like(sl)
-            masked_input[m] = sl[m]
-            enhanced = process_slice(masked_input, method)
-            masked_out = np.zeros_like(enhanced)
-            masked_out[m] = enhanced[m]
-            out_vol[:, :, z] = masked_out
+            sk.masked_copy(vol_rs[:, :, z], m, masked_input)
+            process_slice(masked_input, method, enhanced, arena)
+            np.copyto(out_vol[:, :, z], enhanced, where=m)
 
         # Optional: WhiteStripe normalization
         # out_vol_norm = white_stripe_normalize(out_vol, mask=mask_rs)
@@ -120,6 +112,7 @@ def process_and_save(input_dir, output_dir, method, target_shape):
         out_path = os.path.join(output_dir, out_fname)
 
         nib.save(nib.Nifti1Image(out_vol, affine, header), out_path)
+        qc_metrics.record(out_path, "clahe_then_msrcr" if method == "clahe_msrcr" else method, out_vol, mask_rs, source=path, clip_range=(0, 255))
         print(f"Saved: {out_path}")
 
 if __name__ == '__main__':
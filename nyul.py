@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# Dataset-wide Nyúl–Udupa histogram standardization.
+#
+# white_stripe_normalize (msrcr.py / normalize2.py) standardizes each volume on
+# its own; this stage maps every volume onto one intensity scale learned from
+# the whole dataset, in two passes:
+#
+#   learn   each worker loads one volume at a time and reduces it to a fixed
+#           vector of landmark percentiles inside the brain mask, so memory
+#           per worker stays at one volume no matter how many subjects there
+#           are. The landmarks are mapped linearly onto [S_MIN, S_MAX] and
+#           averaged into the standard scale, saved as JSON.
+#   apply   a vectorized piecewise-linear lookup from each volume's own
+#           landmarks to the standard ones (linear extrapolation past the ends).
+#
+# The saved landmarks are reused for new subjects without relearning:
+#   python nyul.py learn --outputs output_paths.txt --landmarks nyul_landmarks.json
+#   python nyul.py apply --outputs output_paths.txt --landmarks nyul_landmarks.json
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+from tqdm import tqdm
+
+# --- Configuration ---
+OUTPUT_DIR_LIST = "./output_paths.txt"
+IMAGE_NAME = "normalized.nii.gz"
+MASK_NAME = "mask.nii.gz"
+STANDARDIZED_NAME = "standardized.nii.gz"
+LANDMARKS_FILE = "nyul_landmarks.json"
+PERCENTILES = [1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 99]  # first/last bound the scale
+S_MIN, S_MAX = 0.0, 100.0
+# --- End Configuration ---
+
+
+def load_volume(output_dir, image_name=IMAGE_NAME, mask_name=MASK_NAME):
+    """Volume and foreground mask (mask.nii.gz if present, otherwise data > 0)."""
+    img = nib.load(os.path.join(output_dir, image_name))
+    data = img.get_fdata(dtype=np.float32)
+    mask_path = os.path.join(output_dir, mask_name)
+    if os.path.isfile(mask_path):
+        mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+    else:
+        mask = data > 0
+    return img, data, mask
+
+
+def volume_landmarks(data, mask, percentiles=PERCENTILES):
+    """Intensity landmarks of one volume inside its mask."""
+    vals = data[mask] if mask is not None and mask.any() else data.ravel()
+    return np.percentile(vals, percentiles)
+
+
+def _landmarks_for_dir(output_dir, image_name, mask_name, percentiles):
+    _, data, mask = load_volume(output_dir, image_name, mask_name)
+    return volume_landmarks(data, mask, percentiles)
+
+
+def learn_standard_scale(output_dirs, image_name=IMAGE_NAME, mask_name=MASK_NAME,
+                         percentiles=PERCENTILES, s_min=S_MIN, s_max=S_MAX, workers=None):
+    """
+    Learning pass. Each volume contributes one landmark vector; only those
+    (len(percentiles) floats each) are kept, never the volumes themselves.
+    """
+    mapped = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_landmarks_for_dir, d, image_name, mask_name, percentiles): d
+                   for d in output_dirs}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Learning landmarks"):
+            try:
+                lm = fut.result()
+            except Exception as e:
+                failed.append(futures[fut])
+                print(f"Error reading {futures[fut]}: {e}")
+                continue
+            if lm[-1] <= lm[0]:
+                continue  # flat volume, no usable histogram
+            # Map [p_low, p_high] linearly onto [s_min, s_max]
+            mapped.append(s_min + (lm - lm[0]) * (s_max - s_min) / (lm[-1] - lm[0]))
+
+    if not mapped:
+        raise ValueError("No usable volumes to learn landmarks from")
+    standard = np.mean(mapped, axis=0)
+    return {
+        "percentiles": list(percentiles),
+        "standard_scale": standard.tolist(),
+        "image_name": image_name,
+        "n_volumes": len(mapped),
+        "failed": failed,
+    }
+
+
+def save_landmarks(path, landmarks):
+    with open(path, "w") as f:
+        json.dump(landmarks, f, indent=2)
+
+
+def load_landmarks(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def piecewise_linear(values, src, dst):
+    """
+    Map `values` through the piecewise-linear function src -> dst, extending
+    the first and last segments linearly. `src` must be increasing.
+    """
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    # Collapse repeated landmarks (e.g. many voxels at one value) so slopes stay finite
+    keep = np.concatenate([[True], np.diff(src) > 0])
+    src, dst = src[keep], dst[keep]
+    if src.size < 2:
+        return np.full_like(values, dst[0], dtype=np.float32)
+    slope = np.diff(dst) / np.diff(src)
+    seg = np.clip(np.searchsorted(src, values, side="right") - 1, 0, src.size - 2)
+    return (dst[seg] + (values - src[seg]) * slope[seg]).astype(np.float32)
+
+
+def standardize(data, mask, landmarks):
+    """Apply pass for one volume; voxels outside the mask are set to 0."""
+    own = volume_landmarks(data, mask, landmarks["percentiles"])
+    out = np.zeros(data.shape, dtype=np.float32)
+    fg = mask if mask is not None else np.ones(data.shape, dtype=bool)
+    out[fg] = piecewise_linear(data[fg], own, landmarks["standard_scale"])
+    return out
+
+
+def standardize_dir(output_dir, landmarks, image_name=IMAGE_NAME, mask_name=MASK_NAME,
+                    out_name=STANDARDIZED_NAME, overwrite=False):
+    dst = os.path.join(output_dir, out_name)
+    if os.path.exists(dst) and not overwrite:
+        return None
+    img, data, mask = load_volume(output_dir, image_name, mask_name)
+    out = standardize(data, mask, landmarks)
+    nib.save(nib.Nifti1Image(out, img.affine, img.header), dst)
+    return dst
+
+
+def read_paths_from_file(filepath):
+    with open(filepath, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nyúl-Udupa histogram standardization across the dataset.")
+    parser.add_argument("command", choices=["learn", "apply"])
+    parser.add_argument("--outputs", default=OUTPUT_DIR_LIST, help="List of per-subject output directories")
+    parser.add_argument("--landmarks", default=LANDMARKS_FILE)
+    parser.add_argument("--image", default=IMAGE_NAME, help="Image file inside each output directory")
+    parser.add_argument("--mask", default=MASK_NAME)
+    parser.add_argument("--out-name", default=STANDARDIZED_NAME)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    output_dirs = read_paths_from_file(args.outputs)
+
+    if args.command == "learn":
+        landmarks = learn_standard_scale(output_dirs, args.image, args.mask, workers=args.workers)
+        save_landmarks(args.landmarks, landmarks)
+        print(f"Learned standard scale from {landmarks['n_volumes']} volumes -> {args.landmarks}")
+    else:
+        landmarks = load_landmarks(args.landmarks)
+        done = skipped = failed = 0
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {
+                pool.submit(standardize_dir, d, landmarks, args.image, args.mask,
+                            args.out_name, args.overwrite): d
+                for d in output_dirs
+            }
+            for fut in tqdm(as_completed(futures), total=len(futures), desc="Standardizing"):
+                try:
+                    if fut.result() is None:
+                        skipped += 1
+                    else:
+                        done += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"Error standardizing {futures[fut]}: {e}")
+        print(f"Standardization finished: {done} written, {skipped} skipped, {failed} failed.")
@@ -0,0 +1,12 @@
+"""
+Single entry point for the preprocessing stages:
+
+    python -m pipeline <convert|check|refine|register|segment|mask|enhance|volumes|sample|labels|score|dag> [options]
+
+Only argparse/json are imported up front; each subcommand imports the stage
+module (and with it numpy, nibabel, cv2, ...) when it runs.
+"""
+
+from .cli import main
+
+__all__ = ["main"]
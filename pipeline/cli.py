@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# Command-line entry point for all pipeline stages.
+#
+# Every stage still lives in its own top-level module (check.py, segment.py,
+# msrcr.py, ...) with its module-level defaults. This CLI only imports argparse
+# and json; the stage module is imported inside the subcommand handler, so
+# `python -m pipeline check` never loads numpy, cv2, skimage or matplotlib.
+#
+# Options come from flags, or from a JSON config file with one section per
+# subcommand (keys are the option names with '-' replaced by '_') plus an
+# optional "common" section applied to every subcommand that has that option:
+#   {"common": {"workers": 8},
+#    "register": {"engine": "affine", "inputs": "input_files.txt"},
+#    "sample": {"method": "mode", "target_shape": [182, 218, 182]}}
+# Flags given on the command line win over the config file.
+
+import os
+import sys
+import json
+import argparse
+import importlib
+
+# The stage modules sit next to this package
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+
+def _stage(name):
+    """Import a stage module on demand."""
+    return importlib.import_module(name)
+
+
+def _given(args, *names):
+    """Keyword arguments for the options that were actually set (None = module default)."""
+    return {name: getattr(args, name) for name in names if getattr(args, name, None) is not None}
+
+
+def _configure(module, args, mapping):
+    """Override a driver's module-level configuration constants from options."""
+    for option, constant in mapping.items():
+        value = getattr(args, option, None)
+        if value is not None:
+            setattr(module, constant, value)
+
+
+# --- Subcommand handlers ---
+def cmd_convert(args):
+    convert = _stage("convert")
+    convert.write_path_lists(**_given(args, "base_input_dir", "base_output_dir",
+                                      "input_list_filename", "output_list_filename"))
+
+
+def cmd_check(args):
+    check = _stage("check")
+    missing, _ = check.check_outputs(**_given(args, "parent_directory", "expected_files"))
+    return 1 if missing is None or missing else 0
+
+
+def cmd_refine(args):
+    refine = _stage("refine")
+    refine.filter_completed(**_given(args, "input_list", "output_list", "filtered_input_list",
+                                     "filtered_output_list", "required_files"))
+
+
+def cmd_register(args):
+    if args.engine == "affine":
+        affine_reg = _stage("affine_reg")
+        kwargs = _given(args, "dof", "metric", "workers")
+        kwargs.update({k: v for k, v in (("input_list", args.inputs), ("output_list", args.outputs),
+                                         ("template_path", args.template)) if v is not None})
+        _, _, failed = affine_reg.register_batch(overwrite=args.overwrite, **kwargs)
+        return 1 if failed else 0
+
+    if args.engine == "longitudinal":
+        longitudinal = _stage("longitudinal")
+        kwargs = _given(args, "dof", "metric", "workers")
+        kwargs.update({k: v for k, v in (("input_list", args.inputs), ("output_list", args.outputs),
+                                         ("template_path", args.template), ("ref_dir", args.reference_dir))
+                       if v is not None})
+        _, _, failed = longitudinal.run_longitudinal(overwrite=args.overwrite, **kwargs)
+        return 1 if failed else 0
+
+    if args.engine == "turboprep":
+        script = _stage("script")
+        _configure(script, args, {"inputs": "INPUT_FILE_LIST", "outputs": "OUTPUT_DIR_LIST",
+                                  "template": "TEMPLATE_FILE", "log_file": "LOG_FILE",
+                                  "mem_budget_gb": "MEM_BUDGET_GB", "cpu_budget": "CPU_BUDGET",
+                                  "queue_dir": "QUEUE_DIR", "timeout_s": "JOB_TIMEOUT_S",
+                                  "metrics_file": "METRICS_FILE", "metrics_port": "METRICS_PORT"})
+        script.run_processing()
+    else:
+        script_gpu = _stage("script_gpu")
+        _configure(script_gpu, args, {"inputs": "INPUT_LIST", "outputs": "OUTPUT_LIST",
+                                      "template": "TEMPLATE_FILE", "log_file": "LOG_FILE",
+                                      "mem_budget_gb": "MEM_BUDGET_GB", "cpu_budget": "CPU_BUDGET",
+                                      "queue_dir": "QUEUE_DIR", "timeout_s": "JOB_TIMEOUT_S",
+                                      "metrics_file": "METRICS_FILE", "metrics_port": "METRICS_PORT"})
+        script_gpu.main()
+
+
+def cmd_segment(args):
+    segment = _stage("segment")
+    segment.run_segmentation(**_given(args, "input_dir", "output_dir", "command_template",
+                                      "mem_budget_gb", "cpu_budget", "profile_file",
+                                      "metrics_file", "metrics_port"))
+
+
+def cmd_mask(args):
+    mask = _stage("mask")
+    if args.output and len(args.input_files) > 1:
+        raise SystemExit("Error: --output can only be used with a single input file.")
+    if args.method == "otsu3d" and len(args.input_files) > 1:
+        brain_mask = _stage("brain_mask")
+        pairs = [(p, brain_mask.default_output(p)) for p in args.input_files]
+        return 1 if brain_mask.mask_batch(pairs, args.workers) else 0
+    for path in args.input_files:
+        mask.extract_brain_mask(path, args.output, args.threshold, args.method)
+
+
+# enhance method -> (module, function, extra kwargs)
+_ENHANCE = {
+    "clahe": ("msrcr", "process_and_save", {"method": "clahe"}),
+    "msrcr": ("msrcr", "process_and_save", {"method": "msrcr"}),
+    "clahe_msrcr": ("msrcr", "process_and_save", {"method": "clahe_msrcr"}),         # 0.6/0.4 blend
+    "clahe_then_msrcr": ("normalize", "process_and_save", {"method": "clahe_msrcr"}),  # chained
+    "clahe_unsharp": ("normalize2", "process_dir", {}),
+    "msrcr_unsharp": ("msrcr_sample", "process_dir", {}),
+    "msrcr_unsharp_fused": ("fused_enhance", "process_dir", {}),  # same output, shared DCT blurs
+    "bias_whitestripe": ("bias_field", "process_dir", {}),       # N4-style bias field + white-stripe only
+}
+
+
+def cmd_enhance(args):
+    module_name, func_name, extra = _ENHANCE[args.method]
+    func = getattr(_stage(module_name), func_name)
+    target_shape = tuple(args.target_shape)
+    if args.bias_correct and module_name in ("msrcr", "normalize", "bias_field"):
+        raise SystemExit(f"--bias-correct applies to the unsharp variants, not --method {args.method}")
+    if func_name == "process_and_save":
+        func(args.input_dir, args.output_dir, target_shape=target_shape, **extra)
+    elif module_name == "bias_field":
+        func(args.input_dir, args.output_dir, target_shape=target_shape,
+             output_encoding=args.encoding, max_rel_error=args.max_rel_error, workers=args.workers)
+    else:
+        # The unsharp variants write float volumes; msrcr/normalize already write uint8
+        func(args.input_dir, args.output_dir, target_shape=target_shape,
+             output_encoding=args.encoding, max_rel_error=args.max_rel_error,
+             bias_correct=args.bias_correct)
+
+
+def cmd_volumes(args):
+    volumes_process = _stage("volumes_process")
+    volumes_process.report_volumes(**_given(args, "data_dir"), plot=not args.no_plot)
+
+
+def cmd_sample(args):
+    label_resample = _stage("label_resample")
+    label_resample.resample_label_dir(args.input_dir, args.output_dir, list(args.target_shape),
+                                      method=args.method, workers=args.workers, compact=args.compact)
+
+
+def cmd_labels(args):
+    label_table = _stage("label_table")
+    paths = label_table.list_inputs(args.input_dir, args.outputs, args.name)
+    if args.rebuild or not os.path.isfile(args.table):
+        table = label_table.build_table(paths, args.workers)
+        label_table.save_table(args.table, table)
+    else:
+        table = label_table.load_table(args.table)
+    pairs = label_table.encode_pairs(paths, args.output_dir, by_folder=not args.input_dir)
+    _, _, failed = label_table.encode_batch(pairs, table, args.workers)
+    return 1 if failed else 0
+
+
+def cmd_dag(args):
+    from . import dag
+    try:
+        stages = dag.apply_overrides(dag.default_stages(**_given(args, "template_path")), args.set)
+    except ValueError as e:
+        raise SystemExit(f"Error: {e}")
+    subjects = dag.subjects_from_lists(args.inputs, args.outputs)
+    graph = dag.DAG(stages, subjects, args.state_file)
+    _, _, failed, skipped = graph.run(args.stages, args.force or (), args.workers, args.dry_run)
+    return 1 if failed or skipped else 0
+
+
+def cmd_score(args):
+    reg_score = _stage("reg_score")
+    dirs = reg_score.read_paths_from_file(args.outputs)
+    rows = reg_score.score_batch(dirs, workers=args.workers, **_given(args, "template_path", "score_mm"))
+    reg_score.write_scores(rows, args.csv)
+    flagged = [r for r in rows if r["flags"]]
+    print(f"Scored {len(rows)} outputs -> {args.csv}; {len(flagged)} flagged:")
+    for r in flagged:
+        print(f"  {r['output_dir']}: {r['flags']}")
+    return 1 if flagged else 0
+
+
+# --- Parser ---
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m pipeline", description="Brain MRI preprocessing pipeline.")
+    parser.add_argument("--config", help="JSON file with per-subcommand option defaults")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("convert", help="Write input/output list files from patient folders")
+    p.add_argument("--input-dir", dest="base_input_dir")
+    p.add_argument("--output-dir", dest="base_output_dir")
+    p.add_argument("--inputs", dest="input_list_filename")
+    p.add_argument("--outputs", dest="output_list_filename")
+    p.set_defaults(func=cmd_convert)
+
+    p = sub.add_parser("check", help="Report output folders with missing files")
+    p.add_argument("--parent-dir", dest="parent_directory")
+    p.add_argument("--expected", dest="expected_files", nargs="+")
+    p.set_defaults(func=cmd_check)
+
+    p = sub.add_parser("refine", help="Drop completed entries from the list files")
+    p.add_argument("--inputs", dest="input_list")
+    p.add_argument("--outputs", dest="output_list")
+    p.add_argument("--filtered-inputs", dest="filtered_input_list")
+    p.add_argument("--filtered-outputs", dest="filtered_output_list")
+    p.add_argument("--required", dest="required_files", nargs="+")
+    p.set_defaults(func=cmd_refine)
+
+    p = sub.add_parser("register", help="Register to MNI152 (TurboPrep on CPU/GPU, in-process affine, "
+                                         "or subject-grouped longitudinal)")
+    p.add_argument("--engine", choices=["turboprep", "turboprep-gpu", "affine", "longitudinal"], default="turboprep")
+    p.add_argument("--inputs")
+    p.add_argument("--outputs")
+    p.add_argument("--template")
+    p.add_argument("--log-file")
+    p.add_argument("--mem-budget-gb", type=float)
+    p.add_argument("--cpu-budget", type=int)
+    p.add_argument("--timeout-s", type=float)
+    p.add_argument("--queue-dir", help="Claim subjects from a shared work queue (TurboPrep engines)")
+    p.add_argument("--metrics-file", help="TurboPrep engines: Prometheus text file updated while running")
+    p.add_argument("--metrics-port", type=int, help="TurboPrep engines: serve metrics on 127.0.0.1:<port>")
+    p.add_argument("--dof", type=int, choices=[6, 12], help="Affine / longitudinal engines: 6 = rigid, 12 = affine")
+    p.add_argument("--metric", choices=["mi", "ncc"], help="Affine / longitudinal engines: similarity metric")
+    p.add_argument("--reference-dir", help="Longitudinal engine: per-subject reference cache")
+    p.add_argument("--workers", type=int)
+    p.add_argument("--overwrite", action="store_true")
+    p.set_defaults(func=cmd_register)
+
+    p = sub.add_parser("segment", help="Run SynthSeg through the resource scheduler")
+    p.add_argument("--input-dir")
+    p.add_argument("--output-dir")
+    p.add_argument("--command-template")
+    p.add_argument("--mem-budget-gb", type=float)
+    p.add_argument("--cpu-budget", type=int)
+    p.add_argument("--profile-file")
+    p.add_argument("--metrics-file", help="Prometheus text file updated while running")
+    p.add_argument("--metrics-port", type=int, help="Also serve metrics on 127.0.0.1:<port>/metrics")
+    p.set_defaults(func=cmd_segment)
+
+    p = sub.add_parser("mask", help="Brain mask (min-max threshold, or 3D Otsu in parallel)")
+    p.add_argument("input_files", nargs="+")
+    p.add_argument("--output")
+    p.add_argument("--threshold", type=float, default=0.1)
+    p.add_argument("--method", choices=["threshold", "otsu3d"], default="threshold")
+    p.add_argument("--workers", type=int)
+    p.set_defaults(func=cmd_mask)
+
+    p = sub.add_parser("enhance", help="Resample and enhance volumes (CLAHE / MSRCR variants)")
+    p.add_argument("--method", choices=sorted(_ENHANCE), default="clahe_msrcr")
+    p.add_argument("--input-dir", default="1")
+    p.add_argument("--output-dir", default="enhanced_resampled")
+    p.add_argument("--target-shape", type=int, nargs=3, default=[182, 218, 182])
+    p.add_argument("--encoding", choices=["auto", "int16", "uint8"],
+                   help="Store float outputs as scaled integers (default float32)")
+    p.add_argument("--max-rel-error", type=float, default=1e-3)
+    p.add_argument("--bias-correct", action="store_true",
+                   help="Remove an N4-style volumetric bias field before the unsharp variants")
+    p.add_argument("--workers", type=int, help="Processes for --method bias_whitestripe")
+    p.set_defaults(func=cmd_enhance)
+
+    p = sub.add_parser("volumes", help="Brain/mask volume statistics")
+    p.add_argument("--data-dir")
+    p.add_argument("--no-plot", action="store_true")
+    p.set_defaults(func=cmd_volumes)
+
+    p = sub.add_parser("sample", help="Resample label maps to the target shape")
+    p.add_argument("--input-dir", default="reg_0000_process")
+    p.add_argument("--output-dir", default="reg_downsample")
+    p.add_argument("--target-shape", type=int, nargs=3, default=[182, 218, 182])
+    p.add_argument("--method", choices=["mode", "nearest"], default="mode")
+    p.add_argument("--workers", type=int)
+    p.add_argument("--compact", action="store_true", help="Smallest integer dtype for the label set")
+    p.set_defaults(func=cmd_sample)
+
+    p = sub.add_parser("labels", help="Remap segmentations to a dense uint8 index with a lookup table")
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument("--input-dir")
+    g.add_argument("--outputs", help="List of output directories containing --name")
+    p.add_argument("--name", default="segm.nii.gz")
+    p.add_argument("--output-dir")
+    p.add_argument("--table", default="label_table.json")
+    p.add_argument("--rebuild", action="store_true", help="Rescan labels even if --table exists")
+    p.add_argument("--workers", type=int)
+    p.set_defaults(func=cmd_labels)
+
+    p = sub.add_parser("dag", help="Run the stage DAG, rebuilding only tasks whose inputs/parameters changed")
+    p.add_argument("--inputs", default="input_files.txt")
+    p.add_argument("--outputs", default="output_paths.txt")
+    p.add_argument("--template", dest="template_path")
+    p.add_argument("--set", action="append", metavar="[STAGE.]PARAM=VALUE",
+                   help="Override a stage parameter (JSON value), e.g. enhance.sigma_list=[10,60,200] "
+                        "or turboprep.executable=/opt/turboprep/turboprep-docker")
+    p.add_argument("--stages", nargs="+", help="Only run these stages (others must be up to date)")
+    p.add_argument("--force", nargs="+", help="Rerun these stages regardless of fingerprints")
+    p.add_argument("--state-file", default=".pipeline_dag.json")
+    p.add_argument("--dry-run", action="store_true", help="Only print what would run")
+    p.add_argument("--workers", type=int,
+                   help="Processes for Python stages; TurboPrep and SynthSeg are admitted by the resource scheduler")
+    p.set_defaults(func=cmd_dag)
+
+    p = sub.add_parser("score", help="Registration quality (NCC, MI, mask Dice vs MNI152) with outlier flags")
+    p.add_argument("--outputs", default="output_paths.txt")
+    p.add_argument("--template", dest="template_path")
+    p.add_argument("--score-mm", type=float)
+    p.add_argument("--csv", default="registration_scores.csv")
+    p.add_argument("--workers", type=int)
+    p.set_defaults(func=cmd_score)
+
+    return parser, sub
+
+
+def apply_config(parser, subparsers, path):
+    """Install config-file values as subparser defaults; unknown keys are an error."""
+    with open(path) as f:
+        config = json.load(f)
+    common = config.get("common", {})
+    for name, subparser in subparsers.choices.items():
+        known = {a.dest for a in subparser._actions}
+        section = config.get(name, {})
+        unknown = set(section) - known
+        if unknown:
+            parser.error(f"{path}: unknown option(s) for '{name}': {', '.join(sorted(unknown))}")
+        defaults = {k: v for k, v in common.items() if k in known}
+        defaults.update(section)
+        subparser.set_defaults(**defaults)
+
+
+def main(argv=None):
+    parser, subparsers = build_parser()
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config")
+    pre, _ = config_parser.parse_known_args(argv)
+    if pre.config:
+        apply_config(parser, subparsers, pre.config)
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,465 @@
+"""
+Stage DAG with fingerprint-based incremental rebuilds.
+
+Each stage declares what it runs (a ``module:function`` or a shell command),
+the stages it depends on, the external files it reads, the files it writes
+and its parameters. Paths are templates filled from the subject
+(``{input}``, ``{output_dir}``, ``{name}``) and the parameters.
+
+Every (stage, subject) task gets a fingerprint: a hash of the stage name and
+version, its parameters, the size/mtime of its external inputs and the
+fingerprints of the tasks it depends on. Fingerprints are recorded in
+STATE_FILE when a task succeeds. A task runs again only if its fingerprint
+changed or one of its outputs is missing. The fingerprint chain carries a change
+downstream, so e.g. ``--set enhance.sigma_list=[10,60,200]`` reruns enhance
+(and whatever depends on it) and leaves turboprep, brain, segment and sample
+untouched. Intermediates are tracked by fingerprint, not by content, so a
+task whose output was deleted is rebuilt without invalidating its dependents.
+
+Ready tasks start as soon as their dependencies finish, so independent
+stages (segment, enhance and sample after TurboPrep) overlap across subjects.
+Python stages run on a process pool (``--workers``); command stages with a
+``tool`` (TurboPrep, SynthSeg) go through scheduler.ResourceScheduler instead,
+which admits them under that tool's memory and thread profile (PROFILE_FILE)
+so a node never starts more multi-GB runs than it can hold. A task that exits
+cleanly but leaves one of its declared outputs missing counts as failed, and a
+failed task skips its dependents for that subject only.
+Dataset-level stages (``per="dataset"``) run once after their dependencies
+have finished for every subject:
+
+    python -m pipeline dag --inputs input_files.txt --outputs output_paths.txt --dry-run
+    python -m pipeline dag --set target_shape=[160,192,160] --stages enhance sample --workers 8
+"""
+
+import os
+import json
+import time
+import hashlib
+import queue
+import importlib
+import threading
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+STATE_FILE = ".pipeline_dag.json"
+# Learned per-tool memory profiles, shared with script.py / segment.py
+PROFILE_FILE = "tool_profiles.json"
+# Minimum seconds between state-file rewrites while tasks are finishing
+SAVE_INTERVAL_S = 2.0
+DATASET = "*"
+# What TurboPrep leaves in every output folder (check.py's expected_files)
+TURBOPREP_FILES = ("affine_transf.mat", "mask.nii.gz", "normalized.nii.gz", "segm.nii.gz")
+
+
+class Stage:
+    """
+    One step of the DAG. `action` is "module:function" (called with `args`
+    and `params` as keyword arguments) or, with `command`, a shell command
+    template. A command with a `tool` runs under the ResourceScheduler profile
+    of that name, and `{threads}` in it is the thread count the scheduler
+    grants. Bump `version` when the stage's code changes its output.
+    """
+
+    def __init__(self, name, action=None, command=None, deps=(), inputs=(), outputs=(), args=None,
+                 params=None, per="subject", version=1, tool=None):
+        if (action is None) == (command is None):
+            raise ValueError(f"Stage {name}: give exactly one of action / command")
+        self.name = name
+        self.action = action
+        self.command = command
+        self.deps = tuple(deps)
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.args = dict(args or {})
+        self.params = dict(params or {})
+        self.per = per
+        self.version = version
+        self.tool = tool
+
+
+def default_stages(template_path="MNI152_T1_1mm_brain.nii.gz"):
+    """
+    The README workflow on the lists from convert.py: turboprep -> brain ->
+    {segment, enhance}; turboprep -> sample; {turboprep, segment} -> volumes;
+    enhance -> qc_table. TurboPrep's four files (check.py's expected_files)
+    are declared outputs, so a run that misses one fails the way check.py /
+    refine.py would flag it; later stages only read them and write names of
+    their own.
+    """
+    brain = "{output_dir}/brain_mni.nii.gz"
+    return [
+        Stage("turboprep", command="\"{executable}\" \"{input}\" \"{output_dir}\" \"{template_path}\" {options}",
+              tool="turboprep", inputs=("{input}", "{template_path}"),
+              outputs=tuple(f"{{output_dir}}/{n}" for n in TURBOPREP_FILES),
+              params={"template_path": template_path, "executable": "turboprep-docker",
+                      "options": "--modality t1"}),
+        Stage("brain", "pipeline.dag:brain_to_template", deps=("turboprep",),
+              outputs=(brain,),
+              args={"input_path": "{input}", "output_dir": "{output_dir}", "dst": brain},
+              params={"template_path": template_path}),
+        Stage("segment", command=("mri_synthseg --i \"{output_dir}/brain_mni.nii.gz\" "
+                                  "--o \"{output_dir}/synthseg.nii.gz\" --fast --threads {threads} --resample 1"),
+              tool="synthseg", deps=("brain",), outputs=("{output_dir}/synthseg.nii.gz",)),
+        Stage("enhance", "fused_enhance:enhance_file", deps=("brain",),
+              outputs=("{output_dir}/enhanced.nii.gz",),
+              args={"src": brain, "dst": "{output_dir}/enhanced.nii.gz"},
+              params={"target_shape": [182, 218, 182], "sigma_list": [15, 80, 250], "gain": 1.0,
+                      "offset": 0.0, "sharpen_radius": 1, "sharpen_amount": 1.0}),
+        Stage("sample", "label_resample:resample_label_file", deps=("turboprep",),
+              outputs=("{output_dir}/segm_resampled.nii.gz",),
+              args={"src": "{output_dir}/segm.nii.gz", "dst": "{output_dir}/segm_resampled.nii.gz"},
+              params={"target_shape": [182, 218, 182], "method": "mode"}),
+        Stage("volumes", "pipeline.dag:write_volume_table", deps=("turboprep", "segment"), per="dataset",
+              outputs=("{out_path}",), params={"out_path": "volumes.csv"}),
+        Stage("qc_table", "pipeline.dag:write_qc_table", deps=("enhance",), per="dataset",
+              outputs=("{out_path}",), params={"out_path": "qc_table.csv"}),
+    ]
+
+
+def brain_to_template(input_path, output_dir, dst, template_path):
+    """Input resampled through TurboPrep's affine_transf.mat, zero outside its mask.nii.gz."""
+    import numpy as np
+    import nibabel as nib
+    propagate = importlib.import_module("propagate")
+
+    template = nib.load(template_path)
+    fixed_to_moving = propagate.read_affine_transf(os.path.join(output_dir, "affine_transf.mat"))
+    data = propagate.resample_to_template(nib.load(input_path), fixed_to_moving, template, order=3)
+    mask = np.asanyarray(nib.load(os.path.join(output_dir, "mask.nii.gz")).dataobj) > 0
+    data = np.where(mask, np.maximum(data, 0), 0).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, template.affine), dst)
+
+
+def write_qc_table(output_dirs, out_path):
+    """Dataset stage: merge the QC sidecars of every subject folder (qc_metrics.py)."""
+    qc_metrics = importlib.import_module("qc_metrics")
+    sidecars = [p for d in output_dirs for p in qc_metrics.find_sidecars(d)]
+    qc_metrics.write_table(qc_metrics.aggregate(sidecars), out_path)
+
+
+def write_volume_table(output_dirs, out_path):
+    """Dataset stage: volume (mm^3, nonzero voxels) of each subject's mask and label maps."""
+    import csv
+    volumes_process = importlib.import_module("volumes_process")
+    names = ("mask.nii.gz", "segm.nii.gz", "synthseg.nii.gz")
+    tmp = f"{out_path}.tmp"
+    with open(tmp, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["output_dir"] + [n.split(".")[0] + "_mm3" for n in names])
+        for d in output_dirs:
+            vols = [volumes_process.compute_volume(os.path.join(d, n)) for n in names]
+            writer.writerow([d] + ["" if v is None else f"{v:.1f}" for v in vols])
+    os.replace(tmp, out_path)
+
+
+def _format(template, fields):
+    return template.format(**fields) if isinstance(template, str) else template
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def fingerprint(stage, fields, dep_fps):
+    payload = {"stage": stage.name, "version": stage.version, "params": stage.params,
+               "action": stage.action or stage.command,
+               "inputs": {p: _file_stamp(p) for p in (_format(t, fields) for t in stage.inputs)},
+               "deps": dep_fps}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def apply_overrides(stages, assignments):
+    """
+    Apply "stage.param=value" / "param=value" strings (value parsed as JSON,
+    else kept as a string); an unqualified param goes to every stage that has it.
+    """
+    by_name = {s.name: s for s in stages}
+    for text in assignments or ():
+        key, sep, raw = text.partition("=")
+        if not sep:
+            raise ValueError(f"Expected PARAM=VALUE, got {text!r}")
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = raw
+        stage_name, dot, param = key.rpartition(".")
+        targets = [by_name[stage_name]] if dot and stage_name in by_name else \
+            [s for s in stages if param in s.params] if not dot else []
+        if not targets or any(param not in s.params for s in targets):
+            raise ValueError(f"Unknown parameter {key!r}")
+        for s in targets:
+            s.params[param] = value
+    return stages
+
+
+class DAG:
+    """Stages over a list of subjects: plan with fingerprints, then run what is stale."""
+
+    def __init__(self, stages, subjects, state_file=STATE_FILE, scheduler=None):
+        self.stages = {s.name: s for s in stages}
+        # ResourceScheduler for command stages with a tool (created on first use)
+        self.scheduler = scheduler
+        self.order = self._toposort(stages)
+        # subject: {"input", "output_dir", "name"}, keyed by output_dir
+        self.subjects = {s["output_dir"]: s for s in subjects}
+        self.state_file = state_file
+        self.state = {}
+        if state_file and os.path.isfile(state_file):
+            with open(state_file) as f:
+                self.state = json.load(f)
+        self._saved_at = 0.0
+
+    @staticmethod
+    def _toposort(stages):
+        names = {s.name for s in stages}
+        order, done = [], set()
+        pending = list(stages)
+        while pending:
+            ready = [s for s in pending if all(d in done for d in s.deps)]
+            if not ready:
+                bad = [d for s in pending for d in s.deps if d not in names]
+                raise ValueError(f"Unknown dependencies {bad}" if bad else "Stage dependencies form a cycle")
+            for s in ready:
+                order.append(s.name)
+                done.add(s.name)
+                pending.remove(s)
+        return order
+
+    def _fields(self, stage, subject):
+        fields = dict(stage.params)
+        if subject != DATASET:
+            fields.update(self.subjects[subject])
+        else:
+            fields["output_dirs"] = sorted(self.subjects)
+        return fields
+
+    def _subjects_of(self, stage):
+        return [DATASET] if stage.per == "dataset" else sorted(self.subjects)
+
+    def _dep_tasks(self, stage, subject):
+        tasks = []
+        for dep in stage.deps:
+            if self.stages[dep].per == "dataset":
+                tasks.append((dep, DATASET))
+            elif subject == DATASET:
+                tasks.extend((dep, s) for s in sorted(self.subjects))
+            else:
+                tasks.append((dep, subject))
+        return tasks
+
+    def plan(self, selected=None, force=()):
+        """
+        {(stage, subject): {"fp", "deps", "reason"}} in dependency order;
+        reason is None for up-to-date tasks. Stages outside `selected` are
+        planned (their fingerprints feed downstream) but never run.
+        """
+        plan = {}
+        for name in self.order:
+            stage = self.stages[name]
+            for subject in self._subjects_of(stage):
+                fields = self._fields(stage, subject)
+                deps = self._dep_tasks(stage, subject)
+                fp = fingerprint(stage, fields, [plan[d]["fp"] for d in deps])
+                recorded = self.state.get(name, {}).get(subject)
+                if name in force:
+                    reason = "forced"
+                elif recorded is None:
+                    reason = "never run"
+                elif recorded != fp:
+                    reason = "inputs or parameters changed"
+                elif not all(os.path.exists(_format(o, fields)) for o in stage.outputs):
+                    reason = "outputs missing"
+                else:
+                    reason = None
+                if reason and selected is not None and name not in selected:
+                    reason = None if recorded == fp else "not selected"
+                plan[(name, subject)] = {"fp": fp, "deps": deps, "reason": reason}
+        return plan
+
+    def describe(self, plan):
+        lines = []
+        for name in self.order:
+            tasks = [t for (s, _), t in plan.items() if s == name]
+            stale = {}
+            for t in tasks:
+                if t["reason"]:
+                    stale[t["reason"]] = stale.get(t["reason"], 0) + 1
+            detail = ", ".join(f"{n} {r}" for r, n in sorted(stale.items())) or "up to date"
+            lines.append(f"  {name:<10} {len(tasks):>5} tasks: {detail}")
+        return "\n".join(lines)
+
+    def _record(self, stage, subject, fp, final=False):
+        if stage is not None:
+            self.state.setdefault(stage, {})[subject] = fp
+        if self.state_file and (final or time.monotonic() - self._saved_at >= SAVE_INTERVAL_S):
+            tmp = f"{self.state_file}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.state_file)
+            self._saved_at = time.monotonic()
+
+    def run(self, selected=None, force=(), workers=None, dry_run=False):
+        """Run every stale task once its dependencies are done; returns (ran, up_to_date, failed, skipped)."""
+        plan = self.plan(selected, force)
+        print(self.describe(plan))
+        todo = {task for task, info in plan.items() if info["reason"] and info["reason"] != "not selected"}
+        blocked = {task for task, info in plan.items() if info["reason"] == "not selected"}
+        up_to_date = len(plan) - len(todo) - len(blocked)
+        if dry_run or not todo:
+            return 0, up_to_date, 0, 0
+
+        finished, failed = set(), set()
+        ran = skipped = 0
+        commands = None
+        if any(self.stages[name].tool for name, _ in todo):
+            if self.scheduler is None:
+                scheduler = importlib.import_module("scheduler")
+                self.scheduler = scheduler.ResourceScheduler(profile_path=PROFILE_FILE, max_attempts=1)
+            print(f"Scheduler: {self.scheduler.describe()}")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            if any(self.stages[name].tool for name, _ in todo):
+                # Fork the pool's workers before the scheduler thread starts its Popens:
+                # a worker forked mid-Popen keeps its exec pipe open and the Popen never returns
+                pool.submit(int).result()
+                commands = _ScheduledCommands(self.scheduler)
+            running = {}
+            try:
+                while todo or running:
+                    for task in sorted(todo):
+                        deps = plan[task]["deps"]
+                        if any(d in failed or d in blocked for d in deps):
+                            todo.discard(task)
+                            failed.add(task)  # propagate to its own dependents
+                            skipped += 1
+                        elif all(d not in todo and d not in running.values() for d in deps):
+                            todo.discard(task)
+                            stage = self.stages[task[0]]
+                            fields = self._fields(stage, task[1])
+                            if stage.tool:
+                                fut = commands.submit(f"{task[0]}:{task[1]}", stage.tool,
+                                                      stage.command.format(**{**fields, "threads": "{threads}"}),
+                                                      fields.get("output_dir"))
+                            else:
+                                fut = pool.submit(_run_task, stage, fields)
+                            running[fut] = task
+                    if not running:
+                        continue
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        task = running.pop(fut)
+                        label = task[0] if task[1] == DATASET else f"{task[0]} {self.subjects[task[1]]['name']}"
+                        try:
+                            seconds = fut.result()
+                            fields = self._fields(self.stages[task[0]], task[1])
+                            missing = [o for o in (_format(t, fields) for t in self.stages[task[0]].outputs)
+                                       if not os.path.exists(o)]
+                            if missing:
+                                raise RuntimeError(f"finished without {', '.join(missing)}")
+                        except Exception as e:
+                            failed.add(task)
+                            print(f"Error in {label}: {e}")
+                            continue
+                        finished.add(task)
+                        ran += 1
+                        self._record(task[0], task[1], plan[task]["fp"])
+                        print(f"{label}: done in {seconds:.1f}s ({plan[task]['reason']})")
+            finally:
+                if commands is not None:
+                    commands.close()
+                self._record(None, None, None, final=True)
+        failures = len(failed) - skipped
+        print(f"DAG finished: {ran} ran, {up_to_date} up to date, {failures} failed, {skipped} skipped.")
+        return ran, up_to_date, failures, skipped
+
+
+class _ScheduledCommands:
+    """
+    Feeds command tasks to a ResourceScheduler running on a background thread
+    and hands back a Future per task, so the DAG waits on them together with
+    the process pool's futures.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._jobs = queue.Queue()
+        self._futures = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, tool, command, output_dir=None):
+        scheduler = importlib.import_module("scheduler")
+        cleanup = None
+        if tool.startswith("turboprep") and output_dir:
+            # A timed-out turboprep-docker leaves its container running (see script.py)
+            cleanup = lambda d=output_dir: scheduler.kill_containers_mounting(d)
+        fut = Future()
+        self._futures[key] = fut
+        self._jobs.put(scheduler.Job(key, tool, command, shell=True, cleanup=cleanup))
+        return fut
+
+    def _refill(self):
+        # Read the flag first: everything submitted before close() is queued by then
+        closed = self._closed
+        jobs = []
+        while True:
+            try:
+                jobs.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return None if closed and not jobs else jobs
+
+    def _loop(self):
+        try:
+            for result in self.scheduler.run([], refill=self._refill):
+                fut = self._futures.pop(result.job.key)
+                if result.ok:
+                    fut.set_result(result.seconds)
+                else:
+                    fut.set_exception(RuntimeError(f"{result.describe()}: {result.stderr.strip()[-500:]}"))
+        except Exception as e:
+            for fut in self._futures.values():
+                if not fut.done():
+                    fut.set_exception(e)
+
+    def close(self):
+        """No more tasks; waits for the scheduled ones to finish."""
+        self._closed = True
+        self._thread.join()
+
+
+def _run_task(stage, fields):
+    """Execute one task in a worker process; returns its wall time."""
+    start = time.time()
+    if stage.command is not None:
+        proc = subprocess.run(stage.command.format(**fields), shell=True, text=True,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError(f"exit code {proc.returncode}: {proc.stderr.strip()[-500:]}")
+    else:
+        module_name, func_name = stage.action.split(":")
+        func = getattr(importlib.import_module(module_name), func_name)
+        kwargs = {k: _format(v, fields) for k, v in stage.args.items()}
+        if stage.per == "dataset":
+            kwargs.setdefault("output_dirs", fields["output_dirs"])
+        kwargs.update(stage.params)
+        for out in stage.outputs:
+            os.makedirs(os.path.dirname(_format(out, fields)) or ".", exist_ok=True)
+        func(**kwargs)
+    return time.time() - start
+
+
+def subjects_from_lists(input_list, output_list):
+    def read(path):
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+
+    inputs, outputs = read(input_list), read(output_list)
+    if len(inputs) != len(outputs):
+        raise SystemExit(f"Error: Mismatch in number of lines between {input_list} and {output_list}.")
+    return [{"input": i, "output_dir": o, "name": os.path.basename(os.path.normpath(o))}
+            for i, o in zip(inputs, outputs)]
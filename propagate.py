@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Propagate a TurboPrep registration to the co-acquired modalities.
+#
+# TurboPrep is run once per session (on the `_0000` image listed in
+# input_files.txt) and leaves `affine_transf.mat` and `mask.nii.gz` in the
+# output directory. The remaining modalities (`_0001`..`_0003`) of the same
+# session share the scanner space, so instead of registering each of them again
+# we read that transform, resample them onto the MNI template grid in-process
+# (cubic for intensities, nearest for label maps) and only run the intensity
+# normalization steps.
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+from scipy.io import loadmat, savemat
+from scipy.ndimage import affine_transform
+
+from msrcr import white_stripe_normalize
+
+# --- Configuration ---
+INPUT_FILE_LIST = "./input_files.txt"
+OUTPUT_DIR_LIST = "./output_paths.txt"
+TEMPLATE_FILE = "MNI152_T1_1mm_brain.nii.gz"
+MODALITIES = ["0001", "0002", "0003"]
+TRANSFORM_NAME = "affine_transf.mat"
+MASK_NAME = "mask.nii.gz"
+# --- End Configuration ---
+
+# ITK stores physical points in LPS, NIfTI affines are RAS
+_LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def read_affine_transf(mat_path):
+    """
+    Read an ITK/ANTs `affine_transf.mat` and return a 4x4 RAS matrix mapping
+    points of the fixed (template) space to the moving (subject) space.
+    Plain-text 4x4 RAS matrices (greedy / c3d style) are accepted as well.
+    """
+    try:
+        mat = loadmat(mat_path)
+    except Exception:
+        return np.loadtxt(mat_path).reshape(4, 4)
+
+    key = next((k for k in mat if k.startswith(("AffineTransform", "MatrixOffsetTransform"))), None)
+    if key is None:
+        raise ValueError(f"No affine transform found in {mat_path}")
+    params = np.asarray(mat[key], dtype=np.float64).ravel()
+    center = np.asarray(mat.get("fixed", np.zeros(3)), dtype=np.float64).ravel()
+
+    matrix = params[:9].reshape(3, 3)
+    translation = params[9:12]
+    lps = np.eye(4)
+    lps[:3, :3] = matrix
+    lps[:3, 3] = translation + center - matrix @ center
+    return _LPS_TO_RAS @ lps @ _LPS_TO_RAS
+
+
+def write_affine_transf(mat_path, fixed_to_moving):
+    """
+    Write a 4x4 RAS fixed->moving matrix as an ITK/ANTs `AffineTransform_double_3_3`
+    MAT file (the inverse of `read_affine_transf`).
+    """
+    lps = _LPS_TO_RAS @ np.asarray(fixed_to_moving, dtype=np.float64) @ _LPS_TO_RAS
+    params = np.concatenate([lps[:3, :3].ravel(), lps[:3, 3]])
+    savemat(mat_path, {"AffineTransform_double_3_3": params[:, None],
+                       "fixed": np.zeros((3, 1))}, format="4")
+
+
+def resample_to_template(moving_img, fixed_to_moving, template_img, order):
+    """Resample `moving_img` onto the template grid through a fixed->moving RAS transform."""
+    vox_map = np.linalg.inv(moving_img.affine) @ fixed_to_moving @ template_img.affine
+    if order == 0:
+        data = np.asanyarray(moving_img.dataobj)
+    else:
+        data = moving_img.get_fdata(dtype=np.float32)
+    return affine_transform(data, vox_map, output_shape=template_img.shape[:3],
+                            order=order, mode='constant', cval=0, prefilter=order > 1)
+
+
+def propagate_session(input_path, output_dir, template_path=TEMPLATE_FILE,
+                      modalities=MODALITIES, label_suffixes=(), overwrite=False):
+    """
+    Propagate the registration of `input_path` (the `_0000` image) to its sibling
+    modalities. Writes `normalized_<mod>.nii.gz` for intensities and
+    `<suffix>_mni.nii.gz` for label maps into `output_dir`.
+    """
+    transform_path = os.path.join(output_dir, TRANSFORM_NAME)
+    if not os.path.isfile(transform_path):
+        raise FileNotFoundError(f"Missing {TRANSFORM_NAME} in {output_dir}")
+    fixed_to_moving = read_affine_transf(transform_path)
+    template = nib.load(template_path)
+
+    mask_path = os.path.join(output_dir, MASK_NAME)
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0 if os.path.isfile(mask_path) else None
+
+    in_dir = os.path.dirname(input_path)
+    uid = os.path.basename(input_path)[:-len("_0000.nii.gz")]
+    written = []
+
+    for mod in modalities:
+        src = os.path.join(in_dir, f"{uid}_{mod}.nii.gz")
+        dst = os.path.join(output_dir, f"normalized_{mod}.nii.gz")
+        if not os.path.isfile(src) or (os.path.exists(dst) and not overwrite):
+            continue
+        data = resample_to_template(nib.load(src), fixed_to_moving, template, order=3)
+        if mask is not None:
+            data = white_stripe_normalize(data, mask=mask).astype(np.float32)
+            data[~mask] = 0
+        else:
+            data = white_stripe_normalize(data, mask=data > 0).astype(np.float32)
+        nib.save(nib.Nifti1Image(data, template.affine), dst)
+        written.append(dst)
+
+    for suffix in label_suffixes:
+        src = os.path.join(in_dir, f"{uid}_{suffix}.nii.gz")
+        dst = os.path.join(output_dir, f"{suffix}_mni.nii.gz")
+        if not os.path.isfile(src) or (os.path.exists(dst) and not overwrite):
+            continue
+        moving = nib.load(src)
+        labels = resample_to_template(moving, fixed_to_moving, template, order=0)
+        out = nib.Nifti1Image(labels, template.affine)
+        out.set_data_dtype(labels.dtype)
+        nib.save(out, dst)
+        written.append(dst)
+
+    return written
+
+
+def read_paths_from_file(filepath):
+    with open(filepath, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Resample co-acquired modalities into MNI space using the existing TurboPrep transform."
+    )
+    parser.add_argument("--inputs", default=INPUT_FILE_LIST, help="List of registered _0000 input files")
+    parser.add_argument("--outputs", default=OUTPUT_DIR_LIST, help="List of TurboPrep output directories")
+    parser.add_argument("--template", default=TEMPLATE_FILE)
+    parser.add_argument("--modalities", nargs="*", default=MODALITIES)
+    parser.add_argument("--labels", nargs="*", default=[],
+                        help="Suffixes of native-space label maps to resample with nearest neighbour")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    inputs = read_paths_from_file(args.inputs)
+    outputs = read_paths_from_file(args.outputs)
+    if len(inputs) != len(outputs):
+        raise SystemExit(f"Error: Mismatch in number of lines between {args.inputs} and {args.outputs}.")
+
+    done = failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(propagate_session, i, o, args.template, args.modalities, args.labels, args.overwrite): i
+            for i, o in zip(inputs, outputs)
+        }
+        for fut in as_completed(futures):
+            try:
+                written = fut.result()
+                done += 1
+                print(f"{os.path.basename(futures[fut])}: {len(written)} file(s) written")
+            except Exception as e:
+                failed += 1
+                print(f"Error propagating {futures[fut]}: {e}")
+    print(f"Propagation finished: {done} sessions done, {failed} failed.")
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Per-subject QC metrics written by the stages themselves.
+#
+# The enhancement stages (msrcr.py, normalize.py, normalize2.py,
+# msrcr_sample.py, fused_enhance.py, bias_field.py) and mask.py call `record`
+# right after saving their output, with the arrays they still hold in memory,
+# so the image is never read back. The metrics go to a small
+# JSON sidecar next to the output image (normalized.nii.gz -> normalized.qc.json,
+# sub01.nii.gz -> sub01.qc.json), with one section per stage:
+#   {"subject": "sub01", "stages": {"msrcr_unsharp": {"snr": 41.2, ...}, "mask": {...}}}
+# `aggregate` merges every sidecar under a directory into one CSV row per
+# subject, so dataset-level QC never has to decode the voxel data again:
+#   python qc_metrics.py --root images_registered_proc --out qc_table.csv
+
+import os
+import csv
+import json
+import argparse
+
+import numpy as np
+
+# --- Configuration ---
+WRITE_QC = os.environ.get("PIPELINE_QC", "1") != "0"
+SIDECAR_SUFFIX = ".qc.json"
+STRIPE_PCT = (70, 90)
+# Output names shared by every subject folder; their subject is the folder name
+GENERIC_NAMES = ("normalized", "mask", "segm", "standardized", "registered")
+# --- End Configuration ---
+
+
+def subject_id(path):
+    base = os.path.basename(path)
+    for ext in (".nii.gz", ".nii", SIDECAR_SUFFIX):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    if base.startswith(GENERIC_NAMES):
+        return os.path.basename(os.path.dirname(os.path.abspath(path)))
+    return base
+
+
+def sidecar_path(image_path):
+    base = image_path
+    for ext in (".nii.gz", ".nii"):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    return base + SIDECAR_SUFFIX
+
+
+def voxel_volume_ml(header):
+    return float(np.prod(header.get_zooms()[:3])) / 1000.0
+
+
+def compute_metrics(data, mask=None, voxel_ml=None, stripe=None, clip_range=None):
+    """
+    QC statistics of an in-memory volume:
+      mask_voxels / mask_coverage / brain_volume_ml - size of the mask
+      fg_mean / fg_std / bg_std / snr               - in-mask mean over out-of-mask std
+      ws_mean / ws_std                              - white-stripe (given, or of the in-mask 70-90th pct)
+      clip_fraction                                 - in-mask voxels at the ends of clip_range
+                                                      (default: the in-mask min/max, i.e. saturation)
+    """
+    mask = data != 0 if mask is None else mask.astype(bool, copy=False)
+    n_mask = int(np.count_nonzero(mask))
+    metrics = {"shape": list(data.shape), "mask_voxels": n_mask,
+               "mask_coverage": n_mask / data.size}
+    if voxel_ml:
+        metrics["brain_volume_ml"] = n_mask * voxel_ml
+    if n_mask == 0:
+        return metrics
+
+    fg = data[mask]
+    fg_mean, fg_std = float(fg.mean(dtype=np.float64)), float(fg.std(dtype=np.float64))
+    metrics.update(fg_mean=fg_mean, fg_std=fg_std)
+    if n_mask < data.size:
+        bg_std = float(data[~mask].std(dtype=np.float64))
+        metrics["bg_std"] = bg_std
+        metrics["snr"] = abs(fg_mean) / bg_std if bg_std > 0 else None
+
+    if stripe is None:
+        lo, hi = np.percentile(fg, STRIPE_PCT)
+        band = fg[(fg >= lo) & (fg <= hi)]
+        stripe = (band.mean(dtype=np.float64), band.std(dtype=np.float64))
+    metrics["ws_mean"], metrics["ws_std"] = float(stripe[0]), float(stripe[1])
+
+    lo, hi = clip_range if clip_range is not None else (fg.min(), fg.max())
+    metrics["clip_fraction"] = float(np.count_nonzero((fg <= lo) | (fg >= hi))) / n_mask
+    return metrics
+
+
+def write_sidecar(image_path, stage, metrics, subject=None):
+    """Add (or replace) `stage`'s section in the sidecar of `image_path`."""
+    path = sidecar_path(image_path)
+    try:
+        with open(path) as f:
+            doc = json.load(f)
+    except (FileNotFoundError, ValueError):
+        doc = {}
+    doc["subject"] = subject or doc.get("subject") or subject_id(image_path)
+    doc.setdefault("stages", {})[stage] = metrics
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(doc, f)
+    os.replace(tmp, path)
+    return path
+
+
+def record(image_path, stage, data, mask=None, source=None, **kwargs):
+    """compute_metrics + write_sidecar, unless QC is disabled (PIPELINE_QC=0)."""
+    if not WRITE_QC:
+        return None
+    metrics = compute_metrics(data, mask, **kwargs)
+    write_sidecar(image_path, stage, metrics, subject_id(source) if source else None)
+    return metrics
+
+
+def find_sidecars(root):
+    for dirpath, _, files in os.walk(root):
+        for fname in files:
+            if fname.endswith(SIDECAR_SUFFIX):
+                yield os.path.join(dirpath, fname)
+
+
+def aggregate(paths):
+    """One row per subject: {'subject': ..., '<stage>.<metric>': value, ...}."""
+    rows = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                doc = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping {path}: {e}")
+            continue
+        subject = doc.get("subject") or subject_id(path)
+        row = rows.setdefault(subject, {"subject": subject})
+        for stage, metrics in doc.get("stages", {}).items():
+            for name, value in metrics.items():
+                if not isinstance(value, list):
+                    row[f"{stage}.{name}"] = value
+    return [rows[k] for k in sorted(rows)]
+
+
+def write_table(rows, out_path):
+    columns = ["subject"] + sorted({c for row in rows for c in row} - {"subject"})
+    with open(out_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return columns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge per-subject QC sidecars into one CSV table.")
+    parser.add_argument("--root", nargs="+", default=["."], help="Directories searched for *.qc.json")
+    parser.add_argument("--out", default="qc_table.csv")
+    args = parser.parse_args()
+
+    sidecars = [p for root in args.root for p in find_sidecars(root)]
+    rows = aggregate(sidecars)
+    columns = write_table(rows, args.out)
+    print(f"Merged {len(sidecars)} sidecars into {len(rows)} subjects x {len(columns) - 1} metrics -> {args.out}")
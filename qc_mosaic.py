@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Batch QC mosaics for pipeline outputs.
+#
+# For every output directory one PNG is written: a row per available image
+# (normalized.nii.gz, the propagated normalized_000X.nii.gz, standardized.nii.gz)
+# with axial / coronal / sagittal slices through the centre of the brain mask,
+# the mask outline in red and the in-mask histogram on the right. Windowing,
+# outlines and histograms are plain NumPy and the PNG is written by cv2, so no
+# display or matplotlib is needed. Subjects are rendered across a process pool
+# and linked from a single static index.html:
+#   python qc_mosaic.py --outputs output_paths.txt --qc-dir qc
+
+import os
+import html
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+import nibabel as nib
+from tqdm import tqdm
+
+from work_queue import job_id_for
+
+# --- Configuration ---
+OUTPUT_DIR_LIST = "./output_paths.txt"
+QC_DIR = "qc"
+QC_IMAGES = ["normalized.nii.gz", "normalized_0001.nii.gz", "normalized_0002.nii.gz",
+             "normalized_0003.nii.gz", "standardized.nii.gz"]
+MASK_NAME = "mask.nii.gz"
+PANEL_H = 220          # pixel height of every slice panel
+HIST_W = 256           # one column per intensity bin
+WINDOW_PCT = (1, 99)   # display window inside the mask
+# --- End Configuration ---
+
+_LABEL_H = 22
+
+
+def window_to_uint8(data, mask, pct=WINDOW_PCT):
+    """Linear window from in-mask percentiles to 0..255."""
+    vals = data[mask] if mask is not None and mask.any() else data[data != 0]
+    if vals.size == 0:
+        return np.zeros(data.shape, dtype=np.uint8), (0.0, 0.0)
+    lo, hi = np.percentile(vals, pct)
+    scale = 255.0 / max(hi - lo, 1e-6)
+    out = np.clip((data - lo) * scale, 0, 255).astype(np.uint8)
+    return out, (float(lo), float(hi))
+
+
+def _outline(mask2d):
+    """Boundary pixels of a 2D mask (mask minus its 4-neighbour erosion)."""
+    inner = mask2d.copy()
+    inner[1:, :] &= mask2d[:-1, :]
+    inner[:-1, :] &= mask2d[1:, :]
+    inner[:, 1:] &= mask2d[:, :-1]
+    inner[:, :-1] &= mask2d[:, 1:]
+    return mask2d & ~inner
+
+
+def _orthogonal_slices(vol, center):
+    """Axial, coronal and sagittal slices with superior/anterior up (RAS array order)."""
+    x, y, z = center
+    return [np.rot90(vol[:, :, z]), np.rot90(vol[:, y, :]), np.rot90(vol[x, :, :])]
+
+
+def _panel(slice_u8, mask2d, aspect):
+    """Grey slice to a BGR panel of height PANEL_H, mask outline in red."""
+    rgb = np.repeat(slice_u8[:, :, None], 3, axis=2)
+    if mask2d is not None:
+        rgb[_outline(mask2d)] = (0, 0, 255)
+    h, w = slice_u8.shape
+    width = max(int(round(PANEL_H * w * aspect / h)), 1)
+    return cv2.resize(rgb, (width, PANEL_H), interpolation=cv2.INTER_NEAREST)
+
+
+def _histogram_panel(values_u8):
+    """256-bin histogram drawn as white columns, log-scaled heights."""
+    counts = np.bincount(values_u8, minlength=256)[:HIST_W].astype(np.float64)
+    heights = np.log1p(counts)
+    heights = (heights / max(heights.max(), 1e-9) * (PANEL_H - 1)).astype(int)
+    rows = np.arange(PANEL_H)[:, None]
+    canvas = np.where(rows >= PANEL_H - heights[None, :], 255, 40).astype(np.uint8)
+    return np.repeat(canvas[:, :, None], 3, axis=2)
+
+
+def _label(text, width):
+    bar = np.zeros((_LABEL_H, width, 3), dtype=np.uint8)
+    cv2.putText(bar, text, (4, _LABEL_H - 6), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+    return bar
+
+
+def render_subject(output_dir, png_path, images=QC_IMAGES, mask_name=MASK_NAME):
+    """Write the QC mosaic for one output directory; returns a summary dict."""
+    mask_path = os.path.join(output_dir, mask_name)
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0 if os.path.isfile(mask_path) else None
+
+    rows = []
+    stats = {}
+    for name in images:
+        path = os.path.join(output_dir, name)
+        if not os.path.isfile(path):
+            continue
+        img = nib.load(path)
+        data = np.asanyarray(img.dataobj, dtype=np.float32)
+        m = mask if mask is not None and mask.shape == data.shape else data != 0
+        u8, window = window_to_uint8(data, m)
+
+        if m.any():
+            center = [int(np.mean(a)) for a in np.nonzero(m)]  # mask centroid
+        else:
+            center = [s // 2 for s in data.shape]
+        zx, zy, zz = img.header.get_zooms()[:3]
+        # Width/height voxel ratios after rot90: axial (y by x), coronal (z by x), sagittal (z by y)
+        aspects = [zx / zy, zx / zz, zy / zz]
+        panels = [_panel(s, ms, a) for s, ms, a in
+                  zip(_orthogonal_slices(u8, center), _orthogonal_slices(m, center), aspects)]
+        panels.append(_histogram_panel(u8[m]))
+        row = np.concatenate(panels, axis=1)
+        label = f"{name}  window [{window[0]:.3g}, {window[1]:.3g}]"
+        rows.append(np.concatenate([_label(label, row.shape[1]), row], axis=0))
+        stats[name] = {"window": window, "shape": list(data.shape)}
+
+    if not rows:
+        return {"output_dir": output_dir, "png": None, "images": stats, "error": "no QC images found"}
+
+    width = max(r.shape[1] for r in rows)
+    rows = [np.pad(r, ((0, 0), (0, width - r.shape[1]), (0, 0))) for r in rows]
+    cv2.imwrite(png_path, np.concatenate(rows, axis=0))
+    return {"output_dir": output_dir, "png": png_path, "images": stats, "error": None}
+
+
+def write_index(qc_dir, results):
+    """Static HTML page listing every mosaic (lazy-loaded) and every failure."""
+    results = sorted(results, key=lambda r: r["output_dir"])
+    parts = ["<!DOCTYPE html><html><head><meta charset='utf-8'><title>QC</title>",
+             "<style>body{font-family:sans-serif;background:#111;color:#ddd}"
+             "figure{margin:0 0 24px}img{max-width:100%}.err{color:#f66}</style></head><body>",
+             f"<h1>QC: {len(results)} subjects</h1>"]
+    failed = [r for r in results if r["error"]]
+    if failed:
+        parts.append(f"<h2 class='err'>{len(failed)} without mosaic</h2><ul>")
+        parts += [f"<li>{html.escape(r['output_dir'])}: {html.escape(r['error'])}</li>" for r in failed]
+        parts.append("</ul>")
+    for r in results:
+        if r["png"]:
+            rel = os.path.relpath(r["png"], qc_dir)
+            parts.append(f"<figure><figcaption>{html.escape(r['output_dir'])}</figcaption>"
+                         f"<a href='{html.escape(rel)}'><img loading='lazy' src='{html.escape(rel)}'></a></figure>")
+    parts.append("</body></html>")
+    index_path = os.path.join(qc_dir, "index.html")
+    with open(index_path, "w") as f:
+        f.write("\n".join(parts))
+    return index_path
+
+
+def _render_safe(output_dir, png_path, images, mask_name):
+    try:
+        return render_subject(output_dir, png_path, images, mask_name)
+    except Exception as e:
+        return {"output_dir": output_dir, "png": None, "images": {}, "error": str(e)}
+
+
+def render_batch(output_dirs, qc_dir=QC_DIR, images=QC_IMAGES, mask_name=MASK_NAME,
+                 workers=None, overwrite=False):
+    os.makedirs(qc_dir, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for d in output_dirs:
+            png = os.path.join(qc_dir, f"{job_id_for(os.path.join(d, MASK_NAME))}.png")
+            if os.path.exists(png) and not overwrite:
+                results.append({"output_dir": d, "png": png, "images": {}, "error": None})
+                continue
+            futures.append(pool.submit(_render_safe, d, png, images, mask_name))
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Rendering QC"):
+            results.append(fut.result())
+    return results, write_index(qc_dir, results)
+
+
+def read_paths_from_file(filepath):
+    with open(filepath, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render QC mosaics for all output directories.")
+    parser.add_argument("--outputs", default=OUTPUT_DIR_LIST)
+    parser.add_argument("--qc-dir", default=QC_DIR)
+    parser.add_argument("--images", nargs="*", default=QC_IMAGES)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
+
+    results, index = render_batch(read_paths_from_file(args.outputs), args.qc_dir, args.images,
+                                  workers=args.workers, overwrite=args.overwrite)
+    failed = sum(1 for r in results if r["error"])
+    print(f"QC written to {index}: {len(results) - failed} mosaics, {failed} failed.")
@@ -1,24 +1,149 @@
 #!/usr/bin/env python3
+# Gathers every *_reg_0000.nii.gz under a tree into one folder for segment.py.
+#
+# segment.py only reads these files, so by default they are hardlinked (same
+# inode, no data copied). Other modes: 'reflink' (copy-on-write clone, e.g.
+# btrfs/XFS), 'symlink' and 'copy'. Hardlinks and reflinks fall back to a copy
+# when they are not possible (different filesystem, unsupported filesystem);
+# the copies run on a thread pool. Files already in the destination with the
+# same size and mtime are skipped, so re-running is cheap.
 import os
+import errno
 import shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def copy_reg0000_files(src_root, dst_dir):
-    os.makedirs(dst_dir, exist_ok=True)
+# --- Configuration ---
+SUFFIX = '_reg_0000.nii.gz'
+DEFAULT_MODE = 'hardlink'
+COPY_THREADS = 8
+# --- End Configuration ---
+
+MODES = ('hardlink', 'reflink', 'symlink', 'copy')
+_FICLONE = 0x40049409  # Linux ioctl, <linux/fs.h>
+# errnos meaning "cannot link/clone here, copy instead"
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP,
+                    errno.EINVAL, errno.ENOTTY, errno.EBADF}
+
+
+def find_reg0000_files(src_root, suffix=SUFFIX):
+    """(src_path, fname) for every matching file under src_root."""
     for root, _, files in os.walk(src_root):
         for fname in files:
-            if fname.endswith('_reg_0000.nii.gz'):
-                src_path = os.path.join(root, fname)
-                dst_path = os.path.join(dst_dir, fname)
-                print(f"Copying {src_path} → {dst_path}")
-                shutil.copy2(src_path, dst_path)
+            if fname.endswith(suffix):
+                yield os.path.join(root, fname), fname
+
+
+def is_current(src_path, dst_path, mode):
+    """True if dst already matches src (same size and mtime, or the right symlink)."""
+    if mode == 'symlink' and os.path.islink(dst_path):
+        return os.readlink(dst_path) == os.path.abspath(src_path)
+    try:
+        src, dst = os.stat(src_path), os.lstat(dst_path)
+    except FileNotFoundError:
+        return False
+    return src.st_size == dst.st_size and int(src.st_mtime) == int(dst.st_mtime)
+
+
+def _reflink(src_path, dst_path):
+    import fcntl
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.unlink(dst_path)
+            raise
+    shutil.copystat(src_path, dst_path)
+
+
+def _copy(src_path, dst_path):
+    shutil.copy2(src_path, dst_path)
+
+
+def place_file(src_path, dst_path, mode):
+    """
+    Put src at dst using `mode`. Links are created at a temporary name and
+    renamed over dst. Returns the mode actually used, or 'copy-needed' when a
+    link/clone failed and the file has to be copied.
+    """
+    tmp = f"{dst_path}.tmp{os.getpid()}"
+    try:
+        if mode == 'hardlink':
+            os.link(src_path, tmp)
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(src_path), tmp)
+        elif mode == 'reflink':
+            _reflink(src_path, tmp)
+        else:
+            _copy(src_path, tmp)
+    except OSError as e:
+        if mode in ('hardlink', 'reflink') and e.errno in _FALLBACK_ERRNOS:
+            return 'copy-needed'
+        raise
+    os.replace(tmp, dst_path)
+    return mode
+
+
+def copy_in_place(src_path, dst_path):
+    tmp = f"{dst_path}.tmp{os.getpid()}"
+    _copy(src_path, tmp)
+    os.replace(tmp, dst_path)
+    return 'copy'
+
+
+def copy_reg0000_files(src_root, dst_dir, mode=DEFAULT_MODE, threads=COPY_THREADS):
+    """Link/clone/copy every *_reg_0000.nii.gz under src_root into dst_dir; returns counts per outcome."""
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}; expected one of {MODES}")
+    os.makedirs(dst_dir, exist_ok=True)
+    counts = {'skipped': 0, 'failed': 0}
+    to_copy = []
+    for src_path, fname in find_reg0000_files(src_root):
+        dst_path = os.path.join(dst_dir, fname)
+        if is_current(src_path, dst_path, mode):
+            counts['skipped'] += 1
+            continue
+        if mode == 'copy':
+            to_copy.append((src_path, dst_path))
+            continue
+        try:
+            used = place_file(src_path, dst_path, mode)
+        except OSError as e:
+            print(f"Error placing {src_path}: {e}")
+            counts['failed'] += 1
+            continue
+        if used == 'copy-needed':
+            to_copy.append((src_path, dst_path))
+        else:
+            counts[used] = counts.get(used, 0) + 1
+
+    if to_copy:
+        print(f"Copying {len(to_copy)} files with {threads} threads...")
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = {pool.submit(copy_in_place, s, d): s for s, d in to_copy}
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                    counts['copy'] = counts.get('copy', 0) + 1
+                except OSError as e:
+                    print(f"Error copying {futures[fut]}: {e}")
+                    counts['failed'] += 1
+
+    summary = ", ".join(f"{n} {k}" for k, n in counts.items() if n or k in ('skipped', 'failed'))
+    print(f"Gathered into {dst_dir}: {summary}.")
+    return counts
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Recursively copy all *_reg_0000.nii.gz files to one folder."
+        description="Recursively gather all *_reg_0000.nii.gz files into one folder."
     )
     parser.add_argument("--source", help="Root directory to search")
-    parser.add_argument("--dest",   help="Destination directory to copy files into")
+    parser.add_argument("--dest",   help="Destination directory to place files into")
+    parser.add_argument("--mode", choices=MODES, default=DEFAULT_MODE,
+                        help="hardlink/reflink fall back to copying across filesystems")
+    parser.add_argument("--threads", type=int, default=COPY_THREADS, help="Copy threads")
     args = parser.parse_args()
 
-    copy_reg0000_files(args.source, args.dest)
+    copy_reg0000_files(args.source, args.dest, args.mode, args.threads)
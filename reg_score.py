@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Batch registration-quality scoring against the MNI152 template.
+#
+# For every output directory the registered image (normalized.nii.gz) is
+# compared with the template and the subject mask (mask.nii.gz) with the
+# template brain, on the 2 mm level of the affine_reg pyramid:
+#   ncc   normalized cross-correlation where the template brain and the
+#         subject foreground (mask.nii.gz, else nonzero image voxels) overlap
+#   mi    mutual information (32x32 joint histogram) over the same voxels
+#   dice  overlap of mask.nii.gz with the template brain mask
+# The intensity metrics leave out template-brain voxels the subject image
+# zero-fills outside its own mask; how much of the brain the subject covers is
+# what dice measures.
+# The template level, its brain mask and the world coordinates of its voxels
+# are built once (in the parent, so forked workers share them; each worker's
+# initializer keeps them cached otherwise). Per subject, the image is
+# smoothed/subsampled with the same pyramid code and interpolated at those
+# points, so scoring costs a fraction of a second.
+#
+# Outliers are flagged per metric with a robust z-score (median / MAD over the
+# batch) below -OUTLIER_Z, or an absolute floor:
+#   python reg_score.py --outputs output_paths.txt --csv registration_scores.csv
+
+import os
+import csv
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+from tqdm import tqdm
+
+from affine_reg import HIST_BINS, _Trilinear, _quantize, build_pyramid, load_template
+from propagate import read_paths_from_file
+
+# --- Configuration ---
+OUTPUT_DIR_LIST = "./output_paths.txt"
+TEMPLATE_FILE = "MNI152_T1_1mm_brain.nii.gz"
+IMAGE_NAME = "normalized.nii.gz"
+MASK_NAME = "mask.nii.gz"
+SCORE_MM = 2.0
+OUTLIER_Z = 3.5
+MIN_SCORES = {"ncc": 0.5, "dice": 0.8}   # absolute floors, flagged regardless of the batch
+CSV_FILE = "registration_scores.csv"
+# --- End Configuration ---
+
+_grid = {}
+
+
+class ScoreGrid:
+    """Template level used for scoring: intensities, brain mask and voxel world coordinates."""
+
+    def __init__(self, template_path=TEMPLATE_FILE, score_mm=SCORE_MM):
+        img, pyramid = load_template(template_path, (score_mm,))
+        level = pyramid[0]
+        factors = np.rint(np.linalg.norm(level.affine[:3, :3], axis=0) /
+                          np.linalg.norm(img.affine[:3, :3], axis=0)).astype(int)
+        full = np.asanyarray(img.dataobj)
+        self.brain = np.ascontiguousarray(full[::factors[0], ::factors[1], ::factors[2]] > 0)[
+            tuple(slice(0, s) for s in level.data.shape)]
+        self.shape = level.data.shape
+        vox = np.indices(self.shape, dtype=np.float64).reshape(3, -1)
+        self.world = level.affine[:3, :3] @ vox + level.affine[:3, 3:4]
+        self.brain_flat = self.brain.ravel()
+        self.fixed = level.data.ravel()[self.brain_flat].astype(np.float64)
+        lo, hi = np.percentile(self.fixed, [1, 99])
+        self.fixed_q = _quantize(self.fixed, lo, hi, HIST_BINS)
+        self.score_mm = score_mm
+
+
+def score_grid(template_path=TEMPLATE_FILE, score_mm=SCORE_MM):
+    key = (os.path.abspath(template_path), score_mm)
+    if key not in _grid:
+        _grid[key] = ScoreGrid(template_path, score_mm)
+    return _grid[key]
+
+
+def _init_worker(template_path, score_mm):
+    score_grid(template_path, score_mm)
+
+
+def _voxel_coords(world, affine):
+    inv = np.linalg.inv(affine)
+    return inv[:3, :3] @ world + inv[:3, 3:4]
+
+
+def mutual_information(fixed_q, moving_q, bins=HIST_BINS):
+    joint = np.bincount(fixed_q * bins + moving_q, minlength=bins * bins).reshape(bins, bins)
+    pxy = joint / max(joint.sum(), 1)
+    px = pxy.sum(axis=1, keepdims=True)
+    py = pxy.sum(axis=0, keepdims=True)
+    nz = pxy > 0
+    return float(np.sum(pxy[nz] * np.log(pxy[nz] / (px @ py)[nz])))
+
+
+def score_output(output_dir, template_path=TEMPLATE_FILE, score_mm=SCORE_MM,
+                 image_name=IMAGE_NAME, mask_name=MASK_NAME):
+    """{'ncc', 'mi', 'dice', 'coverage'} for one output directory (missing files give None)."""
+    grid = score_grid(template_path, score_mm)
+    scores = {"output_dir": output_dir, "ncc": None, "mi": None, "dice": None, "coverage": None}
+
+    subject = None
+    mask_path = os.path.join(output_dir, mask_name)
+    if os.path.exists(mask_path):
+        mimg = nib.load(mask_path)
+        mdata = np.asanyarray(mimg.dataobj)
+        idx = np.rint(_voxel_coords(grid.world, mimg.affine)).astype(np.intp)
+        inside = np.all((idx >= 0) & (idx < np.array(mdata.shape[:3])[:, None]), axis=0)
+        subject = np.zeros(idx.shape[1], dtype=bool)
+        subject[inside] = mdata[tuple(idx[:, inside])] > 0
+        total = subject.sum() + grid.brain_flat.sum()
+        scores["dice"] = float(2 * np.count_nonzero(subject & grid.brain_flat) / total) if total else None
+
+    image_path = os.path.join(output_dir, image_name)
+    if os.path.exists(image_path):
+        img = nib.load(image_path)
+        level = build_pyramid(img.get_fdata(dtype=np.float32), img.affine, (score_mm,))[0]
+        coords = _voxel_coords(grid.world[:, grid.brain_flat], level.affine)
+        interp = _Trilinear(level.data)
+        inside = interp.inside(coords)
+        scores["coverage"] = float(inside.mean())
+        vals = np.zeros(inside.size, dtype=np.float64)
+        if inside.any():
+            vals[inside] = interp(coords[:, inside])
+        # Template brain ∩ subject foreground: zero fill outside the subject's
+        # mask is not misregistration
+        fg = inside & (subject[grid.brain_flat] if subject is not None else vals != 0)
+        if fg.sum() > 10:
+            f, m = grid.fixed[fg], vals[fg]
+            f = (f - f.mean()) / (f.std() + 1e-9)
+            m = (m - m.mean()) / (m.std() + 1e-9)
+            scores["ncc"] = float(np.mean(f * m))
+            lo, hi = np.percentile(m, [1, 99])
+            scores["mi"] = mutual_information(grid.fixed_q[fg], _quantize(m, lo, hi, HIST_BINS))
+    return scores
+
+
+def flag_outliers(rows, z=OUTLIER_Z, floors=MIN_SCORES, metrics=("ncc", "mi", "dice")):
+    """Add a 'flags' entry to every row: low robust z-scores, floor violations, missing files."""
+    stats = {}
+    for metric in metrics:
+        vals = np.array([r[metric] for r in rows if r[metric] is not None], dtype=np.float64)
+        if vals.size:
+            med = np.median(vals)
+            mad = 1.4826 * np.median(np.abs(vals - med))
+            stats[metric] = (med, mad if mad > 0 else 1e-9)
+    for row in rows:
+        flags = []
+        for metric in metrics:
+            value = row[metric]
+            if value is None:
+                flags.append(f"{metric}:missing")
+                continue
+            med, mad = stats[metric]
+            if (value - med) / mad < -z:
+                flags.append(f"{metric}:z={(value - med) / mad:.1f}")
+            if metric in floors and value < floors[metric]:
+                flags.append(f"{metric}<{floors[metric]}")
+        row["flags"] = ";".join(flags)
+    return rows
+
+
+def score_batch(output_dirs, template_path=TEMPLATE_FILE, score_mm=SCORE_MM, workers=None):
+    """Score every output directory across a process pool; returns rows with flags."""
+    score_grid(template_path, score_mm)  # built before forking, shared copy-on-write
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(template_path, score_mm)) as pool:
+        futures = {pool.submit(score_output, d, template_path, score_mm): d for d in output_dirs}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc="Scoring"):
+            try:
+                rows.append(fut.result())
+            except Exception as e:
+                print(f"Error scoring {futures[fut]}: {e}")
+                rows.append({"output_dir": futures[fut], "ncc": None, "mi": None, "dice": None,
+                             "coverage": None})
+    rows.sort(key=lambda r: r["output_dir"])
+    return flag_outliers(rows)
+
+
+def write_scores(rows, csv_path):
+    columns = ["output_dir", "ncc", "mi", "dice", "coverage", "flags"]
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score registration quality of pipeline outputs against MNI152.")
+    parser.add_argument("--outputs", default=OUTPUT_DIR_LIST, help="List of output directories")
+    parser.add_argument("--parent-dir", help="Score every subdirectory of this folder instead")
+    parser.add_argument("--template", default=TEMPLATE_FILE)
+    parser.add_argument("--score-mm", type=float, default=SCORE_MM)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--csv", default=CSV_FILE)
+    args = parser.parse_args()
+
+    if args.parent_dir:
+        dirs = sorted(os.path.join(args.parent_dir, d) for d in os.listdir(args.parent_dir)
+                      if os.path.isdir(os.path.join(args.parent_dir, d)))
+    else:
+        dirs = read_paths_from_file(args.outputs)
+    rows = score_batch(dirs, args.template, args.score_mm, args.workers)
+    write_scores(rows, args.csv)
+    flagged = [r for r in rows if r["flags"]]
+    print(f"Scored {len(rows)} outputs -> {args.csv}; {len(flagged)} flagged:")
+    for r in flagged:
+        print(f"  {r['output_dir']}: {r['flags']}")
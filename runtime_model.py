@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Runtime prediction for batch jobs.
+#
+# Every finished job is appended to a JSON-lines history together with cheap
+# header-only features of its input (voxel count, spacing, field of view). A
+# small ridge regression per tool turns that history into predicted durations,
+# which the scheduler uses to start the longest jobs first (LPT) and to
+# estimate the time left in the batch (ResourceScheduler.eta_seconds).
+
+import os
+import json
+
+import numpy as np
+import nibabel as nib
+
+HISTORY_FILE = "job_history.jsonl"
+# Samples needed before the regression is trusted over the per-voxel rate
+MIN_SAMPLES = 8
+RIDGE = 1e-3
+
+
+def header_features(path):
+    """Features read from the NIfTI header only (no voxel data is decoded)."""
+    header = nib.load(path).header
+    shape = header.get_data_shape()[:3]
+    zooms = header.get_zooms()[:3]
+    voxels = float(np.prod(shape))
+    return {
+        "mvox": voxels / 1e6,
+        "spacing_mm": float(np.mean(zooms)),
+        "fov_l": voxels * float(np.prod(zooms)) / 1e6,
+    }
+
+
+def _design(feats):
+    return [1.0, feats["mvox"], feats["fov_l"], feats["mvox"] / max(feats["spacing_mm"], 1e-3)]
+
+
+class RuntimeModel:
+    def __init__(self, history_path=HISTORY_FILE):
+        self.history_path = history_path
+        self.samples = {}  # tool -> list of (features, seconds)
+        self._coef = {}
+        if history_path and os.path.isfile(history_path):
+            with open(history_path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    if rec.get("ok"):
+                        self.samples.setdefault(rec["tool"], []).append((rec["features"], rec["seconds"]))
+
+    def record(self, tool, key, features, seconds, ok):
+        if features is None:
+            return
+        with open(self.history_path, "a") as f:
+            f.write(json.dumps({"tool": tool, "key": key, "features": features,
+                                "seconds": round(seconds, 2), "ok": ok}) + "\n")
+        if ok:
+            self.samples.setdefault(tool, []).append((features, seconds))
+            self._coef.pop(tool, None)
+
+    def _fit(self, tool):
+        if tool not in self._coef:
+            samples = self.samples.get(tool, [])
+            if len(samples) >= MIN_SAMPLES:
+                X = np.array([_design(f) for f, _ in samples])
+                y = np.array([s for _, s in samples])
+                A = X.T @ X + RIDGE * np.eye(X.shape[1]) * np.trace(X.T @ X) / X.shape[1]
+                self._coef[tool] = ("ridge", np.linalg.solve(A, X.T @ y), float(y.min()))
+            elif samples:
+                rate = np.median([s / max(f["mvox"], 1e-6) for f, s in samples])
+                self._coef[tool] = ("rate", rate, 0.0)
+            else:
+                self._coef[tool] = ("rate", 1.0, 0.0)
+        return self._coef[tool]
+
+    def predict(self, tool, features):
+        kind, coef, floor = self._fit(tool)
+        if kind == "rate":
+            return coef * features["mvox"]
+        return max(float(np.dot(coef, _design(features))), 0.5 * floor)
+
+    def annotate(self, jobs, path_of=lambda job: job.key):
+        """Attach features and predicted seconds to each job's meta."""
+        for job in jobs:
+            try:
+                feats = header_features(path_of(job))
+            except Exception:
+                feats = None
+            job.meta["features"] = feats
+            job.meta["predicted_s"] = self.predict(job.tool, feats) if feats else 0.0
+        return jobs
@@ -0,0 +1,643 @@
+#!/usr/bin/env python3
+# Resource-aware runner for the external tools (TurboPrep, SynthSeg, Docker).
+#
+# Every job names a tool; each tool has a profile with its expected peak memory
+# and thread count. A job is admitted only while the memory and threads of the
+# running jobs plus the new one fit the node's budget, and each child gets its
+# thread-count environment variables set to its share so concurrent jobs don't
+# oversubscribe the cores. Peak RSS of every finished job is sampled from /proc
+# and, for tools that allow it, fed back into the profile (persisted to JSON)
+# so the memory estimates converge to what the tools actually use.
+#
+# Jobs run in their own process group with a wall-clock timeout; on expiry the
+# whole tree is killed (plus any Docker container the job started, via its
+# cleanup hook). Failed jobs are retried with exponential backoff, and jobs
+# that exhaust their attempts go to a persistent quarantine so later runs skip
+# them instead of burning worker slots.
+#
+# Given a MetricsExporter (metrics_exporter.py), the scheduler counts every
+# attempt by outcome, records per-tool latencies and exposes its queue depth,
+# jobs in flight and their RSS on every metrics refresh.
+
+import os
+import json
+import heapq
+import hashlib
+import queue
+import random
+import signal
+import tempfile
+import threading
+import subprocess
+import time
+
+# Environment variables honoured by OpenMP/BLAS/ITK/TensorFlow based tools
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+    "TF_NUM_INTEROP_THREADS",
+]
+
+# Safety margin applied to learned peak memory
+LEARN_MARGIN = 1.2
+# Number of recent peaks kept per tool
+LEARN_WINDOW = 20
+# Seconds between SIGTERM and SIGKILL when a job times out
+KILL_GRACE_S = 15
+
+
+class ToolProfile:
+    """Expected per-job footprint of one external tool."""
+
+    def __init__(self, mem_gb, threads, max_concurrent=None, learn=True, timeout_s=None):
+        self.mem_gb = float(mem_gb)
+        self.threads = int(threads)
+        self.max_concurrent = max_concurrent
+        self.timeout_s = timeout_s
+        # Docker clients don't show the container's memory in their process tree,
+        # so their cost must be declared rather than learned
+        self.learn = learn
+        self.observed_peaks = []
+
+    def record_peak(self, peak_gb):
+        if not self.learn or peak_gb <= 0:
+            return
+        self.observed_peaks = (self.observed_peaks + [peak_gb])[-LEARN_WINDOW:]
+        self.mem_gb = max(self.observed_peaks) * LEARN_MARGIN
+
+    def to_dict(self):
+        return {"mem_gb": round(self.mem_gb, 3), "threads": self.threads,
+                "max_concurrent": self.max_concurrent, "learn": self.learn,
+                "timeout_s": self.timeout_s,
+                "observed_peaks": [round(p, 3) for p in self.observed_peaks]}
+
+    @classmethod
+    def from_dict(cls, d):
+        profile = cls(d["mem_gb"], d["threads"], d.get("max_concurrent"), d.get("learn", True),
+                      d.get("timeout_s"))
+        profile.observed_peaks = list(d.get("observed_peaks", []))
+        return profile
+
+
+DEFAULT_PROFILES = {
+    # turboprep-docker wraps a container, so its footprint can't be sampled
+    "turboprep": ToolProfile(mem_gb=8, threads=4, learn=False, timeout_s=2 * 3600),
+    "turboprep_gpu": ToolProfile(mem_gb=8, threads=4, max_concurrent=2, learn=False, timeout_s=3600),
+    "synthseg": ToolProfile(mem_gb=6, threads=8, timeout_s=3600),
+}
+
+
+class Job:
+    """
+    One external command. `{threads}` in the command is replaced by the thread
+    count granted to the job at launch. `timeout_s` overrides the tool's
+    timeout; `cleanup` is called after the process tree of a timed-out attempt
+    has been killed (e.g. to stop a Docker container the job started).
+    `prepare`, if given, runs on the job's worker thread right before each
+    launch (e.g. to wait for its inputs to be staged, see staging.py).
+    """
+
+    def __init__(self, key, tool, command, shell=False, meta=None, timeout_s=None, cleanup=None,
+                 prepare=None):
+        self.key = key
+        self.tool = tool
+        self.command = command
+        self.shell = shell
+        self.meta = meta or {}
+        self.timeout_s = timeout_s
+        self.cleanup = cleanup
+        self.prepare = prepare
+        self.attempts = 0
+        self.history = []  # one short description per failed attempt
+
+
+class JobResult:
+    def __init__(self, job, returncode, stdout, stderr, seconds, peak_rss_gb, error=None, command=None,
+                 timed_out=False):
+        self.job = job
+        # The command as launched, with `{threads}` filled in
+        self.command = command if command is not None else job.command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+        self.peak_rss_gb = peak_rss_gb
+        self.error = error
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.error is None and not self.timed_out and self.returncode == 0
+
+    @property
+    def attempts(self):
+        return self.job.attempts
+
+    def describe(self):
+        if self.timed_out:
+            return f"timed out after {self.seconds:.0f}s"
+        if self.error is not None:
+            return f"error: {self.error}"
+        return f"exit code {self.returncode}"
+
+
+class Quarantine:
+    """
+    Persistent record of jobs that failed all their attempts. A job is skipped
+    once it has failed in `after_failures` runs, until released or until it
+    succeeds (e.g. when run by hand).
+    """
+
+    def __init__(self, path, after_failures=1):
+        self.path = path
+        self.after_failures = after_failures
+        self.entries = {}
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_quarantined(self, key):
+        return self.entries.get(key, {}).get("failures", 0) >= self.after_failures
+
+    def filter(self, jobs):
+        """Split jobs into (runnable, quarantined)."""
+        runnable, skipped = [], []
+        for job in jobs:
+            (skipped if self.is_quarantined(job.key) else runnable).append(job)
+        return runnable, skipped
+
+    def record_failure(self, key, reason):
+        entry = self.entries.setdefault(key, {"failures": 0})
+        entry["failures"] += 1
+        entry["last_error"] = reason
+        entry["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.save()
+
+    def record_success(self, key):
+        if self.entries.pop(key, None) is not None:
+            self.save()
+
+    def release(self, keys=None):
+        for key in list(self.entries if keys is None else keys):
+            self.entries.pop(key, None)
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+def read_meminfo():
+    """Return (MemTotal, MemAvailable) in GB."""
+    info = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                info[name] = int(value.split()[0]) / 1024 ** 2
+        return info["MemTotal"], info.get("MemAvailable", info.get("MemFree", 0.0))
+    except (OSError, KeyError, ValueError):
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+        return total, total
+
+
+def _children(pid):
+    kids = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                kids.extend(int(c) for c in f.read().split())
+    except OSError:
+        pass
+    return kids
+
+
+def process_tree_rss_gb(pid):
+    """Resident memory of a process and all of its descendants, in GB."""
+    total_kb = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+        stack.extend(_children(p))
+    return total_kb / 1024 ** 2
+
+
+def kill_process_tree(proc, grace_s=KILL_GRACE_S):
+    """
+    Terminate a job started with start_new_session=True: SIGTERM its process
+    group, then SIGKILL the group and any descendants that left it.
+    """
+    descendants = []
+    stack = [proc.pid]
+    while stack:
+        kids = _children(stack.pop())
+        descendants.extend(kids)
+        stack.extend(kids)
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    try:
+        proc.wait(timeout=grace_s)
+    except subprocess.TimeoutExpired:
+        pass
+    for pid in [proc.pid] + descendants:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+
+
+def kill_containers_mounting(host_path):
+    """
+    Kill running Docker containers that bind-mount `host_path`. Killing the
+    `docker run` client does not stop its container, and the turboprep-docker
+    wrapper doesn't name its containers, so we find them by their mounts.
+    """
+    host_path = os.path.abspath(host_path).rstrip("/")
+    ids = subprocess.run(["docker", "ps", "-q"], capture_output=True, text=True).stdout.split()
+    if not ids:
+        return
+    # Mounts as JSON: sources may contain spaces (/mnt/d/My Data/...)
+    inspect = subprocess.run(["docker", "inspect", "--format", "{{.Id}}\t{{json .Mounts}}"] + ids,
+                             capture_output=True, text=True)
+    for line in inspect.stdout.splitlines():
+        container, _, mounts = line.partition("\t")
+        try:
+            sources = [m.get("Source", "").rstrip("/") for m in json.loads(mounts or "[]")]
+        except ValueError:
+            continue
+        if host_path in sources:
+            subprocess.run(["docker", "kill", container], capture_output=True)
+
+
+def container_label(key):
+    """`docker run --label` value identifying the container of job `key`."""
+    return f"pipeline.job={hashlib.sha1(str(key).encode()).hexdigest()[:16]}"
+
+
+def kill_containers_labelled(label):
+    """Kill running containers started with `--label <label>`."""
+    ids = subprocess.run(["docker", "ps", "-q", "--filter", f"label={label}"],
+                         capture_output=True, text=True).stdout.split()
+    if ids:
+        subprocess.run(["docker", "kill"] + ids, capture_output=True)
+
+
+def thread_env(threads, base=None):
+    env = dict(os.environ if base is None else base)
+    for var in THREAD_ENV_VARS:
+        env[var] = str(threads)
+    return env
+
+
+def docker_limits(profile):
+    """
+    `docker run` flags that carry a profile's budget into the container; the
+    container doesn't inherit our environment, so thread counts go in via -e.
+    Memory is a soft reservation, not a cap: a subject that needs more than
+    the profile estimate should still finish rather than be OOM-killed.
+    """
+    flags = ["--cpus", "{threads}", "--memory-reservation", f"{int(profile.mem_gb * 1024)}m"]
+    for var in THREAD_ENV_VARS:
+        flags += ["-e", f"{var}={{threads}}"]
+    return flags
+
+
+class _Slot:
+    """Book-keeping for one running job."""
+
+    def __init__(self, job, profile, threads):
+        self.job = job
+        self.profile = profile
+        self.reserved_gb = profile.mem_gb
+        self.threads = threads
+        self.rss_gb = 0.0
+        self.peak_rss_gb = 0.0
+        self.started = time.monotonic()
+
+
+class ResourceScheduler:
+    """
+    Runs jobs concurrently under a memory and thread budget.
+
+    mem_budget_gb defaults to 90% of the memory available at start-up and
+    cpu_budget to the number of cores. Jobs are admitted first-fit, so a small
+    job may overtake a large one that is waiting for memory. A failed attempt is
+    retried up to `max_attempts` times in total, waiting backoff_s * 2**n
+    (with jitter) before attempt n+1; only the final attempt is yielded.
+    """
+
+    def __init__(self, profiles=None, mem_budget_gb=None, cpu_budget=None,
+                 profile_path=None, poll_interval=2.0, max_attempts=3, backoff_s=30.0,
+                 quarantine=None, metrics=None):
+        self.profiles = {k: ToolProfile.from_dict(v.to_dict())
+                         for k, v in (profiles or DEFAULT_PROFILES).items()}
+        self.profile_path = profile_path
+        if profile_path and os.path.isfile(profile_path):
+            with open(profile_path) as f:
+                for name, d in json.load(f).items():
+                    self.profiles[name] = ToolProfile.from_dict(d)
+
+        _, available = read_meminfo()
+        self.mem_budget_gb = mem_budget_gb if mem_budget_gb is not None else 0.9 * available
+        self.cpu_budget = cpu_budget if cpu_budget is not None else (os.cpu_count() or 1)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.quarantine = quarantine
+
+        self._running = {}  # job key -> _Slot
+        self._not_before = {}  # job key -> earliest retry time
+        self._pending = []
+        # Observed vs predicted seconds of finished jobs, to calibrate the ETA
+        self._actual_s = 0.0
+        self._predicted_s = 0.0
+        self._results = queue.Queue()
+        self.metrics = None
+        if metrics is not None:
+            self._init_metrics(metrics)
+
+    # --- Admission ---
+    def profile_for(self, job):
+        if job.tool not in self.profiles:
+            raise KeyError(f"No resource profile for tool '{job.tool}'")
+        return self.profiles[job.tool]
+
+    def _granted_threads(self, profile):
+        return max(1, min(profile.threads, self.cpu_budget))
+
+    def fits(self, job, planned=()):
+        """
+        Whether `job` would be admitted now. `planned` names the tools of jobs
+        about to be launched ahead of it, which count as running but untouched.
+        """
+        profile = self.profile_for(job)
+        slots = list(self._running.values())
+        planned = [self.profiles[tool] for tool in planned]
+        if not slots and not planned:
+            # Never starve: a job larger than the whole budget runs alone
+            return True
+        if profile.max_concurrent is not None:
+            same_tool = sum(1 for s in slots if s.job.tool == job.tool)
+            same_tool += sum(1 for p in planned if p is profile)
+            if same_tool >= profile.max_concurrent:
+                return False
+        reserved = sum(s.reserved_gb for s in slots) + sum(p.mem_gb for p in planned)
+        threads = sum(s.threads for s in slots) + sum(self._granted_threads(p) for p in planned)
+        if reserved + profile.mem_gb > self.mem_budget_gb:
+            return False
+        if threads + self._granted_threads(profile) > self.cpu_budget:
+            return False
+        # Memory the running jobs have reserved but not touched yet is not free.
+        # Containers (learn=False) have no RSS we can see, but MemAvailable
+        # already reflects their real usage, so they are not counted twice.
+        _, available = read_meminfo()
+        unrealized = sum(max(0.0, s.reserved_gb - s.rss_gb) for s in slots if s.profile.learn)
+        unrealized += sum(p.mem_gb for p in planned)
+        return available - unrealized >= profile.mem_gb
+
+    # --- Execution ---
+    def _format_command(self, job, threads):
+        if isinstance(job.command, str):
+            return job.command.replace("{threads}", str(threads))
+        return [str(arg).replace("{threads}", str(threads)) for arg in job.command]
+
+    def _launch(self, job):
+        profile = self.profile_for(job)
+        slot = _Slot(job, profile, self._granted_threads(profile))
+        self._running[job.key] = slot
+        command = self._format_command(job, slot.threads)
+        worker = threading.Thread(target=self._run_job, args=(slot, command), daemon=True)
+        worker.start()
+
+    def _run_job(self, slot, command):
+        job = slot.job
+        timeout_s = job.timeout_s if job.timeout_s is not None else slot.profile.timeout_s
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            if job.prepare is not None:
+                job.prepare()
+                start = time.perf_counter()
+            with tempfile.TemporaryFile(mode="w+") as out, tempfile.TemporaryFile(mode="w+") as err:
+                # Own session/process group so a timeout can take down the whole tree
+                proc = subprocess.Popen(command, stdout=out, stderr=err, text=True,
+                                        shell=job.shell, env=thread_env(slot.threads),
+                                        start_new_session=True)
+                while True:
+                    try:
+                        proc.wait(timeout=self.poll_interval)
+                        break
+                    except subprocess.TimeoutExpired:
+                        slot.rss_gb = process_tree_rss_gb(proc.pid)
+                        slot.peak_rss_gb = max(slot.peak_rss_gb, slot.rss_gb)
+                    if timeout_s is not None and time.perf_counter() - start > timeout_s:
+                        timed_out = True
+                        kill_process_tree(proc)
+                        if job.cleanup is not None:
+                            try:
+                                job.cleanup()
+                            except Exception as e:
+                                err.write(f"\n[scheduler] cleanup after timeout failed: {e}\n")
+                        break
+                out.seek(0)
+                err.seek(0)
+                result = JobResult(job, proc.returncode, out.read(), err.read(),
+                                   time.perf_counter() - start, slot.peak_rss_gb, command=command,
+                                   timed_out=timed_out)
+        except Exception as e:
+            result = JobResult(job, None, "", "", time.perf_counter() - start, slot.peak_rss_gb,
+                               error=e, command=command)
+        self._results.put(result)
+
+    def _finish(self, result):
+        """Release the job's slot; returns True if the result is final (no retry)."""
+        slot = self._running.pop(result.job.key)
+        job = result.job
+        if self.metrics is not None:
+            self._record_metrics(result)
+        if result.ok:
+            if job.meta.get("predicted_s"):
+                self._actual_s += result.seconds
+                self._predicted_s += job.meta["predicted_s"]
+            slot.profile.record_peak(result.peak_rss_gb)
+            self.save_profiles()
+            if self.quarantine is not None:
+                self.quarantine.record_success(job.key)
+            return True
+
+        job.history.append(result.describe())
+        if job.attempts < self.max_attempts:
+            delay = self.backoff_s * 2 ** (job.attempts - 1)
+            self._not_before[job.key] = time.monotonic() + delay * random.uniform(0.8, 1.2)
+            return False
+        if self.quarantine is not None:
+            self.quarantine.record_failure(job.key, "; ".join(job.history))
+        return True
+
+    # --- Metrics ---
+    def _init_metrics(self, metrics):
+        self.metrics = metrics
+        self._m_attempts = metrics.counter("jobs_total", "Finished attempts by tool and outcome "
+                                           "(success, retry, failure)", ("tool", "outcome"))
+        self._m_timeouts = metrics.counter("job_timeouts_total", "Attempts killed at their timeout", ("tool",))
+        self._m_seconds = metrics.histogram("job_seconds", "Wall time of successful jobs", ("tool",))
+        self._m_peak = metrics.gauge("job_peak_rss_bytes", "Peak RSS of the last finished job", ("tool",))
+        self._m_last = metrics.gauge("last_completion_timestamp_seconds", "When the last attempt finished")
+        self._m_pending = metrics.gauge("jobs_pending", "Jobs waiting for admission or a retry")
+        self._m_running = metrics.gauge("jobs_running", "Jobs in flight", ("tool",))
+        self._m_rss = metrics.gauge("job_rss_bytes", "RSS of each running job's process tree", ("tool", "job"))
+        self._m_reserved = metrics.gauge("memory_reserved_bytes", "Memory reserved by running jobs")
+        self._m_budget = metrics.gauge("memory_budget_bytes", "Scheduler memory budget")
+        self._m_threads = metrics.gauge("threads_reserved", "Threads granted to running jobs")
+        self._m_eta = metrics.gauge("eta_seconds", "Estimated seconds until pending and running jobs finish")
+        metrics.add_collector(self._collect_metrics)
+
+    def _record_metrics(self, result):
+        job = result.job
+        if result.ok:
+            outcome = "success"
+            self._m_seconds.observe(result.seconds, tool=job.tool)
+        else:
+            outcome = "retry" if job.attempts < self.max_attempts else "failure"
+        self._m_attempts.inc(tool=job.tool, outcome=outcome)
+        if result.timed_out:
+            self._m_timeouts.inc(tool=job.tool)
+        self._m_peak.set(result.peak_rss_gb * 1024 ** 3, tool=job.tool)
+        self._m_last.set(time.time())
+
+    def _collect_metrics(self):
+        """Refresh the live gauges; runs on the exporter's thread."""
+        slots = list(self._running.values())
+        self._m_pending.set(len(self._pending))
+        self._m_running.clear()
+        for tool in self.profiles:
+            self._m_running.set(sum(1 for s in slots if s.job.tool == tool), tool=tool)
+        self._m_rss.clear()
+        for s in slots:
+            self._m_rss.set(s.rss_gb * 1024 ** 3, tool=s.job.tool, job=os.path.basename(str(s.job.key)))
+        self._m_reserved.set(sum(s.reserved_gb for s in slots) * 1024 ** 3)
+        self._m_budget.set(self.mem_budget_gb * 1024 ** 3)
+        self._m_threads.set(sum(s.threads for s in slots))
+        self._m_eta.set(self.eta_seconds())
+
+    def save_profiles(self):
+        if not self.profile_path:
+            return
+        tmp = self.profile_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({k: v.to_dict() for k, v in self.profiles.items()}, f, indent=2)
+        os.replace(tmp, self.profile_path)
+
+    def has_capacity(self, tool, planned=()):
+        """Whether a new job of `tool` would be admitted right now (after the `planned` tools)."""
+        return self.fits(Job(None, tool, None), planned)
+
+    def run(self, jobs, refill=None):
+        """
+        Run `jobs` and yield a JobResult for each as it finishes. Jobs carrying
+        a `predicted_s` in their meta (see runtime_model.py) are started longest
+        first, which keeps the slowest subjects from landing at the tail.
+
+        `refill`, if given, is called whenever nothing is pending and should
+        return a list of new jobs (possibly empty for "nothing right now") or
+        None once no more jobs will ever come (see work_queue.py).
+        """
+        pending = launch_order(jobs)
+        self._pending = pending
+        keys = [j.key for j in pending]
+        if len(set(keys)) != len(keys):
+            raise ValueError("Job keys must be unique")
+
+        exhausted = refill is None
+        while pending or self._running or not exhausted:
+            if not pending and not exhausted:
+                more = refill()
+                if more is None:
+                    exhausted = True
+                else:
+                    pending.extend(more)
+            admitted = True
+            while admitted and pending:
+                admitted = False
+                blocked = set()  # a tool that didn't fit won't fit again in this pass
+                now = time.monotonic()
+                for i, job in enumerate(pending):
+                    if job.tool in blocked or self._not_before.get(job.key, 0) > now:
+                        continue
+                    if self.fits(job):
+                        job = pending.pop(i)
+                        job.attempts += 1
+                        self._launch(job)
+                        admitted = True
+                        break
+                    blocked.add(job.tool)
+            try:
+                result = self._results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if self._finish(result):
+                yield result
+            else:
+                pending.append(result.job)
+
+    def eta_seconds(self):
+        """Estimated seconds until all pending and running jobs are done."""
+        scale = self._actual_s / self._predicted_s if self._predicted_s > 0 else 1.0
+        now = time.monotonic()
+        busy = [max(0.0, s.job.meta.get("predicted_s", 0.0) * scale - (now - s.started))
+                for s in self._running.values()]
+        remaining = [j.meta.get("predicted_s", 0.0) * scale for j in self._pending]
+        return estimate_makespan(remaining, max(1, len(self._running)), busy)
+
+    def describe(self):
+        return (f"memory budget {self.mem_budget_gb:.1f} GB, {self.cpu_budget} threads; "
+                + ", ".join(f"{k}: {p.mem_gb:.1f} GB x{p.threads}" for k, p in self.profiles.items()))
+
+
+def launch_order(jobs):
+    """The order ResourceScheduler.run starts jobs in: longest predicted first."""
+    # sorted() is stable, so jobs without predictions keep their file order
+    return sorted(jobs, key=lambda j: -j.meta.get("predicted_s", 0.0))
+
+
+def estimate_makespan(durations, slots, busy=()):
+    """
+    Greedy list-scheduling estimate of the time to finish `durations` on
+    `slots` parallel workers, some of which are `busy` for the given seconds.
+    """
+    slots = max(1, slots)
+    heap = sorted(list(busy)[:slots] + [0.0] * max(0, slots - len(busy)))
+    for d in sorted(durations, reverse=True):
+        heapq.heappush(heap, heapq.heappop(heap) + d)
+    return max(heap) if heap else 0.0
+
+
+def format_eta(seconds):
+    seconds = int(max(0, seconds))
+    hours, rem = divmod(seconds, 3600)
+    minutes, secs = divmod(rem, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{secs:02d}s"
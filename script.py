@@ -1,8 +1,13 @@
 import os
-import subprocess
 import sys
 from tqdm import tqdm
 
+from metrics_exporter import exporter_from_config, track_queue
+from scheduler import Job, Quarantine, ResourceScheduler, format_eta, kill_containers_mounting, launch_order
+from staging import Stager
+from runtime_model import RuntimeModel
+from work_queue import WorkQueue
+
 # --- Configuration ---
 
 # --- Paths to your input/output list files ---
@@ -19,6 +24,35 @@ OPTIONS = ["--modality", "t2"]
 # --- Log file to save command outputs ---
 LOG_FILE = "turboprep_processing_log.txt"
 
+# --- Node resource budget (None = detect free RAM / core count at start-up) ---
+MEM_BUDGET_GB = None
+CPU_BUDGET = None
+# Per-tool memory/thread costs, learned across runs (see scheduler.py)
+PROFILE_FILE = "tool_profiles.json"
+
+# --- Failure handling ---
+JOB_TIMEOUT_S = None        # wall-clock limit per attempt (None = tool default)
+MAX_ATTEMPTS = 3            # attempts per subject, retried with exponential backoff
+RETRY_BACKOFF_S = 60
+QUARANTINE_FILE = "quarantine.json"  # subjects that exhausted their attempts; delete entries to retry
+# Per-job durations + header features, used to start the slowest subjects first
+HISTORY_FILE = "job_history.jsonl"
+
+# --- Distributed mode ---
+# Directory on the shared filesystem (see work_queue.py). When set, subjects are
+# claimed from the queue instead of the list files, so any number of hosts can
+# run this script against the same NAS.
+QUEUE_DIR = None
+
+# --- Live metrics (see metrics_exporter.py) ---
+METRICS_FILE = "turboprep_metrics.prom"  # Prometheus text file, rewritten while the batch runs (None = off)
+METRICS_PORT = None                      # e.g. 9108 to also serve http://127.0.0.1:9108/metrics
+
+# --- Local scratch staging (see staging.py; list-file mode only) ---
+SCRATCH_DIR = None         # e.g. "/local/scratch/turboprep": stage inputs/template here, write outputs here first
+SCRATCH_BUDGET_GB = 50
+PREFETCH = 4               # subjects copied ahead of the running jobs
+
 # --- End Configuration ---
 
 def windows_to_wsl_path(win_path):
@@ -44,6 +78,94 @@ def read_paths_from_file(filepath):
         print(f"Error reading file {filepath}: {e}")
         sys.exit(1)
 
+def build_job(input_file_wsl, output_dir_win, log_f):
+    """Validate one input/output pair and return its Job, or None if it must be skipped."""
+
+    # Convert output path and ensure it exists
+    output_dir_wsl = windows_to_wsl_path(output_dir_win)
+    try:
+        os.makedirs(output_dir_wsl, exist_ok=True)
+    except OSError as e:
+        error_msg = f"Error creating directory {output_dir_wsl}: {e}"
+        print(f"\n{error_msg}")
+        log_f.write(f"SKIPPING: {input_file_wsl}\n{error_msg}\n")
+        log_f.write("-" * 50 + "\n")
+        return None
+
+    # Check if input file exists before running command
+    if not os.path.exists(input_file_wsl):
+        error_msg = f"Error: Input file not found: {input_file_wsl}"
+        print(f"\n{error_msg}")
+        log_f.write(f"SKIPPING: {input_file_wsl}\n{error_msg}\n")
+        log_f.write("-" * 50 + "\n")
+        return None
+
+    command = turboprep_command(input_file_wsl, output_dir_wsl, TEMPLATE_FILE)
+    return Job(input_file_wsl, "turboprep", command, meta={"output_dir": output_dir_wsl},
+               timeout_s=JOB_TIMEOUT_S,
+               cleanup=lambda d=output_dir_wsl: kill_containers_mounting(d))
+
+
+def turboprep_command(input_file, output_dir, template_file):
+    """TurboPrep command line as a list."""
+    return [
+        TURBOPREP_EXECUTABLE,
+        input_file,
+        output_dir,
+        template_file
+    ] + OPTIONS
+
+
+def use_scratch(jobs, stager):
+    """
+    Point every job at scratch copies of its input and the template and at a
+    local output directory; outputs are flushed back to meta['output_dir'].
+    """
+    template_local = stager.pin(TEMPLATE_FILE)
+    for job in launch_order(jobs):
+        input_local = stager.plan(job.key, [job.key])[job.key]
+        output_local = stager.output_dir(job.key)
+        job.command = turboprep_command(input_local, output_local, template_local)
+        job.prepare = lambda key=job.key: stager.acquire(key)
+        job.cleanup = lambda d=output_local: kill_containers_mounting(d)
+    return stager.start()
+
+
+def log_result(log_f, result):
+    input_file_wsl = result.job.key
+    log_f.write(f"Processing: {input_file_wsl}\n")
+    log_f.write(f"Output Dir: {result.job.meta['output_dir']}\n")
+    log_f.write(f"Command: {' '.join(result.command)}\n")
+
+    if result.error is not None:
+        error_msg = f"### Python script error during subprocess execution: {result.error} ###\n"
+        print(f"\n{error_msg}")
+        log_f.write(error_msg)
+    else:
+        # Log stdout and stderr
+        log_f.write("--- STDOUT ---\n")
+        log_f.write(result.stdout if result.stdout else "[No stdout]\n")
+        log_f.write("--- STDERR ---\n")
+        log_f.write(result.stderr if result.stderr else "[No stderr]\n")
+
+        if result.timed_out:
+            log_f.write(f"### Command timed out after {result.seconds:.0f}s; process tree killed ###\n")
+            print(f"\nWarning: Command timed out for {os.path.basename(input_file_wsl)}. Check log.")
+        elif result.returncode != 0:
+            log_f.write(f"### Command failed with exit code: {result.returncode} ###\n")
+            print(f"\nWarning: Command failed for {os.path.basename(input_file_wsl)} (Code: {result.returncode}). Check log.")
+        else:
+             log_f.write("### Command completed successfully ###\n")
+    if result.job.history:
+        log_f.write(f"Attempts: {result.attempts} ({'; '.join(result.job.history)})\n")
+        if not result.ok and QUEUE_DIR is None:
+            log_f.write(f"### Quarantined: listed in {QUARANTINE_FILE} ###\n")
+    log_f.write(f"Elapsed: {result.seconds:.1f}s, peak RSS: {result.peak_rss_gb:.2f} GB\n")
+
+    log_f.write("-" * 50 + "\n")
+    log_f.flush() # Ensure entry is fully written
+
+
 def run_processing():
     """Reads paths, runs turboprep command for each, logs output."""
 
@@ -60,6 +182,10 @@ def run_processing():
         print(f"Error: Template file not found at {TEMPLATE_FILE}")
         sys.exit(1)
 
+    if QUEUE_DIR is not None:
+        run_queue_worker()
+        return
+
     print("Reading input and output paths...")
     input_files = read_paths_from_file(INPUT_FILE_LIST)
     output_dirs_win = read_paths_from_file(OUTPUT_DIR_LIST)
@@ -76,76 +202,131 @@ def run_processing():
     print(f"Logging output to: {LOG_FILE}")
 
     # --- Processing Loop ---
+    quarantine = Quarantine(QUARANTINE_FILE)
+    metrics = exporter_from_config(METRICS_FILE, METRICS_PORT)
+    scheduler = ResourceScheduler(mem_budget_gb=MEM_BUDGET_GB, cpu_budget=CPU_BUDGET,
+                                  profile_path=PROFILE_FILE, max_attempts=MAX_ATTEMPTS,
+                                  backoff_s=RETRY_BACKOFF_S, quarantine=quarantine, metrics=metrics)
+    print(f"Scheduler: {scheduler.describe()}")
+    if metrics is not None:
+        print(f"Metrics: {metrics.describe()}")
+
     with open(LOG_FILE, 'w') as log_f:
         log_f.write(f"--- Starting processing run at {__import__('datetime').datetime.now()} ---\n")
 
-        # Use tqdm for progress bar
-        for input_file_wsl, output_dir_win in tqdm(zip(input_files, output_dirs_win), total=len(input_files), desc="Processing Files"):
-
-            # Convert output path and ensure it exists
-            output_dir_wsl = windows_to_wsl_path(output_dir_win)
-            try:
-                os.makedirs(output_dir_wsl, exist_ok=True)
-            except OSError as e:
-                error_msg = f"Error creating directory {output_dir_wsl}: {e}"
-                print(f"\n{error_msg}")
-                log_f.write(f"SKIPPING: {input_file_wsl}\n{error_msg}\n")
-                log_f.write("-" * 50 + "\n")
-                continue # Skip to the next file
-
-            # Check if input file exists before running command
-            if not os.path.exists(input_file_wsl):
-                error_msg = f"Error: Input file not found: {input_file_wsl}"
-                print(f"\n{error_msg}")
-                log_f.write(f"SKIPPING: {input_file_wsl}\n{error_msg}\n")
-                log_f.write("-" * 50 + "\n")
-                continue # Skip to the next file
-
-
-            # Construct the command as a list
-            command = [
-                TURBOPREP_EXECUTABLE,
-                input_file_wsl,
-                output_dir_wsl,
-                TEMPLATE_FILE
-            ] + OPTIONS
-
-            log_f.write(f"Processing: {input_file_wsl}\n")
-            log_f.write(f"Output Dir: {output_dir_wsl}\n")
-            log_f.write(f"Command: {' '.join(command)}\n")
-            log_f.flush() # Ensure log is written before running command
-
-            try:
-                # Run the command, capture output
-                result = subprocess.run(
-                    command,
-                    capture_output=True,
-                    text=True, # Decode stdout/stderr as text
-                    check=False # Don't raise exception on non-zero exit code
-                )
-
-                # Log stdout and stderr
-                log_f.write("--- STDOUT ---\n")
-                log_f.write(result.stdout if result.stdout else "[No stdout]\n")
-                log_f.write("--- STDERR ---\n")
-                log_f.write(result.stderr if result.stderr else "[No stderr]\n")
-
-                if result.returncode != 0:
-                    log_f.write(f"### Command failed with exit code: {result.returncode} ###\n")
-                    print(f"\nWarning: Command failed for {os.path.basename(input_file_wsl)} (Code: {result.returncode}). Check log.")
-                else:
-                     log_f.write("### Command completed successfully ###\n")
-
-            except Exception as e:
-                error_msg = f"### Python script error during subprocess execution: {e} ###\n"
-                print(f"\n{error_msg}")
-                log_f.write(error_msg)
+        jobs = []
+        for input_file_wsl, output_dir_win in zip(input_files, output_dirs_win):
+            job = build_job(input_file_wsl, output_dir_win, log_f)
+            if job is not None:
+                jobs.append(job)
 
+        jobs, quarantined = quarantine.filter(jobs)
+        for job in quarantined:
+            reason = quarantine.entries[job.key].get("last_error", "")
+            log_f.write(f"SKIPPING: {job.key}\nQuarantined after repeated failures: {reason}\n")
             log_f.write("-" * 50 + "\n")
-            log_f.flush() # Ensure entry is fully written
+        if quarantined:
+            print(f"Skipping {len(quarantined)} quarantined file(s); see {QUARANTINE_FILE}.")
+        log_f.flush()
+
+        # Predicted durations order the queue longest-first and drive the ETA
+        model = RuntimeModel(HISTORY_FILE)
+        model.annotate(jobs)
+
+        # Read-ahead to local scratch in launch order; outputs are written back behind the jobs
+        stager = None
+        if SCRATCH_DIR is not None:
+            stager = use_scratch(jobs, Stager(SCRATCH_DIR, SCRATCH_BUDGET_GB, PREFETCH))
+            print(f"Staging: {stager.describe()}")
+
+        # Jobs run concurrently within the node budget; results arrive as they finish
+        progress = tqdm(total=len(jobs), desc="Processing Files",
+                        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}, ETA {postfix}]")
+        progress.set_postfix_str("?")
+        try:
+            for result in scheduler.run(jobs):
+                model.record(result.job.tool, result.job.key, result.job.meta["features"],
+                             result.seconds, result.ok)
+                if stager is not None:
+                    stager.flush(result.job.key, result.job.meta["output_dir"])
+                progress.update(1)
+                progress.set_postfix_str(format_eta(scheduler.eta_seconds()))
+                log_result(log_f, result)
+        finally:
+            if metrics is not None:
+                metrics.stop()
+            if stager is not None:
+                print("Waiting for outputs to be written back...")
+                for error in stager.close():
+                    print(f"Warning: {error}")
+                    log_f.write(f"### Write-back failed: {error} ###\n")
+                print(f"Staging: {stager.summary()}")
+
+        progress.close()
 
     print("\nProcessing finished.")
     print(f"Check {LOG_FILE} for detailed output.")
 
+
+def run_queue_worker():
+    """
+    Distributed mode: claim subjects from the shared queue in QUEUE_DIR until it
+    is drained. Retries and quarantine are handled by the queue (failed/), so
+    that another host can pick up a job this one failed.
+    """
+    work_queue = WorkQueue(QUEUE_DIR, max_attempts=MAX_ATTEMPTS)
+    metrics = exporter_from_config(METRICS_FILE, METRICS_PORT)
+    if metrics is not None:
+        track_queue(metrics, work_queue)
+    scheduler = ResourceScheduler(mem_budget_gb=MEM_BUDGET_GB, cpu_budget=CPU_BUDGET,
+                                  profile_path=PROFILE_FILE, max_attempts=1, metrics=metrics)
+    model = RuntimeModel(HISTORY_FILE)
+    print(f"Worker {work_queue.worker_id} on queue {QUEUE_DIR}: {work_queue.status()}")
+    print(f"Scheduler: {scheduler.describe()}")
+    if metrics is not None:
+        print(f"Metrics: {metrics.describe()}")
+
+    log_name = f"{os.path.splitext(LOG_FILE)[0]}_{work_queue.worker_id}.txt"
+    with open(log_name, 'w') as log_f:
+        log_f.write(f"--- Starting queue worker at {__import__('datetime').datetime.now()} ---\n")
+
+        def refill():
+            # Claim as many jobs as would be admitted now, and no more, so
+            # leases aren't held idle
+            jobs = []
+            while scheduler.has_capacity("turboprep", [j.tool for j in jobs]):
+                spec = work_queue.claim()
+                if spec is None:
+                    if not jobs and work_queue.drained():
+                        return None
+                    break
+                job = build_job(spec["input"], spec["output"], log_f)
+                if job is None:
+                    work_queue.complete(spec["id"], False, {"error": "invalid input or output path"})
+                    continue
+                job.meta["queue_id"] = spec["id"]
+                jobs.append(job)
+            return model.annotate(jobs)
+
+        work_queue.start_heartbeats()
+        progress = tqdm(desc="Processing Files", unit="file")
+        try:
+            for result in scheduler.run([], refill=refill):
+                model.record(result.job.tool, result.job.key, result.job.meta["features"],
+                             result.seconds, result.ok)
+                work_queue.complete(result.job.meta["queue_id"], result.ok,
+                                    {"seconds": round(result.seconds, 1),
+                                     "error": None if result.ok else result.describe()})
+                progress.update(1)
+                progress.set_postfix(work_queue.status())
+                log_result(log_f, result)
+        finally:
+            work_queue.stop_heartbeats()
+            progress.close()
+            if metrics is not None:
+                metrics.stop()
+
+    print(f"\nQueue drained: {work_queue.status()}. Check {log_name} for detailed output.")
+
 if __name__ == "__main__":
     run_processing()
\ No newline at end of file
@@ -5,6 +5,13 @@ import sys
 from tqdm import tqdm
 from datetime import datetime
 
+from metrics_exporter import exporter_from_config, track_queue
+from scheduler import (Job, Quarantine, ResourceScheduler, container_label, docker_limits, format_eta,
+                       kill_containers_labelled, launch_order)
+from staging import Stager
+from runtime_model import RuntimeModel
+from work_queue import WorkQueue
+
 # --- Configuration ---
 INPUT_LIST = "./input_files_2.txt"
 OUTPUT_LIST = "./output_paths_2.txt"
@@ -12,6 +19,26 @@ TEMPLATE_FILE = "/home/sukhvansh/DIP/MNI152_T1_1mm_brain.nii.gz"
 DOCKER_IMAGE = "lemuelpansh/turboprep:latest"
 OPTIONS = ["--modality", "t1"]
 LOG_FILE = "turboprep_processing_log.txt"
+# Node budget (None = detect); per-tool costs live in PROFILE_FILE
+MEM_BUDGET_GB = None
+CPU_BUDGET = None
+PROFILE_FILE = "tool_profiles.json"
+# Timeout per attempt (None = tool default), retries and quarantine of repeat failures
+JOB_TIMEOUT_S = None
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF_S = 60
+QUARANTINE_FILE = "quarantine.json"
+# Duration history for longest-first ordering and the ETA
+HISTORY_FILE = "job_history.jsonl"
+# Shared-filesystem queue (see work_queue.py); when set, subjects are claimed from it
+QUEUE_DIR = None
+# Live Prometheus metrics (see metrics_exporter.py): text file and/or localhost port
+METRICS_FILE = "turboprep_gpu_metrics.prom"
+METRICS_PORT = None
+# Local scratch staging (see staging.py; list-file mode only): None = use the dataset paths directly
+SCRATCH_DIR = None
+SCRATCH_BUDGET_GB = 50
+PREFETCH = 4
 
 # --- Helpers ---
 def windows_to_wsl(path: str) -> str:
@@ -32,49 +59,178 @@ def read_lines(filepath: str):
         print(f"Error reading {filepath}: {e}")
         sys.exit(1)
 
+def build_job(in_wsl, out_win, limits, log):
+    out_wsl = windows_to_wsl(out_win)
+    os.makedirs(out_wsl, exist_ok=True)
+
+    if not os.path.exists(in_wsl):
+        log.write(f"Missing input: {in_wsl}\n" + "-"*40 + "\n")
+        return None
+
+    label = container_label(in_wsl)
+    cmd = docker_command(in_wsl, out_wsl, TEMPLATE_FILE, limits, label)
+    # Killing `docker run` leaves the container running, so stop it by its label
+    return Job(in_wsl, "turboprep_gpu", cmd, meta={"output_dir": out_wsl}, timeout_s=JOB_TIMEOUT_S,
+               cleanup=lambda lb=label: kill_containers_labelled(lb))
+
+
+def docker_command(in_path, out_dir, template, limits, label=None):
+    return [
+        "docker", "run", "--rm", "--gpus", "all",
+    ] + (["--label", label] if label else []) + limits + [
+        "-v", f"{os.path.dirname(in_path)}:/app/input",
+        "-v", f"{out_dir}:/app/output",
+        "-v", f"{os.path.dirname(template)}:/app/template",
+        DOCKER_IMAGE,
+        f"/app/input/{os.path.basename(in_path)}",
+        "/app/output",
+        f"/app/template/{os.path.basename(template)}",
+    ] + OPTIONS
+
+
+def use_scratch(jobs, stager, limits):
+    """Mount scratch copies of input and template and a local output dir; outputs flush back later."""
+    template_local = stager.pin(TEMPLATE_FILE)
+    for job in launch_order(jobs):
+        in_local = stager.plan(job.key, [job.key])[job.key]
+        out_local = stager.output_dir(job.key)
+        job.command = docker_command(in_local, out_local, template_local, limits, container_label(job.key))
+        job.prepare = lambda key=job.key: stager.acquire(key)
+    return stager.start()
+
+
+def log_result(log, result):
+    log.write("Running: " + " ".join(result.command) + "\n")
+    if result.error is not None:
+        log.write(f"Error: {result.error}\n")
+    if result.job.history:
+        log.write(f"Attempts: {result.attempts} ({'; '.join(result.job.history)})\n")
+    log.write("--- STDOUT ---\n" + (result.stdout or "[No stdout]\n"))
+    log.write("--- STDERR ---\n" + (result.stderr or "[No stderr]\n"))
+    log.write(f"Exit code: {result.returncode}\n" + "-"*40 + "\n")
+    log.flush()
+
+
 # --- Main Processing ---
 def main():
     # Pre-pull image
     subprocess.run(["docker", "pull", DOCKER_IMAGE], check=False)
 
+    if QUEUE_DIR is not None:
+        run_queue_worker()
+        return
+
     inputs   = read_lines(INPUT_LIST)
     outputs  = read_lines(OUTPUT_LIST)
     if len(inputs) != len(outputs):
         print("Error: input/output count mismatch.")
         sys.exit(1)
 
+    quarantine = Quarantine(QUARANTINE_FILE)
+    metrics = exporter_from_config(METRICS_FILE, METRICS_PORT)
+    scheduler = ResourceScheduler(mem_budget_gb=MEM_BUDGET_GB, cpu_budget=CPU_BUDGET,
+                                  profile_path=PROFILE_FILE, max_attempts=MAX_ATTEMPTS,
+                                  backoff_s=RETRY_BACKOFF_S, quarantine=quarantine, metrics=metrics)
+    limits = docker_limits(scheduler.profiles["turboprep_gpu"])
+
     with open(LOG_FILE, 'w') as log:
         log.write(f"Start: {datetime.now()}\n")
         gpu = subprocess.run(["nvidia-smi"], capture_output=True, text=True)
         log.write("--- GPU STATUS ---\n" + gpu.stdout + "\n")
+        log.write(f"Scheduler: {scheduler.describe()}\n")
+
+        jobs = []
+        for in_wsl, out_win in zip(inputs, outputs):
+            job = build_job(in_wsl, out_win, limits, log)
+            if job is not None:
+                jobs.append(job)
 
-        for in_wsl, out_win in tqdm(zip(inputs, outputs), total=len(inputs), desc="Processing"):
-            out_wsl = windows_to_wsl(out_win)
-            os.makedirs(out_wsl, exist_ok=True)
-
-            if not os.path.exists(in_wsl):
-                log.write(f"Missing input: {in_wsl}\n" + "-"*40 + "\n")
-                continue
-
-            # build docker command
-            cmd = [
-                "docker", "run", "--rm", "--gpus", "all",
-                "-v", f"{os.path.dirname(in_wsl)}:/app/input",
-                "-v", f"{out_wsl}:/app/output",
-                "-v", f"{os.path.dirname(TEMPLATE_FILE)}:/app/template",
-                DOCKER_IMAGE,
-                f"/app/input/{os.path.basename(in_wsl)}",
-                "/app/output",
-                f"/app/template/{os.path.basename(TEMPLATE_FILE)}",
-            ] + OPTIONS
-
-            log.write("Running: " + " ".join(cmd) + "\n")
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            log.write("--- STDOUT ---\n" + (result.stdout or "[No stdout]\n"))
-            log.write("--- STDERR ---\n" + (result.stderr or "[No stderr]\n"))
-            log.write(f"Exit code: {result.returncode}\n" + "-"*40 + "\n")
+        jobs, quarantined = quarantine.filter(jobs)
+        for job in quarantined:
+            log.write(f"Quarantined: {job.key}\n" + "-"*40 + "\n")
+
+        model = RuntimeModel(HISTORY_FILE)
+        model.annotate(jobs)
+        stager = None
+        if SCRATCH_DIR is not None:
+            stager = use_scratch(jobs, Stager(SCRATCH_DIR, SCRATCH_BUDGET_GB, PREFETCH), limits)
+            log.write(f"Staging: {stager.describe()}\n")
+        progress = tqdm(total=len(jobs), desc="Processing",
+                        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}, ETA {postfix}]")
+        progress.set_postfix_str("?")
+        try:
+            for result in scheduler.run(jobs):
+                model.record(result.job.tool, result.job.key, result.job.meta["features"],
+                             result.seconds, result.ok)
+                if stager is not None:
+                    stager.flush(result.job.key, result.job.meta["output_dir"])
+                progress.update(1)
+                progress.set_postfix_str(format_eta(scheduler.eta_seconds()))
+                log_result(log, result)
+        finally:
+            if metrics is not None:
+                metrics.stop()
+            if stager is not None:
+                for error in stager.close():
+                    print(f"Warning: {error}")
+                    log.write(f"Write-back failed: {error}\n")
+                log.write(f"Staging: {stager.summary()}\n")
+        progress.close()
 
     print(f"Done. See {LOG_FILE}")
 
+
+def run_queue_worker():
+    """Distributed mode: claim subjects from QUEUE_DIR until the shared queue is drained."""
+    work_queue = WorkQueue(QUEUE_DIR, max_attempts=MAX_ATTEMPTS)
+    metrics = exporter_from_config(METRICS_FILE, METRICS_PORT)
+    if metrics is not None:
+        track_queue(metrics, work_queue)
+    scheduler = ResourceScheduler(mem_budget_gb=MEM_BUDGET_GB, cpu_budget=CPU_BUDGET,
+                                  profile_path=PROFILE_FILE, max_attempts=1, metrics=metrics)
+    limits = docker_limits(scheduler.profiles["turboprep_gpu"])
+    model = RuntimeModel(HISTORY_FILE)
+    log_name = f"{os.path.splitext(LOG_FILE)[0]}_{work_queue.worker_id}.txt"
+
+    with open(log_name, 'w') as log:
+        log.write(f"Start: {datetime.now()} worker {work_queue.worker_id}\n")
+
+        def refill():
+            # Claim as many jobs as would be admitted now
+            jobs = []
+            while scheduler.has_capacity("turboprep_gpu", [j.tool for j in jobs]):
+                spec = work_queue.claim()
+                if spec is None:
+                    if not jobs and work_queue.drained():
+                        return None
+                    break
+                job = build_job(spec["input"], spec["output"], limits, log)
+                if job is None:
+                    work_queue.complete(spec["id"], False, {"error": "missing input"})
+                    continue
+                job.meta["queue_id"] = spec["id"]
+                jobs.append(job)
+            return model.annotate(jobs)
+
+        work_queue.start_heartbeats()
+        progress = tqdm(desc="Processing", unit="file")
+        try:
+            for result in scheduler.run([], refill=refill):
+                model.record(result.job.tool, result.job.key, result.job.meta["features"],
+                             result.seconds, result.ok)
+                work_queue.complete(result.job.meta["queue_id"], result.ok,
+                                    {"seconds": round(result.seconds, 1),
+                                     "error": None if result.ok else result.describe()})
+                progress.update(1)
+                progress.set_postfix(work_queue.status())
+                log_result(log, result)
+        finally:
+            work_queue.stop_heartbeats()
+            progress.close()
+            if metrics is not None:
+                metrics.stop()
+
+    print(f"Queue drained: {work_queue.status()}. See {log_name}")
+
 if __name__ == "__main__":
     main()
@@ -1,32 +1,62 @@
 import os
-import subprocess
+
+from metrics_exporter import exporter_from_config
+from scheduler import Job, ResourceScheduler
 
 # --- Configuration ---
 input_dir = "reg_0000"
 output_dir = "reg_0000_process"
-# Example command: modify as needed; {input_path} and {output_path} will be substituted
-command_template = "mri_synthseg --i \"{input_path}\" --o \"{output_path}\" --fast --threads 8 --resample 1"
+# Example command: modify as needed; {input_path} and {output_path} will be substituted,
+# {threads} is filled in by the scheduler with the job's share of the cores
+command_template = "mri_synthseg --i \"{input_path}\" --o \"{output_path}\" --fast --threads {threads} --resample 1"
+# Node budget (None = detect free RAM / core count); SynthSeg's memory cost is learned
+mem_budget_gb = None
+cpu_budget = None
+profile_file = "tool_profiles.json"
+# Live Prometheus metrics (see metrics_exporter.py); None disables the file
+metrics_file = "synthseg_metrics.prom"
+metrics_port = None
 
-# Ensure output directory exists
-os.makedirs(output_dir, exist_ok=True)
 
-# Process each file in the input directory
-for filename in os.listdir(input_dir):
-    input_path = os.path.join(input_dir, filename)
-    output_path = os.path.join(output_dir, filename)
+def run_segmentation(input_dir=input_dir, output_dir=output_dir, command_template=command_template,
+                     mem_budget_gb=mem_budget_gb, cpu_budget=cpu_budget, profile_file=profile_file,
+                     metrics_file=metrics_file, metrics_port=metrics_port):
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
 
-    # Skip if output file already exists
-    if os.path.exists(output_path):
-        print(f"Skipping {filename} (already processed)")
-        continue
+    jobs = []
+    # Process each file in the input directory
+    for filename in os.listdir(input_dir):
+        input_path = os.path.join(input_dir, filename)
+        output_path = os.path.join(output_dir, filename)
+
+        # Skip if output file already exists
+        if os.path.exists(output_path):
+            print(f"Skipping {filename} (already processed)")
+            continue
 
-    try:
         # Format the command with input and output paths
-        command = command_template.format(input_path=input_path, output_path=output_path)
-        print(f"Processing {input_path} -> {output_path}")
-        subprocess.run(command, shell=True, check=True)
-        print(f"Successfully processed {filename}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command for {filename}: {e}")
-    except Exception as e:
-        print(f"Unexpected error for {filename}: {e}")
+        command = command_template.format(input_path=input_path, output_path=output_path, threads="{threads}")
+        jobs.append(Job(filename, "synthseg", command, shell=True))
+
+    metrics = exporter_from_config(metrics_file, metrics_port)
+    scheduler = ResourceScheduler(mem_budget_gb=mem_budget_gb, cpu_budget=cpu_budget, profile_path=profile_file,
+                                  metrics=metrics)
+    print(f"Scheduler: {scheduler.describe()}")
+
+    try:
+        for result in scheduler.run(jobs):
+            filename = result.job.key
+            if result.error is not None:
+                print(f"Unexpected error for {filename}: {result.error}")
+            elif result.returncode != 0:
+                print(f"Error running command for {filename}: exit code {result.returncode}\n{result.stderr}")
+            else:
+                print(f"Successfully processed {filename} ({result.seconds:.0f}s, peak {result.peak_rss_gb:.1f} GB)")
+    finally:
+        if metrics is not None:
+            metrics.stop()
+
+
+if __name__ == "__main__":
+    run_segmentation()
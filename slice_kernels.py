@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Allocation-free 2D slice kernels for the CLAHE / MSRCR loops.
+#
+# Every kernel writes into an explicit `out` array and takes its temporaries
+# from a `SliceArena`: named buffers that are allocated on first use and then
+# reused for every further slice of the same shape (and the CLAHE object is
+# created once). msrcr.py and normalize.py run their per-slice loops through
+# these kernels, so processing a volume allocates a handful of buffers instead
+# of several new arrays per slice. Results are bit-identical to the old
+# cv2.normalize(...).astype(np.uint8) / np.zeros_like code paths.
+#
+#   arena = worker_arena()
+#   out = np.empty(slice_2d.shape, np.uint8)
+#   apply_msrcr(slice_2d, out, arena)
+
+import threading
+
+import cv2
+import numpy as np
+
+_local = threading.local()
+
+
+class SliceArena:
+    """Named scratch buffers reused across slices (one arena per worker thread)."""
+
+    def __init__(self):
+        self._buffers = {}
+        self._clahe = {}
+
+    def get(self, name, shape, dtype):
+        """Buffer `name` with this shape and dtype; contents are undefined."""
+        dtype = np.dtype(dtype)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buf
+
+    def like(self, name, arr, dtype=None):
+        return self.get(name, arr.shape, arr.dtype if dtype is None else dtype)
+
+    def clahe(self, clip_limit, tile_grid_size):
+        key = (clip_limit, tuple(tile_grid_size))
+        obj = self._clahe.get(key)
+        if obj is None:
+            obj = self._clahe[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+        return obj
+
+    def nbytes(self):
+        return sum(b.nbytes for b in self._buffers.values())
+
+
+def worker_arena():
+    """The calling thread's arena (one per process for the ProcessPool workers)."""
+    arena = getattr(_local, "arena", None)
+    if arena is None:
+        arena = _local.arena = SliceArena()
+    return arena
+
+
+def _out(out, shape, dtype):
+    return np.empty(shape, dtype=dtype) if out is None else out
+
+
+def normalize_u8(src, out=None, arena=None):
+    """cv2.normalize(src, None, 0, 255, NORM_MINMAX).astype(np.uint8), into `out`."""
+    arena = arena or worker_arena()
+    out = _out(out, src.shape, np.uint8)
+    scratch = arena.like("normalize", src)
+    cv2.normalize(src, scratch, 0, 255, cv2.NORM_MINMAX)
+    np.copyto(out, scratch, casting="unsafe")
+    return out
+
+
+def brain_mask(slice_2d, out=None, arena=None, kernel_size=5):
+    """Otsu threshold + closing of a slice, as a bool mask in `out`."""
+    arena = arena or worker_arena()
+    out = _out(out, slice_2d.shape, bool)
+    norm8 = normalize_u8(slice_2d, arena.like("mask_norm8", slice_2d, np.uint8), arena)
+    thresh = arena.like("mask_thresh", slice_2d, np.uint8)
+    cv2.threshold(norm8, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=thresh)
+    kernel = arena.get("mask_kernel", (kernel_size, kernel_size), np.uint8)
+    kernel.fill(1)
+    closed = arena.like("mask_closed", slice_2d, np.uint8)
+    cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel, dst=closed)
+    np.not_equal(closed, 0, out=out)
+    return out
+
+
+def clahe(slice_2d, out=None, arena=None, clip_limit=2.0, tile_grid_size=(8, 8)):
+    """Min-max to uint8, then CLAHE, into uint8 `out`."""
+    arena = arena or worker_arena()
+    out = _out(out, slice_2d.shape, np.uint8)
+    norm8 = normalize_u8(slice_2d, arena.like("clahe_norm8", slice_2d, np.uint8), arena)
+    arena.clahe(clip_limit, tile_grid_size).apply(norm8, dst=out)
+    return out
+
+
+def msrcr(slice_2d, out=None, arena=None, sigma_list=(15, 80, 250), gain=1.0, offset=0):
+    """Multi-scale retinex (log10, cv2 blurs) normalized to uint8 `out`."""
+    arena = arena or worker_arena()
+    out = _out(out, slice_2d.shape, np.uint8)
+    img = arena.like("msrcr_img", slice_2d, np.float32)
+    np.copyto(img, slice_2d, casting="unsafe")
+    img += 1.0
+    log_img = arena.like("msrcr_log", img)
+    np.log10(img, out=log_img)
+    blur = arena.like("msrcr_blur", img)
+    retinex = arena.like("msrcr_retinex", img)
+    retinex.fill(0)
+    for sigma in sigma_list:
+        cv2.GaussianBlur(img, (0, 0), sigma, dst=blur)
+        np.log10(blur, out=blur)
+        np.subtract(log_img, blur, out=blur)
+        retinex += blur
+    retinex /= len(sigma_list)
+    if gain != 1.0:
+        retinex *= gain
+    if offset:
+        retinex += offset
+    return normalize_u8(retinex, out, arena)
+
+
+def blend_u8(a, b, wa, wb, out, arena=None):
+    """out = wa * a + wb * b (float64, truncated to out's dtype like an array store)."""
+    arena = arena or worker_arena()
+    acc = arena.like("blend_a", a, np.float64)
+    tmp = arena.like("blend_b", b, np.float64)
+    np.multiply(a, wa, out=acc)
+    np.multiply(b, wb, out=tmp)
+    acc += tmp
+    np.copyto(out, acc, casting="unsafe")
+    return out
+
+
+def masked_copy(src, mask, out):
+    """out = src inside mask, 0 elsewhere (replaces zeros_like + boolean assignment)."""
+    out.fill(0)
+    np.copyto(out, src, where=mask, casting="unsafe")
+    return out
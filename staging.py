@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# Local scratch staging for jobs whose dataset lives on network storage.
+#
+# The batch drivers (script.py, script_gpu.py) point TurboPrep at local copies
+# instead of the NAS paths:
+#   * read-ahead - the inputs of the next PREFETCH jobs (in the scheduler's
+#     launch order) are copied to SCRATCH_DIR by a small thread pool while the
+#     current jobs run; the template is copied once and pinned;
+#   * jobs write to a per-job local output directory; when a job finishes its
+#     outputs are flushed back to the dataset tree by a write-behind pool
+#     (written to a temporary name, fsynced, renamed, then verified by size
+#     and, with VERIFY = "sha256", by re-reading the remote copy), and only
+#     then is the local copy deleted - a failed flush keeps it and is reported;
+#   * the bytes on scratch (pinned + staged inputs + outputs waiting to be
+#     flushed) are kept under SCRATCH_BUDGET_GB: read-ahead pauses while the
+#     budget is full. A job whose inputs were not prefetched yet stages them on
+#     demand, so the budget never blocks the job that is about to run.
+# A job waits for its own inputs only (Job.prepare), so the scheduler's workers
+# stay busy with compute while the copies for later jobs and the flushes of
+# earlier ones proceed in the background.
+#
+#   stager = Stager("/scratch/turboprep", budget_gb=50, prefetch=4)
+#   template = stager.pin(TEMPLATE_FILE)
+#   local = stager.plan(key, [input_path]); out_dir = stager.output_dir(key)
+#   stager.start(); ... stager.acquire(key) ... stager.flush(key, remote_dir)
+#   failures = stager.close()
+
+import os
+import re
+import shutil
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Configuration ---
+SCRATCH_BUDGET_GB = 50
+PREFETCH = 4           # jobs staged ahead of the running ones
+COPY_THREADS = 4       # concurrent read-ahead copies (hides per-file NAS latency)
+FLUSH_THREADS = 2
+VERIFY = "sha256"      # "sha256" (re-read the remote copy) or "size"
+CHUNK_BYTES = 8 << 20
+# --- End Configuration ---
+
+
+def _slug(key):
+    """Readable, collision-free directory name for a job key."""
+    readable = re.sub(r"[^A-Za-z0-9._-]+", "_", str(key)).strip("_")[-100:] or "job"
+    return f"{readable}-{hashlib.sha1(str(key).encode()).hexdigest()[:8]}"
+
+
+def copy_file(src, dst, fsync=False):
+    """Stream `src` to `dst` via a temporary name; returns (bytes, sha256 hex of the data)."""
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp = f"{dst}.part{os.getpid()}"
+    h = hashlib.sha256()
+    size = 0
+    with open(src, "rb") as fin, open(tmp, "wb") as fout:
+        while True:
+            chunk = fin.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            h.update(chunk)
+            fout.write(chunk)
+            size += len(chunk)
+        if fsync:
+            fout.flush()
+            os.fsync(fout.fileno())
+    shutil.copymode(src, tmp)
+    os.replace(tmp, dst)
+    return size, h.hexdigest()
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def tree_bytes(path):
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class _Item:
+    def __init__(self, key, sources, base, local):
+        self.key = key
+        self.base = base
+        self.sources = sources
+        self.local = local  # source -> local path
+        self.size = sum(os.path.getsize(s) for s in sources if os.path.exists(s))
+        self.state = "queued"  # queued -> copying -> ready | failed; released
+        self.error = None
+        self.acquired = False
+        self.ready = threading.Event()
+
+
+class Stager:
+    """Read-ahead input staging and write-behind output flushing under a scratch byte budget."""
+
+    def __init__(self, scratch_dir, budget_gb=SCRATCH_BUDGET_GB, prefetch=PREFETCH,
+                 copy_threads=COPY_THREADS, flush_threads=FLUSH_THREADS, verify=VERIFY):
+        self.root = os.path.abspath(scratch_dir)
+        self.budget = int(budget_gb * 1024 ** 3)
+        self.prefetch = prefetch
+        self.verify = verify
+        self._cond = threading.Condition()
+        self._items = {}
+        self._order = []
+        self._used = 0
+        self._pinned = 0
+        self._closed = False
+        self._copy_pool = ThreadPoolExecutor(copy_threads, thread_name_prefix="stage-in")
+        self._flush_pool = ThreadPoolExecutor(flush_threads, thread_name_prefix="stage-out")
+        self._flushes = []
+        self._thread = None
+        self.stats = {"staged_bytes": 0, "flushed_bytes": 0, "on_demand": 0, "peak_bytes": 0}
+
+    # --- Setup ---
+    def pin(self, path):
+        """Copy a file used by every job (the template) once; returns its local path."""
+        local = os.path.join(self.root, "pinned", os.path.basename(path))
+        if not (os.path.exists(local) and os.path.getsize(local) == os.path.getsize(path)):
+            copy_file(path, local)
+        with self._cond:
+            size = os.path.getsize(local)
+            self._pinned += size
+            self._add_used(size)
+        return local
+
+    def plan(self, key, sources):
+        """Register a job's input files, in launch order; returns {source: local path}."""
+        base = os.path.join(self.root, "in", _slug(key))
+        local = {src: os.path.join(base, os.path.basename(src)) for src in sources}
+        with self._cond:
+            self._items[key] = _Item(key, list(sources), base, local)
+            self._order.append(key)
+            self._cond.notify_all()
+        return local
+
+    def output_dir(self, key):
+        path = os.path.join(self.root, "out", _slug(key))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._read_ahead, daemon=True)
+            self._thread.start()
+        return self
+
+    # --- Budget ---
+    def _add_used(self, n):
+        self._used += n
+        self.stats["peak_bytes"] = max(self.stats["peak_bytes"], self._used)
+
+    def _release(self, n):
+        with self._cond:
+            self._used -= n
+            self._cond.notify_all()
+
+    def _fits(self, item):
+        # Nothing but pinned files on scratch: always admit, or one large job could wait forever
+        return self._used + item.size <= self.budget or self._used <= self._pinned
+
+    # --- Read-ahead ---
+    def _next_to_stage(self):
+        ahead = sum(1 for k in self._order
+                    if self._items[k].state in ("copying", "ready") and not self._items[k].acquired)
+        if ahead >= self.prefetch:
+            return None
+        for key in self._order:
+            item = self._items[key]
+            if item.state == "queued":
+                return item if self._fits(item) else None
+        return None
+
+    def _read_ahead(self):
+        while True:
+            with self._cond:
+                item = self._next_to_stage()
+                while item is None and not self._closed:
+                    self._cond.wait()
+                    item = self._next_to_stage()
+                if self._closed:
+                    return
+                self._begin(item)
+            self._copy_pool.submit(self._stage_in, item)
+
+    def _begin(self, item):
+        item.state = "copying"
+        self._add_used(item.size)
+
+    def _stage_in(self, item):
+        try:
+            for src, dst in item.local.items():
+                if not (os.path.exists(dst) and os.path.getsize(dst) == os.path.getsize(src)):
+                    copy_file(src, dst)
+            state, error = "ready", None
+        except Exception as e:
+            state, error = "failed", f"{type(e).__name__}: {e}"
+        with self._cond:
+            item.state, item.error = state, error
+            if state == "ready":
+                self.stats["staged_bytes"] += item.size
+            self._cond.notify_all()
+        item.ready.set()
+
+    # --- Job side ---
+    def acquire(self, key):
+        """Block until the job's inputs are on scratch (staging them now if needed); returns {source: local}."""
+        with self._cond:
+            item = self._items[key]
+            item.acquired = True
+            start_now = item.state == "queued"
+            if start_now:
+                self.stats["on_demand"] += 1
+                self._begin(item)
+            self._cond.notify_all()
+        if start_now:
+            self._stage_in(item)
+        item.ready.wait()
+        if item.state == "failed":
+            raise OSError(f"Staging inputs of {key} failed: {item.error}")
+        return item.local
+
+    def flush(self, key, remote_dir):
+        """Queue the job's local outputs for copy-back to `remote_dir`; its inputs are released now."""
+        local_out = os.path.join(self.root, "out", _slug(key))
+        size = tree_bytes(local_out)
+        with self._cond:
+            self._add_used(size)
+        self._drop_inputs(key)
+        future = self._flush_pool.submit(self._flush, key, local_out, remote_dir, size)
+        self._flushes.append(future)
+        return future
+
+    def discard(self, key):
+        """Drop a job's staged inputs and outputs without copying anything back."""
+        self._drop_inputs(key)
+        shutil.rmtree(os.path.join(self.root, "out", _slug(key)), ignore_errors=True)
+
+    def _drop_inputs(self, key):
+        item = self._items.get(key)
+        with self._cond:
+            if item is None or item.state == "released":
+                return
+            if item.state == "queued":
+                item.state = "released"
+                self._cond.notify_all()
+                return
+        item.ready.wait()
+        shutil.rmtree(item.base, ignore_errors=True)
+        with self._cond:
+            item.state = "released"
+            self._used -= item.size
+            self._cond.notify_all()
+
+    def _flush(self, key, local_out, remote_dir, size):
+        """Copy, verify, then delete the local outputs; returns None or an error string."""
+        try:
+            for dirpath, _, files in os.walk(local_out):
+                rel = os.path.relpath(dirpath, local_out)
+                for name in files:
+                    src = os.path.join(dirpath, name)
+                    dst = os.path.normpath(os.path.join(remote_dir, rel, name))
+                    n, digest = copy_file(src, dst, fsync=True)
+                    if os.path.getsize(dst) != n:
+                        raise OSError(f"size mismatch after copying {dst}")
+                    if self.verify == "sha256" and file_sha256(dst) != digest:
+                        raise OSError(f"checksum mismatch after copying {dst}")
+                    with self._cond:
+                        self.stats["flushed_bytes"] += n
+        except Exception as e:
+            # Keep the local copy (still counted against the budget) so nothing is lost
+            return f"{key}: flush to {remote_dir} failed ({type(e).__name__}: {e}); outputs kept in {local_out}"
+        shutil.rmtree(local_out, ignore_errors=True)
+        self._release(size)
+        return None
+
+    def close(self, wait=True):
+        """Wait for pending flushes and stop read-ahead; returns the list of flush errors."""
+        errors = [f.result() for f in self._flushes] if wait else []
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._copy_pool.shutdown(wait=wait)
+        self._flush_pool.shutdown(wait=wait)
+        for key in list(self._items):
+            if self._items[key].state not in ("queued", "released"):
+                self._drop_inputs(key)
+        return [e for e in errors if e]
+
+    def describe(self):
+        return (f"scratch {self.root}, budget {format_bytes(self.budget)}, "
+                f"read-ahead {self.prefetch} jobs, verify {self.verify}")
+
+    def summary(self):
+        s = self.stats
+        return (f"staged {format_bytes(s['staged_bytes'])} in, flushed {format_bytes(s['flushed_bytes'])} out, "
+                f"peak scratch {format_bytes(s['peak_bytes'])}, {s['on_demand']} on-demand stage-ins")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage a list of files to scratch and copy them back (I/O check).")
+    parser.add_argument("--inputs", required=True, help="File with one input path per line")
+    parser.add_argument("--scratch", required=True)
+    parser.add_argument("--dest", required=True, help="Directory the staged copies are flushed back to")
+    parser.add_argument("--budget-gb", type=float, default=SCRATCH_BUDGET_GB)
+    parser.add_argument("--prefetch", type=int, default=PREFETCH)
+    args = parser.parse_args()
+
+    with open(args.inputs) as f:
+        paths = [line.strip() for line in f if line.strip()]
+    stager = Stager(args.scratch, args.budget_gb, args.prefetch)
+    for p in paths:
+        stager.plan(p, [p])
+    stager.start()
+    for p in paths:
+        local = stager.acquire(p)[p]
+        shutil.copy(local, os.path.join(stager.output_dir(p), os.path.basename(p)))
+        stager.flush(p, args.dest)
+    errors = stager.close()
+    for e in errors:
+        print(e)
+    print(f"Staging finished: {len(paths) - len(errors)} done, {len(errors)} failed; {stager.summary()}.")
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# Parameter sweep for the CLAHE / MSRCR enhancement settings.
+#
+# Runs every point of a parameter grid over a subset of subjects and writes a
+# metrics table plus one output volume per (variant, subject). Variants that
+# share their expensive enhancement (the same sigma_list for MSRCR, the same
+# CLAHE settings) form one task per subject, so the resampled volume and its
+# Gaussian blurs are computed once per task and kept in a bounded in-memory
+# cache; adding grid points there mostly costs the cheap per-variant tail
+# (unsharp mask + white-stripe). When there are fewer tasks than workers (one
+# or two tuning subjects, one sigma_list) the groups are split further, so the
+# variants still run in parallel at the price of repeating the shared blurs.
+# --cache_mb is the budget across all workers; each gets an equal share.
+#
+# Example grid file (JSON, every value is a list of candidates):
+#   {"method": ["msrcr"], "sigma_list": [[15, 80, 250], [10, 60, 200]],
+#    "gain": [1.0], "sharpen_radius": [1.0], "sharpen_amount": [0.5, 1.0]}
+
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter
+from skimage import exposure
+
+from msrcr import white_stripe_normalize
+from intermediate_cache import load_resampled
+
+# --- Defaults (mirror msrcr_sample.py / normalize2.py) ---
+DEFAULT_PARAMS = {
+    "method": "msrcr",            # 'msrcr' (msrcr_sample.py) or 'clahe' (normalize2.py)
+    "sigma_list": (15, 80, 250),
+    "gain": 1.0,
+    "offset": 0.0,
+    "clip_limit": 0.03,
+    "tile_grid_size": (8, 8),
+    "sharpen_radius": 1.0,
+    "sharpen_amount": 1.0,
+}
+TARGET_SHAPE = (182, 218, 182)
+# --- End Defaults ---
+
+
+class IntermediateCache:
+    """
+    Thread-safe LRU cache of numpy arrays bounded by total size in bytes.
+    `get_or_compute` guarantees each key is computed once even under concurrency.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, (tuple, list)):
+            return sum(IntermediateCache._sizeof(v) for v in value)
+        return 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+        return None
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self._nbytes -= self._sizeof(self._items.pop(key))
+            if size > self.max_bytes:
+                return
+            self._items[key] = value
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._nbytes -= self._sizeof(evicted)
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            value = self.get(key)
+            if value is None:
+                with self._lock:
+                    self.misses += 1
+                value = compute()
+                self.put(key, value)
+        with self._lock:
+            self._key_locks.pop(key, None)
+        return value
+
+
+_cache = None
+
+
+def _init_worker(cache_bytes):
+    global _cache
+    _cache = IntermediateCache(cache_bytes)
+
+
+def expand_grid(grid):
+    """Cartesian product of a {param: [values]} grid, filled with defaults."""
+    unknown = set(grid) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {', '.join(sorted(unknown))}")
+    names = sorted(grid)
+    variants = []
+    for values in itertools.product(*(grid[n] for n in names)):
+        params = dict(DEFAULT_PARAMS)
+        for name, value in zip(names, values):
+            params[name] = tuple(value) if isinstance(value, list) else value
+        variants.append(params)
+    return variants
+
+
+def inplane_blur(vol, sigma):
+    # sigma 0 along z makes this identical to blurring every axial slice in 2D
+    return gaussian_filter(vol, sigma=(sigma, sigma, 0))
+
+
+def msrcr_volume(path, target_shape, sigma_list, gain, offset):
+    vol = _cache.get_or_compute(("resampled", path, target_shape),
+                                lambda: load_resampled(path, target_shape))[0]
+    # Cubic resampling can undershoot below -1 at the brain edge; clamp before the log
+    img_safe = np.maximum(vol, 0) + 1.0
+    log_img = np.log(img_safe)
+    retinex = np.zeros_like(img_safe)
+    for sigma in sigma_list:
+        blur = _cache.get_or_compute(("blur", path, target_shape, sigma),
+                                     lambda s=sigma: inplane_blur(img_safe, s))
+        retinex += log_img - np.log(blur + 1e-6)
+    retinex /= len(sigma_list)
+    return (gain * retinex + offset).astype(np.float32)
+
+
+def clahe_volume(vol, mask, clip_limit, tile_grid_size):
+    # Same per-slice ROI crop as normalize2.py, kernel size derived from the tile grid
+    proc = np.copy(vol)
+    for z in range(vol.shape[2]):
+        slice_mask = mask[:, :, z]
+        if not slice_mask.any():
+            continue
+        ys, xs = np.where(slice_mask)
+        y0, y1 = ys.min(), ys.max() + 1
+        x0, x1 = xs.min(), xs.max() + 1
+        crop = vol[y0:y1, x0:x1, z]
+        mn, mx = crop.min(), crop.max()
+        if mx <= mn:
+            continue
+        kernel_size = [max(1, int(np.ceil(s / t))) for s, t in zip(crop.shape, tile_grid_size)]
+        eq = exposure.equalize_adapthist((crop - mn) / (mx - mn),
+                                         clip_limit=clip_limit, kernel_size=kernel_size)
+        region_mask = slice_mask[y0:y1, x0:x1]
+        proc[y0:y1, x0:x1, z][region_mask] = (eq * (mx - mn) + mn)[region_mask]
+    return proc
+
+
+def unsharp(vol, radius, amount):
+    # skimage.filters.unsharp_mask(preserve_range=True) applied slice-by-slice
+    if amount == 0:
+        return vol
+    return vol + (vol - inplane_blur(vol, radius)) * amount
+
+
+def variant_metrics(normed, mask):
+    vals = normed[mask] if mask.any() else normed.ravel()
+    p01, p50, p99 = np.percentile(vals, [1, 50, 99])
+    hist, _ = np.histogram(vals, bins=256, range=(p01, p99) if p99 > p01 else None)
+    prob = hist[hist > 0] / hist.sum()
+    return {
+        "mean": float(vals.mean()),
+        "std": float(vals.std()),
+        "p01": float(p01),
+        "p50": float(p50),
+        "p99": float(p99),
+        "entropy": float(-(prob * np.log2(prob)).sum()),
+    }
+
+
+def enhancement_key(params):
+    """Variants with equal keys share their expensive step (Gaussian blurs / CLAHE)."""
+    if params["method"] == "msrcr":
+        return ("msrcr", params["sigma_list"])
+    return (params["method"], params["clip_limit"], params["tile_grid_size"])
+
+
+def plan_tasks(variants, n_subjects, workers):
+    """
+    Lists of variant indices, each run as one task per subject: variants that
+    share an enhancement stay together, and the largest groups are halved
+    until there are enough tasks to keep `workers` busy.
+    """
+    groups = {}
+    for idx, params in enumerate(variants):
+        groups.setdefault(enhancement_key(params), []).append(idx)
+    groups = list(groups.values())
+    wanted = -(-max(1, workers) // max(1, n_subjects))  # tasks per subject
+    while len(groups) < wanted:
+        largest = max(groups, key=len)
+        if len(largest) < 2:
+            break
+        groups.remove(largest)
+        half = len(largest) // 2
+        groups += [largest[:half], largest[half:]]
+    return groups
+
+
+def run_subject(path, variants, out_dir, target_shape):
+    """Evaluate (index, params) variants on one subject; returns one metrics row per variant."""
+    rows = []
+    fname = os.path.basename(path)
+    for idx, params in variants:
+        t0 = time.perf_counter()
+        vol, mask, affine, header = _cache.get_or_compute(
+            ("resampled", path, target_shape), lambda: load_resampled(path, target_shape))
+        if params["method"] == "msrcr":
+            enhanced = _cache.get_or_compute(
+                ("msrcr", path, target_shape, params["sigma_list"], params["gain"], params["offset"]),
+                lambda: msrcr_volume(path, target_shape, params["sigma_list"],
+                                     params["gain"], params["offset"]))
+        elif params["method"] == "clahe":
+            enhanced = _cache.get_or_compute(
+                ("clahe", path, target_shape, params["clip_limit"], params["tile_grid_size"]),
+                lambda: clahe_volume(vol, mask, params["clip_limit"], params["tile_grid_size"]))
+        else:
+            raise ValueError(f"Invalid method: {params['method']}")
+
+        sharpened = unsharp(enhanced, params["sharpen_radius"], params["sharpen_amount"])
+        normed = white_stripe_normalize(sharpened, lower_pct=70, upper_pct=90, mask=mask).astype(np.float32)
+        elapsed = time.perf_counter() - t0
+
+        variant_dir = os.path.join(out_dir, f"v{idx:03d}")
+        os.makedirs(variant_dir, exist_ok=True)
+        nib.save(nib.Nifti1Image(normed, affine, header), os.path.join(variant_dir, fname))
+
+        row = {"variant": f"v{idx:03d}", "subject": fname, "seconds": round(elapsed, 3)}
+        row.update(variant_metrics(normed, mask))
+        rows.append(row)
+    print(f"{fname}: {len(variants)} variants (cache hits {_cache.hits}, misses {_cache.misses})")
+    return rows
+
+
+def run_sweep(input_paths, grid, out_dir, target_shape=TARGET_SHAPE, workers=1, cache_mb=4096):
+    """`cache_mb` bounds the in-memory caches of all workers together."""
+    variants = expand_grid(grid)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "variants.json"), "w") as f:
+        json.dump({f"v{i:03d}": p for i, p in enumerate(variants)}, f, indent=2)
+
+    workers = workers or os.cpu_count() or 1
+    tasks = plan_tasks(variants, len(input_paths), workers)
+    print(f"{len(variants)} variants x {len(input_paths)} subjects as {len(tasks) * len(input_paths)} tasks "
+          f"on {workers} workers ({cache_mb // workers} MB cache each)")
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cache_mb * 1024 ** 2 // workers,)) as pool:
+        futures = {pool.submit(run_subject, p, [(i, variants[i]) for i in task], out_dir, tuple(target_shape)): p
+                   for task in tasks for p in input_paths}
+        for fut in as_completed(futures):
+            try:
+                rows.extend(fut.result())
+            except Exception as e:
+                print(f"Error processing {futures[fut]}: {e}")
+
+    param_names = sorted(DEFAULT_PARAMS)
+    metrics_path = os.path.join(out_dir, "metrics.csv")
+    with open(metrics_path, "w", newline="") as f:
+        fieldnames = ["variant", "subject"] + param_names + [
+            "seconds", "mean", "std", "p01", "p50", "p99", "entropy"]
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in sorted(rows, key=lambda r: (r["variant"], r["subject"])):
+            params = variants[int(row["variant"][1:])]
+            writer.writerow({**row, **{n: params[n] for n in param_names}})
+    print(f"Wrote {len(rows)} rows for {len(variants)} variants to {metrics_path}")
+    return metrics_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep CLAHE/MSRCR parameters over a subject subset.")
+    parser.add_argument("--input_dir", default="1", help="Directory of .nii.gz inputs")
+    parser.add_argument("--grid", required=True, help="JSON file mapping parameter -> list of values")
+    parser.add_argument("--output_dir", default="sweep_results")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N subjects")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--cache_mb", type=int, default=4096, help="In-memory cache budget across all workers")
+    args = parser.parse_args()
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+    inputs = sorted(os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir)
+                    if f.endswith('.nii.gz'))[:args.limit]
+    run_sweep(inputs, grid, args.output_dir, workers=args.workers, cache_mb=args.cache_mb)
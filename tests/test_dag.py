@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+from pipeline.dag import DAG, Stage, apply_overrides, fingerprint
+
+
+def add_suffix(src, dst, suffix):
+    """Test stage: copy src to dst with `suffix` appended."""
+    with open(src) as f:
+        text = f.read()
+    with open(dst, "w") as f:
+        f.write(text + suffix)
+
+
+def write_nothing(dst, suffix):
+    """Test stage that 'succeeds' without writing its declared output."""
+
+
+def stages():
+    return [
+        Stage("first", "test_dag:add_suffix", inputs=("{input}",), outputs=("{output_dir}/first.txt",),
+              args={"src": "{input}", "dst": "{output_dir}/first.txt"}, params={"suffix": "-a"}),
+        Stage("second", "test_dag:add_suffix", deps=("first",), outputs=("{output_dir}/second.txt",),
+              args={"src": "{output_dir}/first.txt", "dst": "{output_dir}/second.txt"}, params={"suffix": "-b"}),
+        Stage("side", "test_dag:add_suffix", inputs=("{input}",), outputs=("{output_dir}/side.txt",),
+              args={"src": "{input}", "dst": "{output_dir}/side.txt"}, params={"suffix": "-c"}),
+    ]
+
+
+@pytest.fixture
+def subjects(tmp_path):
+    subjects = []
+    for name in ("s1", "s2"):
+        src = tmp_path / f"{name}.txt"
+        src.write_text(name)
+        subjects.append({"input": str(src), "output_dir": str(tmp_path / "out" / name), "name": name})
+    return subjects
+
+
+def reasons(dag, **kwargs):
+    return {task: info["reason"] for task, info in dag.plan(**kwargs).items()}
+
+
+def stale(dag, **kwargs):
+    return sorted(task for task, reason in reasons(dag, **kwargs).items() if reason)
+
+
+def build(subjects, tmp_path, stage_list=None):
+    return DAG(stage_list or stages(), subjects, str(tmp_path / "state.json"))
+
+
+def test_first_run_builds_everything_then_nothing_is_stale(subjects, tmp_path):
+    ran, up_to_date, failed, skipped = build(subjects, tmp_path).run(workers=1)
+    assert (ran, up_to_date, failed, skipped) == (6, 0, 0, 0)
+    with open(os.path.join(subjects[0]["output_dir"], "second.txt")) as f:
+        assert f.read() == "s1-a-b"
+    assert stale(build(subjects, tmp_path)) == []
+
+
+def test_parameter_change_reruns_stage_and_dependents_only(subjects, tmp_path):
+    build(subjects, tmp_path).run(workers=1)
+    dag = build(subjects, tmp_path, apply_overrides(stages(), ["first.suffix=\"-x\""]))
+    assert stale(dag) == [("first", s["output_dir"]) for s in subjects] + \
+        [("second", s["output_dir"]) for s in subjects]
+    assert set(reasons(dag).values()) == {None, "inputs or parameters changed"}
+
+
+def test_changed_input_file_invalidates_its_subject(subjects, tmp_path):
+    build(subjects, tmp_path).run(workers=1)
+    with open(subjects[1]["input"], "a") as f:
+        f.write("!")
+    s2 = subjects[1]["output_dir"]
+    assert stale(build(subjects, tmp_path)) == [("first", s2), ("second", s2), ("side", s2)]
+
+
+def test_missing_output_reruns_only_that_task(subjects, tmp_path):
+    build(subjects, tmp_path).run(workers=1)
+    s1 = subjects[0]["output_dir"]
+    os.remove(os.path.join(s1, "first.txt"))
+    dag = build(subjects, tmp_path)
+    assert stale(dag) == [("first", s1)]
+    assert reasons(dag)[("first", s1)] == "outputs missing"
+
+
+def test_version_bump_and_forcing(subjects, tmp_path):
+    build(subjects, tmp_path).run(workers=1)
+    bumped = stages()
+    bumped[2].version = 2
+    assert {t[0] for t in stale(build(subjects, tmp_path, bumped))} == {"side"}
+    assert {t[0] for t in stale(build(subjects, tmp_path), force=("second",))} == {"second"}
+
+
+def test_unselected_stale_stage_blocks_its_dependents(subjects, tmp_path):
+    build(subjects, tmp_path).run(workers=1)
+    dag = build(subjects, tmp_path, apply_overrides(stages(), ["suffix=\"-y\""]))
+    ran, _, failed, skipped = dag.run(selected={"second", "side"}, workers=1)
+    assert (ran, failed, skipped) == (2, 0, 2)
+
+
+def test_fingerprint_covers_params_and_dependencies(subjects):
+    stage = stages()[1]
+    fields = dict(subjects[0], **stage.params)
+    base = fingerprint(stage, fields, ["dep"])
+    assert fingerprint(stage, fields, ["dep"]) == base
+    assert fingerprint(stage, fields, ["other"]) != base
+    stage.params["suffix"] = "-z"
+    assert fingerprint(stage, fields, ["dep"]) != base
+
+
+def test_missing_declared_output_fails_task_and_skips_dependents(subjects, tmp_path):
+    broken = stages()
+    broken[0] = Stage("first", "test_dag:write_nothing", inputs=("{input}",),
+                      outputs=("{output_dir}/first.txt",), args={"dst": "{output_dir}/first.txt"},
+                      params={"suffix": "-a"})
+    ran, _, failed, skipped = build(subjects, tmp_path, broken).run(workers=1)
+    assert (ran, failed, skipped) == (2, 2, 2)
+    assert stale(build(subjects, tmp_path, broken)) == sorted(
+        [("first", s["output_dir"]) for s in subjects] + [("second", s["output_dir"]) for s in subjects])
+
+
+def test_overrides_are_validated():
+    with pytest.raises(ValueError):
+        apply_overrides(stages(), ["first.nope=1"])
+    with pytest.raises(ValueError):
+        apply_overrides(stages(), ["suffix"])
+    updated = apply_overrides(stages(), ["suffix=[1, 2]"])
+    assert all(s.params["suffix"] == [1, 2] for s in updated)
+
+
+def test_cycles_and_unknown_dependencies_are_rejected():
+    with pytest.raises(ValueError, match="cycle"):
+        DAG([Stage("a", "m:f", deps=("b",)), Stage("b", "m:f", deps=("a",))], [], None)
+    with pytest.raises(ValueError, match="Unknown"):
+        DAG([Stage("a", "m:f", deps=("missing",))], [], None)
@@ -0,0 +1,81 @@
+import numpy as np
+import nibabel as nib
+import pytest
+
+from encoding import encode_intensity, encode_labels, save_labels, save_output
+
+
+@pytest.fixture
+def volume():
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(20, 24, 16)).astype(np.float32) * 3
+    data[:4] = 0  # background
+    return data
+
+
+@pytest.mark.parametrize("rel", [1e-2, 1e-3])
+def test_auto_encoding_round_trip_within_bound(tmp_path, volume, rel):
+    path = str(tmp_path / "out.nii.gz")
+    report = save_output(volume, np.eye(4), path, encoding="auto", max_rel_error=rel)
+    decoded = nib.load(path).get_fdata(dtype=np.float32)
+    bound = rel * (volume.max() - volume.min())
+    assert report["dtype"] in ("uint8", "int16")
+    assert np.abs(decoded - volume).max() <= bound * 1.0001
+    # Background stays exactly zero
+    assert np.all(decoded[:4] == 0)
+
+
+def test_loose_bound_picks_uint8_and_tight_bound_int16(volume):
+    assert encode_intensity(volume, max_rel_error=1e-2)[3]["dtype"] == "uint8"
+    assert encode_intensity(volume, max_rel_error=1e-4)[3]["dtype"] == "int16"
+
+
+def test_unreachable_bound_falls_back_to_float32(volume):
+    q, slope, inter, report = encode_intensity(volume, max_rel_error=1e-7)
+    assert report["dtype"] == "float32" and q.dtype == np.float32
+    assert (slope, inter) == (1.0, 0.0)
+
+
+def test_forced_dtype_ignores_bound(tmp_path, volume):
+    path = str(tmp_path / "out.nii.gz")
+    report = save_output(volume, np.eye(4), path, encoding="uint8", max_rel_error=1e-6)
+    assert report["dtype"] == "uint8"
+    assert nib.load(path).get_data_dtype() == np.uint8
+
+
+def test_float32_default_is_lossless(tmp_path, volume):
+    path = str(tmp_path / "out.nii.gz")
+    assert save_output(volume, np.eye(4), path) is None
+    np.testing.assert_array_equal(nib.load(path).get_fdata(dtype=np.float32), volume)
+
+
+def test_nonfinite_values_are_zeroed_and_counted(volume):
+    volume[5, 5, 5] = np.nan
+    volume[6, 6, 6] = np.inf
+    q, slope, inter, report = encode_intensity(volume)
+    assert report["nonfinite"] == 2
+    assert q[5, 5, 5] * slope + inter == pytest.approx(0, abs=report["bound"])
+
+
+def test_positive_only_volume_round_trip(volume):
+    data = np.abs(volume) + 10
+    q, slope, inter, report = encode_intensity(data)
+    decoded = q.astype(np.float32) * np.float32(slope) + np.float32(inter)
+    assert np.abs(decoded - data).max() <= report["bound"] * 1.0001
+
+
+def test_labels_use_smallest_dtype_and_round_trip(tmp_path):
+    labels = np.zeros((8, 8, 8), dtype=np.float64)
+    labels[2:4] = 2
+    labels[5:7] = 41
+    assert encode_labels(labels).dtype == np.uint8
+    assert encode_labels(labels * 100).dtype == np.uint16
+    assert encode_labels(-labels).dtype == np.int8
+    path = str(tmp_path / "labels.nii.gz")
+    assert save_labels(labels, np.eye(4), path) == "uint8"
+    np.testing.assert_array_equal(np.asanyarray(nib.load(path).dataobj), labels)
+
+
+def test_non_integer_labels_are_rejected():
+    with pytest.raises(ValueError):
+        encode_labels(np.array([0.0, 1.5]))
@@ -0,0 +1,99 @@
+import pytest
+
+import scheduler
+from scheduler import Job, Quarantine, ResourceScheduler, ToolProfile, estimate_makespan, launch_order
+
+
+@pytest.fixture(autouse=True)
+def plenty_of_memory(monkeypatch):
+    monkeypatch.setattr(scheduler, "read_meminfo", lambda: (64.0, 64.0))
+
+
+def make_scheduler(**kwargs):
+    profiles = {"small": ToolProfile(mem_gb=2, threads=1, timeout_s=30),
+                "big": ToolProfile(mem_gb=6, threads=2, timeout_s=30),
+                "capped": ToolProfile(mem_gb=1, threads=1, max_concurrent=2, learn=False, timeout_s=30)}
+    options = dict(profiles=profiles, mem_budget_gb=10, cpu_budget=4, poll_interval=0.05, backoff_s=0)
+    options.update(kwargs)
+    return ResourceScheduler(**options)
+
+
+def test_admission_respects_memory_threads_and_concurrency():
+    s = make_scheduler()
+    assert s.has_capacity("big")
+    assert s.has_capacity("small", ["big"])
+    # 6 + 2 + 2 GB fills the 10 GB budget, a fourth job does not fit
+    assert s.has_capacity("small", ["big", "small"])
+    assert not s.has_capacity("small", ["big", "small", "small"])
+    # Threads: 2 + 1 + 1 of 4 are taken, a second big job needs 2 more
+    assert not s.has_capacity("big", ["big", "small"])
+    assert s.has_capacity("capped", ["capped"])
+    assert not s.has_capacity("capped", ["capped", "capped"])
+
+
+def test_oversized_job_runs_alone():
+    s = make_scheduler(mem_budget_gb=1)
+    assert s.has_capacity("big")
+    assert not s.has_capacity("small", ["big"])
+
+
+def test_low_available_memory_blocks_admission(monkeypatch):
+    s = make_scheduler()
+    monkeypatch.setattr(scheduler, "read_meminfo", lambda: (64.0, 1.0))
+    assert not s.has_capacity("small", ["small"])
+
+
+def test_unknown_tool_is_an_error():
+    with pytest.raises(KeyError):
+        make_scheduler().has_capacity("nope")
+
+
+def test_threads_placeholder_is_filled():
+    results = list(make_scheduler().run([Job("a", "big", "echo {threads}", shell=True)]))
+    assert results[0].ok and results[0].stdout.strip() == "2"
+
+
+def test_failed_attempt_is_retried_and_only_the_last_is_yielded(tmp_path):
+    marker = tmp_path / "marker"
+    flaky = f"test -f {marker} || {{ touch {marker}; exit 1; }}"
+    results = list(make_scheduler(max_attempts=3).run([Job("flaky", "small", flaky, shell=True)]))
+    assert len(results) == 1
+    assert results[0].ok and results[0].attempts == 2
+    assert results[0].job.history == ["exit code 1"]
+
+
+def test_exhausted_job_is_quarantined(tmp_path):
+    quarantine = Quarantine(str(tmp_path / "quarantine.json"))
+    results = list(make_scheduler(max_attempts=2, quarantine=quarantine).run([Job("bad", "small", ["false"])]))
+    assert not results[0].ok and results[0].attempts == 2
+    assert quarantine.is_quarantined("bad")
+    runnable, skipped = Quarantine(quarantine.path).filter([Job("bad", "small", ["true"])])
+    assert not runnable and [j.key for j in skipped] == ["bad"]
+
+
+def test_timeout_kills_and_runs_cleanup():
+    cleaned = []
+    job = Job("slow", "small", ["sleep", "30"], timeout_s=0.2, cleanup=lambda: cleaned.append(True))
+    result = next(make_scheduler(max_attempts=1).run([job]))
+    assert result.timed_out and not result.ok
+    assert result.describe().startswith("timed out")
+    assert cleaned == [True]
+
+
+def test_refill_feeds_jobs_until_none():
+    batches = [[Job("a", "small", ["true"])], [], [Job("b", "small", ["true"])], None]
+    results = list(make_scheduler().run([], refill=lambda: batches.pop(0)))
+    assert sorted(r.job.key for r in results) == ["a", "b"]
+
+
+def test_duplicate_keys_are_rejected():
+    with pytest.raises(ValueError):
+        list(make_scheduler().run([Job("a", "small", ["true"]), Job("a", "small", ["true"])]))
+
+
+def test_launch_order_and_makespan():
+    jobs = [Job(k, "small", None, meta={"predicted_s": p}) for k, p in (("a", 1), ("b", 5), ("c", 3))]
+    assert [j.key for j in launch_order(jobs)] == ["b", "c", "a"]
+    assert estimate_makespan([5, 3, 1], 2) == 5
+    assert estimate_makespan([5, 3, 1], 1) == 9
+    assert estimate_makespan([2], 2, busy=[4]) == 4
@@ -0,0 +1,114 @@
+import os
+import time
+
+import pytest
+
+from work_queue import WorkQueue, job_id_for, specs_from_lists
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = WorkQueue(str(tmp_path / "queue"), worker_id="w1", lease_s=60, max_attempts=2)
+    q.enqueue(specs_from_lists(["/data/s1/t1.nii.gz", "/data/s2/t1.nii.gz"], ["/out/s1", "/out/s2"]))
+    return q
+
+
+def age(queue, state, job_id, seconds):
+    path = queue._path(state, job_id)
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_job_id_is_stable_and_distinguishes_paths():
+    assert job_id_for("/data/s1/t1.nii.gz") == job_id_for("/data/s1/t1.nii.gz")
+    assert job_id_for("/data/s1/t1.nii.gz") != job_id_for("/other/s1/t1.nii.gz")
+    assert job_id_for("/data/s1/t1.nii.gz").startswith("s1-")
+
+
+def test_enqueue_skips_known_ids(queue):
+    specs = specs_from_lists(["/data/s1/t1.nii.gz", "/data/s3/t1.nii.gz"], ["/out/s1", "/out/s3"])
+    assert queue.enqueue(specs) == 1
+    assert queue.status() == {"todo": 3, "leases": 0, "done": 0, "failed": 0}
+
+
+def test_claim_then_complete_ok(queue):
+    spec = queue.claim()
+    assert spec["worker"] == "w1"
+    assert queue.status()["leases"] == 1
+    queue.complete(spec["id"], True, {"seconds": 1.0})
+    assert queue.status() == {"todo": 1, "leases": 0, "done": 1, "failed": 0}
+    assert queue._read_json(queue._path("done", spec["id"]))["info"] == {"seconds": 1.0}
+
+
+def test_failures_retry_then_land_in_failed(queue):
+    spec = queue.claim()
+    queue.complete(spec["id"], False, {"error": "boom"})
+    retried = queue._read_json(queue._path("todo", spec["id"]))
+    assert retried["attempts"] == 1 and retried["last_error"] == "boom"
+
+    while queue.claim()["id"] != spec["id"]:
+        pass
+    queue.complete(spec["id"], False, {"error": "boom"})
+    assert queue._read_json(queue._path("failed", spec["id"]))["attempts"] == 2
+    assert not os.path.exists(queue._path("todo", spec["id"]))
+
+
+def test_expired_lease_is_reaped_back_to_todo(queue):
+    spec = queue.claim()
+    age(queue, "leases", spec["id"], 120)
+    assert queue.reap_expired() == 1
+    reaped = queue._read_json(queue._path("todo", spec["id"]))
+    assert reaped["attempts"] == 1
+    assert "worker" not in reaped and "lease expired" in reaped["last_error"]
+
+
+def test_fresh_lease_is_not_reaped(queue):
+    queue.claim()
+    assert queue.reap_expired() == 0
+    assert queue.status()["leases"] == 1
+
+
+def test_late_failure_from_lost_lease_is_ignored(queue):
+    spec = queue.claim()
+    age(queue, "leases", spec["id"], 120)
+    other = WorkQueue(queue.root, worker_id="w2", lease_s=60, max_attempts=2)
+    other.reap_expired()
+    reclaimed = other.claim()
+    while reclaimed["id"] != spec["id"]:
+        other.complete(reclaimed["id"], True)
+        reclaimed = other.claim()
+
+    # The first worker finishes after losing its lease: w2's lease stays untouched
+    queue.complete(spec["id"], False, {"error": "late"})
+    assert queue._read_json(queue._path("leases", spec["id"]))["worker"] == "w2"
+    assert queue.heartbeat() == []
+
+
+def test_late_success_from_lost_lease_is_kept_and_drops_stale_todo(queue):
+    spec = queue.claim()
+    age(queue, "leases", spec["id"], 120)
+    queue.reap_expired()
+    queue.complete(spec["id"], True)
+    assert os.path.exists(queue._path("done", spec["id"]))
+    # The re-queued copy is discarded by the next claim instead of running twice
+    nxt = queue.claim()
+    assert nxt["id"] != spec["id"]
+    assert not os.path.exists(queue._path("todo", spec["id"]))
+
+
+def test_clock_probe_is_removed(queue):
+    queue._fs_now()
+    assert not [n for n in os.listdir(queue.root) if n.startswith(".clock-")]
+
+
+def test_retry_failed_skips_unreadable_entries(queue):
+    with open(queue._path("failed", "broken"), "w") as f:
+        f.write("{not json")
+    spec = queue.claim()
+    queue.max_attempts = 1
+    queue.complete(spec["id"], False)
+
+    moved, skipped = queue.retry_failed()
+    assert moved == 1 and skipped == ["broken"]
+    assert queue._read_json(queue._path("todo", spec["id"]))["attempts"] == 0
+    assert os.path.exists(queue._path("failed", "broken"))
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# Work queue on a shared filesystem (NAS) for running the drivers on many hosts.
+#
+# Layout under the queue directory, one small JSON file per subject:
+#   todo/<id>.json      waiting to be claimed
+#   leases/<id>.json    claimed; the file's mtime is the owner's heartbeat
+#   done/<id>.json      completion marker with the result summary
+#   failed/<id>.json    gave up after max_attempts (acts as the quarantine)
+#
+# Every state change is a rename within the same filesystem, which is atomic,
+# so when several workers race for the same file exactly one rename succeeds.
+# Owners touch their lease files every `heartbeat_s`; a lease whose mtime is
+# older than `lease_s` belongs to a dead worker and is moved back to todo/ by
+# whichever worker notices first. Lease age is measured against the file
+# server's clock (via a probe file), so clock skew between hosts doesn't matter.
+#
+# Initialise once, then start `script.py` / `script_gpu.py` with QUEUE_DIR set
+# on as many hosts as you like:
+#   python work_queue.py init --queue-dir /nas/queue --inputs input_files.txt --outputs output_paths.txt
+
+import os
+import json
+import time
+import socket
+import hashlib
+import argparse
+import threading
+
+STATES = ("todo", "leases", "done", "failed")
+
+
+def job_id_for(input_path):
+    """Stable, filesystem-safe id: the session folder name plus a short path hash."""
+    name = os.path.basename(os.path.dirname(input_path)) or os.path.basename(input_path)
+    digest = hashlib.sha1(input_path.encode()).hexdigest()[:8]
+    return f"{name}-{digest}"
+
+
+class WorkQueue:
+    def __init__(self, root, worker_id=None, lease_s=600, heartbeat_s=60, max_attempts=3):
+        self.root = root
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_s = lease_s
+        self.heartbeat_s = heartbeat_s
+        self.max_attempts = max_attempts
+        self._owned = set()
+        self._priority = {}  # id -> predicted_s, todo specs are read once
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+        for state in STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    # --- Helpers ---
+    def _path(self, state, job_id):
+        return os.path.join(self.root, state, f"{job_id}.json")
+
+    def _write_json(self, path, data):
+        tmp = f"{path}.{self.worker_id}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _ids(self, state):
+        try:
+            names = os.listdir(os.path.join(self.root, state))
+        except FileNotFoundError:
+            return []
+        return [n[:-5] for n in names if n.endswith(".json")]
+
+    def _fs_now(self):
+        """Current time according to the file server (from a probe file, removed again)."""
+        probe = os.path.join(self.root, f".clock-{self.worker_id}")
+        with open(probe, "a"):
+            os.utime(probe, None)
+        try:
+            return os.stat(probe).st_mtime
+        finally:
+            os.remove(probe)
+
+    # --- Producer side ---
+    def enqueue(self, specs):
+        """Add job specs (dicts with an 'id'); ids already known in any state are skipped."""
+        known = set()
+        for state in STATES:
+            known.update(self._ids(state))
+        added = 0
+        for spec in specs:
+            if spec["id"] in known:
+                continue
+            spec = dict(spec, attempts=spec.get("attempts", 0))
+            tmp = os.path.join(self.root, f".{spec['id']}.{self.worker_id}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(spec, f)
+            try:
+                # link() fails if another host created the same entry meanwhile
+                os.link(tmp, self._path("todo", spec["id"]))
+                added += 1
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        return added
+
+    # --- Worker side ---
+    def claim(self):
+        """Claim one job; returns its spec or None if nothing is claimable right now."""
+        self.reap_expired()
+        done = set(self._ids("done"))
+        candidates = []
+        for job_id in self._ids("todo"):
+            if job_id in done:
+                # Finished by a worker whose lease had expired; drop the stale entry
+                try:
+                    os.remove(self._path("todo", job_id))
+                except FileNotFoundError:
+                    pass
+                continue
+            if job_id not in self._priority:
+                spec = self._read_json(self._path("todo", job_id))
+                if spec is None:
+                    continue
+                self._priority[job_id] = spec.get("predicted_s", 0.0)
+            candidates.append(job_id)
+        # Longest predicted first, matching the local LPT ordering
+        candidates.sort(key=lambda j: -self._priority[j])
+
+        for job_id in candidates:
+            src = self._path("todo", job_id)
+            dst = self._path("leases", job_id)
+            try:
+                # Refresh mtime first so the lease doesn't look expired the moment it lands
+                os.utime(src, None)
+                os.rename(src, dst)
+            except FileNotFoundError:
+                continue  # another worker won the race
+            spec = self._read_json(dst) or {"id": job_id}
+            lease = dict(spec, worker=self.worker_id, claimed=time.time())
+            self._write_json(dst, lease)
+            with self._lock:
+                self._owned.add(job_id)
+            return lease
+        return None
+
+    def heartbeat(self):
+        """Touch every lease we own; drops (and returns) ids we have lost."""
+        lost = []
+        with self._lock:
+            owned = list(self._owned)
+        for job_id in owned:
+            path = self._path("leases", job_id)
+            lease = self._read_json(path)
+            if lease is None or lease.get("worker") != self.worker_id:
+                lost.append(job_id)
+                continue
+            try:
+                os.utime(path, None)
+            except FileNotFoundError:
+                lost.append(job_id)
+        with self._lock:
+            self._owned.difference_update(lost)
+        return lost
+
+    def start_heartbeats(self):
+        def loop():
+            while not self._stop.wait(self.heartbeat_s):
+                self.heartbeat()
+        self._heartbeat_thread = threading.Thread(target=loop, daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeats(self):
+        self._stop.set()
+
+    def complete(self, job_id, ok, info=None):
+        """
+        Record the outcome of a claimed job. Failures go back to todo/ until
+        max_attempts is reached, then to failed/.
+        """
+        lease_path = self._path("leases", job_id)
+        lease = self._read_json(lease_path) or {"id": job_id, "attempts": 0}
+        record = dict(lease, worker=self.worker_id, finished=time.time(), ok=ok, info=info or {})
+        with self._lock:
+            self._owned.discard(job_id)
+
+        if ok:
+            self._write_json(self._path("done", job_id), record)
+        elif lease.get("worker") != self.worker_id:
+            # Our lease expired and the job is already back in circulation
+            return
+        else:
+            attempts = lease.get("attempts", 0) + 1
+            spec = {k: v for k, v in lease.items() if k not in ("worker", "claimed")}
+            spec["attempts"] = attempts
+            spec["last_error"] = (info or {}).get("error")
+            target = "failed" if attempts >= self.max_attempts else "todo"
+            self._write_json(self._path(target, job_id), spec)
+        if lease.get("worker") == self.worker_id:
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+
+    def reap_expired(self):
+        """Move leases of dead workers back to todo/ (or failed/); returns how many."""
+        now = self._fs_now()
+        reaped = 0
+        for job_id in self._ids("leases"):
+            path = self._path("leases", job_id)
+            try:
+                age = now - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age <= self.lease_s:
+                continue
+            grave = f"{path}.reaped-{self.worker_id}"
+            try:
+                os.rename(path, grave)  # only one reaper wins
+            except FileNotFoundError:
+                continue
+            spec = self._read_json(grave) or {"id": job_id}
+            spec = {k: v for k, v in spec.items() if k not in ("worker", "claimed")}
+            spec["attempts"] = spec.get("attempts", 0) + 1
+            spec["last_error"] = f"lease expired after {age:.0f}s"
+            target = "failed" if spec["attempts"] >= self.max_attempts else "todo"
+            self._write_json(self._path(target, job_id), spec)
+            os.remove(grave)
+            reaped += 1
+        # Clock probes left behind by killed (or older) workers
+        for name in os.listdir(self.root):
+            if name.startswith(".clock-"):
+                try:
+                    if now - os.stat(os.path.join(self.root, name)).st_mtime > self.lease_s:
+                        os.remove(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass
+        return reaped
+
+    def retry_failed(self):
+        """Move failed jobs back to todo/; unreadable entries stay in failed/. Returns (moved, skipped)."""
+        moved, skipped = 0, []
+        for job_id in self._ids("failed"):
+            path = self._path("failed", job_id)
+            spec = self._read_json(path)
+            if not isinstance(spec, dict):
+                skipped.append(job_id)
+                continue
+            spec["attempts"] = 0
+            self._write_json(self._path("todo", job_id), spec)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            moved += 1
+        for job_id in skipped:
+            print(f"Could not read failed/{job_id}.json; left in place")
+        return moved, skipped
+
+    def drained(self):
+        """True when nothing is waiting and no lease (ours or anyone's) is outstanding."""
+        return not self._ids("todo") and not self._ids("leases")
+
+    def status(self):
+        return {state: len(self._ids(state)) for state in STATES}
+
+
+def specs_from_lists(input_paths, output_dirs):
+    return [{"id": job_id_for(i), "input": i, "output": o} for i, o in zip(input_paths, output_dirs)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared-filesystem work queue for the batch drivers.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_init = sub.add_parser("init", help="Enqueue input/output list pairs")
+    p_init.add_argument("--queue-dir", required=True)
+    p_init.add_argument("--inputs", required=True)
+    p_init.add_argument("--outputs", required=True)
+    p_init.add_argument("--history", help="job_history.jsonl to predict durations for longest-first claiming")
+    p_init.add_argument("--tool", default="turboprep", help="Tool whose history is used with --history")
+    p_status = sub.add_parser("status", help="Show counts per state")
+    p_status.add_argument("--queue-dir", required=True)
+    p_retry = sub.add_parser("retry-failed", help="Move failed jobs back to todo")
+    p_retry.add_argument("--queue-dir", required=True)
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue_dir)
+    if args.command == "init":
+        with open(args.inputs) as f:
+            inputs = [line.strip() for line in f if line.strip()]
+        with open(args.outputs) as f:
+            outputs = [line.strip() for line in f if line.strip()]
+        if len(inputs) != len(outputs):
+            raise SystemExit("Error: input/output count mismatch.")
+        specs = specs_from_lists(inputs, outputs)
+        if args.history:
+            from runtime_model import RuntimeModel, header_features
+            model = RuntimeModel(args.history)
+            for spec in specs:
+                try:
+                    spec["predicted_s"] = model.predict(args.tool, header_features(spec["input"]))
+                except Exception:
+                    pass
+        print(f"Enqueued {queue.enqueue(specs)} new job(s).")
+    elif args.command == "retry-failed":
+        moved, skipped = queue.retry_failed()
+        print(f"Moved {moved} job(s) back to todo, {len(skipped)} unreadable.")
+    print(queue.status())